@@ -13,17 +13,19 @@ import matplotlib.pyplot as plt
 import scipy.spatial.distance as distance
 import numpy as np
 import itertools
-import gc
 import parasail
 import xml.etree.ElementTree as ET
 import cairo
 import hashlib
+import threading
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import my_classes as mc
 from pathlib import Path
 from snapgene_reader import snapgene_file_to_dict, snapgene_file_to_seqrecord
 from scipy.cluster.hierarchy import linkage, leaves_list
+from scipy.optimize import linear_sum_assignment
 from matplotlib import rc
 from Bio.Seq import Seq
 rc('font',**{'family':'sans-serif','sans-serif':['Helvetica']})
@@ -31,92 +33,208 @@ rc('font',**{'family':'sans-serif','sans-serif':['Helvetica']})
 """
 functions
 """
-def pre_survery(refseq_list, param_dict):
+# distance of pairs skipped by k-mer prefilter (larger than score_threshold, but not measured)
+FAR_DISTANCE = -1
+
+def pre_survery(refseq_list, param_dict, max_workers=None, callback=None, score_threshold=None, distance_cache_path=None):
+    return pre_survery_core(refseq_list, param_dict, is_linear=False, max_workers=max_workers, callback=callback, score_threshold=score_threshold, distance_cache_path=distance_cache_path)
+
+def pre_survery_linear(refseq_list, param_dict, max_workers=None, callback=None, score_threshold=None, distance_cache_path=None):
+    return pre_survery_core(refseq_list, param_dict, is_linear=True, max_workers=max_workers, callback=callback, score_threshold=score_threshold, distance_cache_path=distance_cache_path)
+
+def print_progress(N_done, total_N):
+    print(f"\rProcessing... {N_done}/{total_N}", end="")
+
+def pre_survery_core(refseq_list, param_dict, is_linear, max_workers=None, callback=None, score_threshold=None, distance_cache_path=None):
+    """
+    score_matrix[r, c]: distance of query (c) against refseq (r)
+    pairs are distributed to a process pool (max_workers=None: use all cores, 1: serial execution)
+    callback(N_done, total_N) is called every time a pair is finished
+    score_threshold: pairs whose distance must be larger than score_threshold (by KmerSketch) are not aligned, and FAR_DISTANCE is given instead of the distance
+    distance_cache_path: distances are loaded from / appended to PairwiseDistanceCache, so that only pairs with new sequences are aligned
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if callback is None:
+        callback = print_progress
     N = len(refseq_list)
-    total_N = N ** 2
-    i = 0
-    score_matrix = np.empty((N, N), dtype=int)
-    for r, my_refseq in enumerate(refseq_list):
-        for c, query in enumerate(refseq_list):
-            print(f"\rProcessing... {i+1}/{total_N}", end="")
-            i += 1
-            if r != c:
-                duplicated_refseq_seq = my_refseq.seq + my_refseq.seq
-                score_matrix[r, c] = calc_distance(duplicated_refseq_seq, query.seq, param_dict)
-            else:
-                score_matrix[r, c] = 0
+    seq_list = [refseq.seq for refseq in refseq_list]
+    hash_list = [refseq.my_hash for refseq in refseq_list]
+    score_matrix = np.zeros((N, N), dtype=int)
+    # identical sequences do not have to be aligned (distance is 0 as for r == c)
+    task_list = [(r, c) for r in range(N) for c in range(N) if hash_list[r] != hash_list[c]]
+    # cache
+    if distance_cache_path is not None:
+        distance_cache = PairwiseDistanceCache(distance_cache_path, param_dict, is_linear)
+        cached_task_list = [(r, c) for r, c in task_list if (hash_list[r], hash_list[c]) in distance_cache]
+        for r, c in cached_task_list:
+            score_matrix[r, c] = distance_cache[hash_list[r], hash_list[c]]
+        task_list = sorted(set(task_list) - set(cached_task_list))
+        print(f"{len(cached_task_list)} out of {len(cached_task_list) + len(task_list)} pairs were loaded from cache")
+    # prefilter
+    if score_threshold is not None:
+        sketch_list = [KmerSketch(seq, is_circular=not is_linear) for seq in seq_list]
+        far_task_list = [(r, c) for r, c in task_list if sketch_list[c].lower_bound_distance(sketch_list[r]) > score_threshold]
+        for r, c in far_task_list:
+            score_matrix[r, c] = FAR_DISTANCE
+        task_list = sorted(set(task_list) - set(far_task_list))
+        print(f"{len(far_task_list)} out of {len(far_task_list) + len(task_list)} pairs were skipped by k-mer prefilter")
+    total_N = len(task_list)
+    if (max_workers <= 1) or (total_N <= 1):
+        init_pre_survey_worker(seq_list, param_dict, is_linear)
+        for i, task in enumerate(task_list):
+            r, c, d = calc_distance_in_worker(task)
+            score_matrix[r, c] = d
+            callback(i + 1, total_N)
+    else:
+        chunksize = max(1, min(int(np.ceil(total_N / (max_workers * 4))), 20))
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=init_pre_survey_worker, initargs=(seq_list, param_dict, is_linear)) as executor:
+            for i, (r, c, d) in enumerate(executor.map(calc_distance_in_worker, task_list, chunksize=chunksize)):
+                score_matrix[r, c] = d
+                callback(i + 1, total_N)
     print()
+    if distance_cache_path is not None:
+        # distances given by prefilter are not cached
+        distance_cache.save({(hash_list[r], hash_list[c]): score_matrix[r, c] for r, c in task_list})
     return score_matrix
 
-def calc_distance(duplicated_refseq_seq, query_seq, param_dict):
-    gap_open_penalty = param_dict["gap_open_penalty"]
-    gap_extend_penalty = param_dict["gap_extend_penalty"]
-    match_score = param_dict["match_score"]
-    mismatch_score = param_dict["mismatch_score"]
-    my_custom_matrix =parasail.matrix_create("ACGT", match_score, mismatch_score)
-    # alignment
-    result = parasail.sw_trace(query_seq, duplicated_refseq_seq, gap_open_penalty, gap_extend_penalty, my_custom_matrix)
-    result = MyResult_Minimum(result)
-    # alignment for reverse complement
-    result_rc = parasail.sw_trace(str(Seq(query_seq).reverse_complement()), duplicated_refseq_seq, gap_open_penalty, gap_extend_penalty, my_custom_matrix)
-    result_rc = MyResult_Minimum(result_rc)
-    # use alignment with higher match
-    gc.collect()
-    is_rc = np.argmax([result.score, result_rc.score])
-    if not is_rc:
+class PairwiseDistanceCache():
+    """
+    tab-separated file of distances, keyed by (refseq hash, query hash, alignment params, mode)
+    new distances are appended, so the file can be shared across different refseq lists
+    """
+    param_keys = ["gap_open_penalty", "gap_extend_penalty", "match_score", "mismatch_score"]
+    def __init__(self, path, param_dict, is_linear) -> None:
+        self.path = Path(path)
+        self.param_str = ",".join(f"{k}={param_dict[k]}" for k in self.param_keys)
+        self.mode = "linear" if is_linear else "circular"
+        self.distance_dict = {}
+        if self.path.exists():
+            with open(self.path, "r") as f:
+                for line in f:
+                    refseq_hash, query_hash, param_str, mode, d = line.rstrip("\n").split("\t")
+                    if (param_str == self.param_str) and (mode == self.mode):
+                        self.distance_dict[refseq_hash, query_hash] = int(d)
+    def __contains__(self, key):
+        return key in self.distance_dict
+    def __getitem__(self, key):
+        return self.distance_dict[key]
+    def save(self, new_distance_dict):
+        new_distance_dict = {key: int(d) for key, d in new_distance_dict.items() if key not in self.distance_dict}
+        if len(new_distance_dict) == 0:
+            return
+        with open(self.path, "a") as f:
+            for (refseq_hash, query_hash), d in new_distance_dict.items():
+                f.write(f"{refseq_hash}\t{query_hash}\t{self.param_str}\t{self.mode}\t{d}\n")
+        self.distance_dict.update(new_distance_dict)
+
+class KmerSketch():
+    """
+    canonical k-mers of a sequence (2-bit encoded) to estimate the lower bound of the distance before alignment
+    each mismatch, insertion, deletion or unaligned base of the query breaks at most k k-mers of the query,
+    so (number of query k-mers absent in the refseq) / k <= distance
+    circular refseqs include k-mers spanning the origin
+    """
+    base2code = np.full(256, 4, dtype=np.uint8)
+    for code, b in enumerate("ACGT"):
+        base2code[ord(b)] = code
+        base2code[ord(b.lower())] = code
+    del code, b
+    def __init__(self, seq, k=15, is_circular=True) -> None:
+        self.k = k
+        # as query (linear)
+        self.query_kmer_codes = self.get_canonical_kmer_codes(seq)
+        # as refseq
+        if is_circular:
+            self.kmer_set = np.unique(self.get_canonical_kmer_codes(seq + seq[:k - 1]))
+        else:
+            self.kmer_set = np.unique(self.query_kmer_codes)
+    def get_canonical_kmer_codes(self, seq):
+        codes = self.base2code[np.frombuffer(seq.encode("ascii"), dtype=np.uint8)]
+        if len(codes) < self.k:
+            return np.empty(0, dtype=np.uint64)
+        kmers = np.lib.stride_tricks.sliding_window_view(codes, self.k)
+        kmers = kmers[(kmers < 4).all(axis=1)]     # k-mers with non-ACGT letters are ignored
+        weights = np.uint64(4) ** np.arange(self.k - 1, -1, -1, dtype=np.uint64)
+        kmer_codes = (kmers.astype(np.uint64) * weights).sum(axis=1, dtype=np.uint64)
+        kmer_codes_rc = ((3 - kmers[:, ::-1]).astype(np.uint64) * weights).sum(axis=1, dtype=np.uint64)
+        return np.minimum(kmer_codes, kmer_codes_rc)
+    def lower_bound_distance(self, refseq_sketch):
+        assert self.k == refseq_sketch.k
+        N_absent = len(self.query_kmer_codes) - np.isin(self.query_kmer_codes, refseq_sketch.kmer_set).sum()
+        return N_absent / self.k
+
+class DistanceCalculator():
+    """
+    distance = (query length) - (number of matches) + (number of deletions) of the alignment (forward or reverse complement, whichever has the higher score)
+    orientation is chosen by score-only alignment, and traceback is done only for the chosen one
+    """
+    def __init__(self, param_dict) -> None:
+        self.gap_open_penalty = param_dict["gap_open_penalty"]
+        self.gap_extend_penalty = param_dict["gap_extend_penalty"]
+        self.my_custom_matrix = parasail.matrix_create("ACGT", param_dict["match_score"], param_dict["mismatch_score"])
+    def align_score_only(self, query_seq, refseq_seq):
+        result = parasail.sw_striped_16(query_seq, refseq_seq, self.gap_open_penalty, self.gap_extend_penalty, self.my_custom_matrix)
+        if result.saturated:
+            result = parasail.sw_striped_32(query_seq, refseq_seq, self.gap_open_penalty, self.gap_extend_penalty, self.my_custom_matrix)
+        return result.score
+    def calc_distance(self, refseq_seq, query_seq):
+        query_seq_rc = str(Seq(query_seq).reverse_complement())
+        score = self.align_score_only(query_seq, refseq_seq)
+        score_rc = self.align_score_only(query_seq_rc, refseq_seq)
+        # use alignment with higher match
+        is_rc = np.argmax([score, score_rc])
+        if not is_rc:
+            result = MyResult_Minimum(parasail.sw_trace(query_seq, refseq_seq, self.gap_open_penalty, self.gap_extend_penalty, self.my_custom_matrix))
+        else:
+            result = MyResult_Minimum(parasail.sw_trace(query_seq_rc, refseq_seq, self.gap_open_penalty, self.gap_extend_penalty, self.my_custom_matrix))
+        assert result.score == max(score, score_rc)
         return len(query_seq) - result.count_N_match() + result.count_N_del()
-    else:
-        return len(query_seq) - result_rc.count_N_match() + result_rc.count_N_del()
 
-def pre_survery_linear(refseq_list, param_dict):
-    N = len(refseq_list)
-    total_N = N ** 2
-    i = 0
-    score_matrix = np.empty((N, N), dtype=int)
-    for r, my_refseq in enumerate(refseq_list):
-        for c, query in enumerate(refseq_list):
-            print(f"\rProcessing... {i+1}/{total_N}", end="")
-            i += 1
-            if r != c:
-                score_matrix[r, c] = calc_distance_linear(my_refseq.seq, query.seq, param_dict)
-            else:
-                score_matrix[r, c] = 0
-    print()
-    return score_matrix
+def init_pre_survey_worker(seq_list, param_dict, is_linear):
+    global worker_seq_list, worker_is_linear, worker_distance_calculator
+    worker_seq_list = seq_list
+    worker_is_linear = is_linear
+    worker_distance_calculator = DistanceCalculator(param_dict)
 
-def calc_distance_linear(refseq_seq, query_seq, param_dict):
-    gap_open_penalty = param_dict["gap_open_penalty"]
-    gap_extend_penalty = param_dict["gap_extend_penalty"]
-    match_score = param_dict["match_score"]
-    mismatch_score = param_dict["mismatch_score"]
-    my_custom_matrix =parasail.matrix_create("ACGT", match_score, mismatch_score)
-    # alignment
-    result = parasail.sw_trace(query_seq, refseq_seq, gap_open_penalty, gap_extend_penalty, my_custom_matrix)
-    result = MyResult_Minimum(result)
-    # alignment for reverse complement
-    result_rc = parasail.sw_trace(str(Seq(query_seq).reverse_complement()), refseq_seq, gap_open_penalty, gap_extend_penalty, my_custom_matrix)
-    result_rc = MyResult_Minimum(result_rc)
-    # use alignment with higher match
-    gc.collect()
-    is_rc = np.argmax([result.score, result_rc.score])
-    if not is_rc:
-        return len(query_seq) - result.count_N_match() + result.count_N_del()
+def calc_distance_in_worker(task):
+    r, c = task
+    if worker_is_linear:
+        refseq_seq = worker_seq_list[r]
     else:
-        return len(query_seq) - result_rc.count_N_match() + result_rc.count_N_del()
+        refseq_seq = worker_seq_list[r] + worker_seq_list[r]    # duplicated
+    return r, c, worker_distance_calculator.calc_distance(refseq_seq, worker_seq_list[c])
 
-def recommended_combination(score_matrix, score_threshold):
+def calc_distance(duplicated_refseq_seq, query_seq, param_dict):
+    return DistanceCalculator(param_dict).calc_distance(duplicated_refseq_seq, query_seq)
+
+def calc_distance_linear(refseq_seq, query_seq, param_dict):
+    return DistanceCalculator(param_dict).calc_distance(refseq_seq, query_seq)
+
+def get_distance_matrix(score_matrix):
+    """
+    symmetric distance matrix (the smaller one of both directions), where FAR_DISTANCE is given as np.inf
+    """
+    distance_matrix = np.where(score_matrix == FAR_DISTANCE, np.inf, score_matrix).astype(float)
+    return np.minimum(distance_matrix, distance_matrix.T)
+
+def recommended_combination(score_matrix, score_threshold, exact_limit=10000):
+    """
+    groups similar sequences by clustering, and distributes members of each group to different combinations
+    exact_limit: all permutations are compared if the number of them is not larger than exact_limit, otherwise each group is assigned by linear_sum_assignment (polynomial time)
+    the objectives differ: the exact search minimizes the variance of calc_group_score over combinations (balanced combinations),
+    while assign_group maximizes their sum, as the variance can not be solved as an assignment problem
+    in both cases, members of a group are always put in different combinations
+    """
     print(score_matrix)
 
-    distance_matrix = np.copy(score_matrix)
+    distance_matrix = get_distance_matrix(score_matrix)
     N = len(distance_matrix)
-    for i in range(N - 1):
-        for j in range(i + 1, N):
-            v = min(distance_matrix[i, j], distance_matrix[j, i])
-            distance_matrix[i, j] = v
-            distance_matrix[j, i] = v
 
     # clustering by sequence similarity (similar sequences will be grouped)
-    dArray = distance.squareform(distance_matrix)
+    # linkage does not accept np.inf: far pairs are never merged as long as they are above score_threshold
+    finite_distances = distance_matrix[np.isfinite(distance_matrix)]
+    dArray = distance.squareform(np.minimum(distance_matrix, max(finite_distances.max(), score_threshold) + 1))
     result = linkage(dArray, method='complete')
     print(leaves_list(result))
     # quit()
@@ -139,6 +257,7 @@ def recommended_combination(score_matrix, score_threshold):
             raise Exception("error!")
         combination_of_index = list(itertools.combinations(index_list, 2))
         scores = distance_matrix[tuple(zip(*combination_of_index))]
+        # far pairs (np.inf) are more dissimilar than any measured pairs
         return scores.min() / len(scores)
 
     # 似た配列がコンビにならないように、組み合わせを選出（グループ：似た者同士の集合、コンビ：違う者同士の集合）
@@ -150,6 +269,12 @@ def recommended_combination(score_matrix, score_threshold):
         selected_groups = [g + [None for i in range(N_combination - c)] for g in grouping if len(g) == c]
         if len(selected_groups) == 0:
             continue
+        # 組み合わせが多すぎる場合は、グループごとに割り当て問題として解く
+        N_permutation = np.prod(np.arange(N_combination - c + 1, N_combination + 1, dtype=float)) ** len(selected_groups)
+        if N_permutation > exact_limit:
+            for g in selected_groups:
+                assign_group(combination_list, [p_sub for p_sub in g if p_sub is not None], calc_group_score)
+            continue
         # どのような組み合わせでコンビに追加するかを全通り書き出す
         selected_group_permuation = [list(set(itertools.permutations(g, N_combination))) for g in selected_groups]
         product_of_selected_group_permutation = list(itertools.product(*selected_group_permuation))
@@ -176,6 +301,117 @@ def recommended_combination(score_matrix, score_threshold):
     print(combination_list)
     return combination_list, result
 
+def plan_multiplex(score_matrix, min_distance, max_plasmids_per_sample, refseq_lengths=None, exact_limit=10000):
+    """
+    distributes sequences to the minimum number of samples, where each sample contains at most max_plasmids_per_sample sequences
+    and any two sequences in a sample are separated by at least min_distance
+    starting from the lower bound of the number of samples, samples are filled by DSatur-like coloring of the conflict graph (pairs closer than min_distance),
+    and if it fails, by exact search (backtracking) until all sequences are assigned
+    exact_limit: the exact search is given up after exact_limit steps, so the number of samples is not guaranteed to be the minimum for large conflict graphs
+    refseq_lengths: if given, total length of each sample (i.e., expected coverage per plasmid) is balanced, otherwise the number of sequences is balanced
+    """
+    N = len(score_matrix)
+    assert max_plasmids_per_sample > 0
+    distance_matrix = get_distance_matrix(score_matrix)
+    conflict_matrix = distance_matrix < min_distance
+    np.fill_diagonal(conflict_matrix, False)
+    degree_array = conflict_matrix.sum(axis=1)
+    if refseq_lengths is None:
+        weight_array = np.ones(N, dtype=float)
+    else:
+        weight_array = np.array(refseq_lengths, dtype=float)
+    N_samples_min = max(int(np.ceil(N / max_plasmids_per_sample)), 1)
+    for N_samples in range(N_samples_min, N + 1):
+        combination_list = plan_multiplex_core(conflict_matrix, degree_array, weight_array, N_samples, max_plasmids_per_sample)
+        if combination_list is None:
+            combination_list = plan_multiplex_exact(conflict_matrix, degree_array, weight_array, N_samples, max_plasmids_per_sample, exact_limit)
+        if combination_list is not None:
+            print(combination_list)
+            return combination_list
+    raise Exception("error!")
+
+def plan_multiplex_core(conflict_matrix, degree_array, weight_array, N_samples, max_plasmids_per_sample):
+    N = len(conflict_matrix)
+    sample_idx_array = np.full(N, -1, dtype=int)
+    sample_conflict_matrix = np.zeros((N, N_samples), dtype=bool)  # [i, s]: i conflicts with a sequence in sample s
+    sample_size_array = np.zeros(N_samples, dtype=int)
+    sample_weight_array = np.zeros(N_samples, dtype=float)
+    for _ in range(N):
+        # most constrained sequence first (saturation, degree, weight)
+        unassigned = np.where(sample_idx_array < 0)[0]
+        saturation_array = sample_conflict_matrix[unassigned].sum(axis=1)
+        i = unassigned[np.lexsort((-weight_array[unassigned], -degree_array[unassigned], -saturation_array))[0]]
+        # least loaded sample among available ones
+        available_samples = np.where(~sample_conflict_matrix[i] & (sample_size_array < max_plasmids_per_sample))[0]
+        if len(available_samples) == 0:
+            return None
+        s = available_samples[np.lexsort((sample_size_array[available_samples], sample_weight_array[available_samples]))[0]]
+        sample_idx_array[i] = s
+        sample_size_array[s] += 1
+        sample_weight_array[s] += weight_array[i]
+        sample_conflict_matrix[conflict_matrix[i], s] = True
+    return [np.where(sample_idx_array == s)[0].tolist() for s in range(N_samples)]
+
+def plan_multiplex_exact(conflict_matrix, degree_array, weight_array, N_samples, max_plasmids_per_sample, exact_limit):
+    """
+    depth-first search of all assignments (sequences are assigned in descending order of degree)
+    returns None if no assignment exists, or if it is not found within exact_limit steps
+    """
+    N = len(conflict_matrix)
+    order = np.argsort(-degree_array, kind="stable")
+    sample_idx_array = np.full(N, -1, dtype=int)
+    sample_size_array = np.zeros(N_samples, dtype=int)
+    sample_weight_array = np.zeros(N_samples, dtype=float)
+    candidate_samples_list = [None for i in range(N)]  # samples not yet tried at each depth
+    depth = 0
+    N_steps = 0
+    while depth >= 0:
+        i = order[depth]
+        if candidate_samples_list[depth] is None:
+            is_available = (sample_size_array < max_plasmids_per_sample)
+            is_available[sample_idx_array[conflict_matrix[i] & (sample_idx_array >= 0)]] = False
+            # empty samples are interchangeable, so only the first one is tried
+            empty_samples = np.where(sample_size_array == 0)[0]
+            is_available[empty_samples[1:]] = False
+            available_samples = np.where(is_available)[0]
+            # least loaded sample is tried first
+            candidate_samples_list[depth] = available_samples[np.lexsort((sample_size_array[available_samples], sample_weight_array[available_samples]))[::-1]].tolist()
+        else:
+            # undo the previous trial
+            s = sample_idx_array[i]
+            sample_idx_array[i] = -1
+            sample_size_array[s] -= 1
+            sample_weight_array[s] -= weight_array[i]
+        if len(candidate_samples_list[depth]) == 0:
+            candidate_samples_list[depth] = None
+            depth -= 1
+            continue
+        N_steps += 1
+        if N_steps > exact_limit:
+            return None
+        s = candidate_samples_list[depth].pop()
+        sample_idx_array[i] = s
+        sample_size_array[s] += 1
+        sample_weight_array[s] += weight_array[i]
+        depth += 1
+        if depth == N:
+            return [np.where(sample_idx_array == s)[0].tolist() for s in range(N_samples)]
+    return None
+
+def assign_group(combination_list, group, calc_group_score):
+    """
+    members of a group are added to different combinations so that the total score (higher is more dissimilar) is maximized
+    (not the variance minimized by the exact search of recommended_combination)
+    """
+    score_matrix = np.array([[calc_group_score(combination + [m]) for combination in combination_list] for m in group])
+    # combinations of a single member (np.inf) are preferred to any others
+    finite_scores = score_matrix[np.isfinite(score_matrix)]
+    inf_score = (finite_scores.max() + 1) if len(finite_scores) > 0 else 1
+    score_matrix[np.isinf(score_matrix)] = inf_score
+    member_idx_list, combination_idx_list = linear_sum_assignment(score_matrix, maximize=True)
+    for m_idx, i in zip(member_idx_list, combination_idx_list):
+        combination_list[i].append(group[m_idx])
+
 class MyRefSeq_Minimum():
     def __init__(self, path: Path):
         self.path = path
@@ -302,25 +538,44 @@ class Svg():
         self.svg.append(text)
     @staticmethod
     def textsize(text, fontsize, font_style):
-        tmp_svg_path = "undefined.svg"
-        surface = cairo.SVGSurface(tmp_svg_path, 1280, 200)
-        cr = cairo.Context(surface)
-        cr.select_font_face(font_style, cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_BOLD)
-        cr.set_font_size(fontsize)
-        xbearing, ybearing, width, height, xadvance, yadvance = cr.text_extents(text)
-        os.remove(tmp_svg_path)
-        return {
-            "xbearing":xbearing, 
-            "ybearing":ybearing, 
-            "width":width, 
-            "height":height, 
-            "xadvance":xadvance, 
-            "yadvance":yadvance
-        }
+        return text_metrics.textsize(text, fontsize, font_style)
     def save(self, path):   # 上書き保存されます
         tree = ET.ElementTree(element=self.svg)
         tree.write(path, encoding='utf-8', xml_declaration=True)
 
+class TextMetrics():
+    """
+    text extents measured on a single SVGSurface without output (no temporary svg file), cached by (text, fontsize, font_style)
+    """
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.context = None
+        self.cache = {}
+    def get_context(self):
+        if self.context is None:
+            surface = cairo.SVGSurface(None, 1280, 200)
+            self.context = cairo.Context(surface)
+        return self.context
+    def textsize(self, text, fontsize, font_style):
+        key = (text, fontsize, font_style)
+        with self.lock:
+            if key not in self.cache:
+                cr = self.get_context()
+                cr.select_font_face(font_style, cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_BOLD)
+                cr.set_font_size(fontsize)
+                xbearing, ybearing, width, height, xadvance, yadvance = cr.text_extents(text)
+                self.cache[key] = {
+                    "xbearing":xbearing, 
+                    "ybearing":ybearing, 
+                    "width":width, 
+                    "height":height, 
+                    "xadvance":xadvance, 
+                    "yadvance":yadvance
+                }
+            return dict(self.cache[key])
+
+text_metrics = TextMetrics()
+
 class D(str):
     def __new__(cls, path_command_list=[]):
         initial_string = " ".join([f"{path_command} {','.join(map(str, values))}" for path_command, values in path_command_list])
@@ -349,7 +604,7 @@ def draw_heatmap(score_matrix, refseq_names, comb_idx_list, threshold_used, save
     details_width = max([Svg.textsize(details, details_font_size, font_style)["xadvance"] for details in details_list])
 
     # make matplotlib fig
-    fig, ax = draw_heatmap_core(score_matrix, x_labels=tmp_names, y_labels=tmp_names, value_font_size=value_font_size, tick_font_size=tick_font_size)
+    fig, ax = draw_heatmap_core(score_matrix, x_labels=tmp_names, y_labels=tmp_names, value_font_size=value_font_size, tick_font_size=tick_font_size, threshold_used=threshold_used)
 
     # highlight combination
     for i in comb_idx_list:
@@ -374,20 +629,27 @@ def draw_heatmap(score_matrix, refseq_names, comb_idx_list, threshold_used, save
     svg.adjust_margin(save_path, l=left_top_margin, r=right_margin, t=left_top_margin, b=bottom_margin)
     svg.save(save_path)
 
-def draw_heatmap_core(score_matrix, x_labels, y_labels, value_font_size=10, tick_font_size=14, subplot=[1,1,1]):
+def draw_heatmap_core(score_matrix, x_labels, y_labels, value_font_size=10, tick_font_size=14, subplot=[1,1,1], threshold_used=None):
+    """
+    threshold_used: pairs of FAR_DISTANCE are shown as ">threshold_used" (with the color of cbar_max)
+    """
     assert score_matrix.shape == (len(y_labels), len(x_labels))
     figsize_unit = 0.5
     cbar_max = 30   #score_matrix.max()#
+    is_far = score_matrix == FAR_DISTANCE
 
     fig =plt.figure(figsize=(len(x_labels) * figsize_unit, len(y_labels) * figsize_unit))
     ax = plt.subplot(*subplot)
-    im = plt.imshow(score_matrix, cmap="YlGn", vmin=0, vmax=cbar_max)
+    im = plt.imshow(np.where(is_far, cbar_max, score_matrix), cmap="YlGn", vmin=0, vmax=cbar_max)
     bar = plt.colorbar(im, fraction=0.046, pad=0.04)
     # Loop over data dimensions and create text annotations.
     for i in range(score_matrix.shape[0]):
         for j in range(score_matrix.shape[1]):
             if np.isnan(score_matrix[i, j]):
                 continue
+            if is_far[i, j]:
+                ax.text(j, i, f">{threshold_used}", ha="center", va="center", color="w", fontsize=value_font_size)
+                continue
             value = f"{np.round(score_matrix[i, j], 3)}"
             if np.absolute(score_matrix[i, j]) < cbar_max / 2:
                 text = ax.text(j, i, value, ha="center", va="center", color="k", fontsize=value_font_size)
@@ -465,7 +727,7 @@ class RecommendedGroupings(mc.MyTextFormat):
             else:
                 return False
 
-def main(uploaded_refseq_file_paths, param_dict, save_dir, score_matrix=None, tmp_names=None):
+def main(uploaded_refseq_file_paths, param_dict, save_dir, score_matrix=None, tmp_names=None, max_workers=None):
 
     # open files
     my_refseq_list = [
@@ -474,8 +736,11 @@ def main(uploaded_refseq_file_paths, param_dict, save_dir, score_matrix=None, tm
 
     # calc distance & propose optimized combination
     if score_matrix is None:
-        score_matrix = pre_survery(my_refseq_list, param_dict)
+        score_matrix = pre_survery(my_refseq_list, param_dict, max_workers=max_workers, score_threshold=param_dict["score_threshold"], distance_cache_path=save_dir / "pairwise_distance_cache.tsv")
     comb, result = recommended_combination(score_matrix, param_dict["score_threshold"])
+    max_plasmids_per_sample = param_dict.get("max_plasmids_per_sample", None)
+    if max_plasmids_per_sample is not None:
+        comb = plan_multiplex(score_matrix, param_dict["score_threshold"], max_plasmids_per_sample, refseq_lengths=[refseq.length for refseq in my_refseq_list])
     refseq_names = [refseq.path.name for refseq in my_refseq_list]
 
     # remove before make
@@ -538,7 +803,9 @@ if __name__ == "__main__":
     if recommended_groupings_path.exists():
         recommended_groupings = RecommendedGroupings()
         recommended_groupings.load(recommended_groupings_path)
-        if recommended_groupings.assert_data(uploaded_refseq_file_paths, tmp_names):
+        # pairs skipped by k-mer prefilter are only known to be above the threshold used at that time
+        is_reusable = (FAR_DISTANCE not in recommended_groupings.score_matrix) or (float(recommended_groupings.param_dict["score_threshold"]) >= score_threshold)
+        if recommended_groupings.assert_data(uploaded_refseq_file_paths, tmp_names) and is_reusable:
             score_matrix = recommended_groupings.score_matrix.astype(int)
             comb, score_matrix = main(uploaded_refseq_file_paths, param_dict, save_dir, score_matrix=score_matrix, tmp_names=tmp_names)
             skip = True
@@ -13,45 +13,82 @@ import pandas as pd
 import re
 import copy
 import zipfile
+import gzip
 import parasail
-import gc
 import textwrap
 import matplotlib.pyplot as plt
 import hashlib
+import time
 from datetime import datetime
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 from matplotlib.patches import Patch
 from itertools import product
-from collections import OrderedDict, namedtuple, defaultdict
+from collections import OrderedDict, namedtuple, defaultdict, deque
+from collections.abc import Mapping
+from array import array
 from snapgene_reader import snapgene_file_to_dict, snapgene_file_to_seqrecord
 from Bio.Seq import Seq
 from numpy.core.memmap import uint8
+from scipy.stats import norm
 from PIL import Image as PilImage
 from . import my_classes as mc
 
-class MyFastQ(OrderedDict):
+def iter_fastq(path):
+    """
+    yields (seq_id, seq, q) as bytes, 4 lines at a time (gzip/bgzip compressed files are also accepted)
+    """
+    with open(path, "rb") as f:
+        is_gzipped = f.read(2) == b"\x1f\x8b"
+    with (gzip.open(path, "rb") if is_gzipped else open(path, "rb")) as f:
+        while True:
+            seq_id = f.readline()
+            if not seq_id:
+                break
+            seq = f.readline()
+            p = f.readline()
+            q = f.readline()
+            assert p.strip() == b"+"
+            yield seq_id.strip(), seq.strip(), q.strip()
+
+class MyFastQ(Mapping):
+    """
+    {seq_id: [seq, q_scores]}
+    sequences and q_scores of all reads are kept in contiguous uint8 buffers (with offsets), and converted on access
+    """
     maximum_q_score_allowed = 41
     def __init__(self, path=None):
-        super().__init__()
         self.path = path
-        if self.path is not None: # for deep copy
-            with open(self.path.as_posix(), "r") as f:
-                fastq_txt = f.readlines()
-            # check
-            self.N_seq, mod = divmod(len(fastq_txt), 4)
-            assert mod == 0
-            # register
-            for i in range(self.N_seq):
-                seq_id = fastq_txt[4 * i].strip()
-                seq = fastq_txt[4 * i + 1].strip()
-                p = fastq_txt[4 * i + 2].strip()
-                q_scores = [ord(q) - 33 for q in fastq_txt[4 * i + 3].strip()]
-                q_scores = [min(q, self.maximum_q_score_allowed) for q in q_scores]
-                assert p == "+"
-                assert len(seq) == len(q_scores)
-                self[seq_id] = [seq, q_scores]
-        else:
-            pass
+        self.seq_id_list = []
+        self.seq_id2idx = {}
+        self.seq_buffer = bytearray()
+        self.q_buffer = bytearray()
+        self.offsets = array("q", [0])
+        if self.path is not None:
+            for seq_id, seq, q in iter_fastq(self.path):
+                assert len(seq) == len(q)
+                self.add_read(seq_id.decode("utf-8"), seq, q)
+            # decode q_scores in bulk
+            q_array = np.frombuffer(self.q_buffer, dtype=np.uint8)
+            np.minimum(q_array - 33, self.maximum_q_score_allowed, out=q_array)
+            self.N_seq = len(self)
+    def add_read(self, seq_id, seq: bytes, q: bytes):
+        if seq_id in self.seq_id2idx:
+            raise Exception(f"duplicated seq_id: {seq_id}")
+        self.seq_id2idx[seq_id] = len(self.seq_id_list)
+        self.seq_id_list.append(seq_id)
+        self.seq_buffer += seq
+        self.q_buffer += q
+        self.offsets.append(len(self.seq_buffer))
+    def __len__(self):
+        return len(self.seq_id_list)
+    def __iter__(self):
+        return iter(self.seq_id_list)
+    def __contains__(self, k):
+        return k in self.seq_id2idx
+    def __setitem__(self, k, v):
+        seq, q_scores = v
+        self.add_read(k, seq.encode("ascii"), bytes(q_scores))
     @property
     def combined_name_stem(self):
         if isinstance(self.path, list):
@@ -59,12 +96,30 @@ class MyFastQ(OrderedDict):
         else:
             return self.path.stem
     def get_read_lengths(self):
-        return np.array([len(v[0]) for v in self.values()])
+        return np.diff(np.frombuffer(self.offsets, dtype=np.int64))
     def get_q_scores(self):
-        q_scores = []
-        for v in self.values():
-            q_scores.extend(v[1])
-        return np.array(q_scores)
+        return np.frombuffer(self.q_buffer, dtype=np.uint8).astype(int)
+    def get_q_score_histogram(self, read_group_array, N_groups, N_reads_per_chunk=10000):
+        """
+        counts of q_scores (0 to maximum_q_score_allowed) of reads in each group: array of shape (N_groups, maximum_q_score_allowed + 1)
+        read_group_array[idx] is the group of the idx-th read (reads with negative values are ignored)
+        """
+        N_q_scores = self.maximum_q_score_allowed + 1
+        q_score_histogram = np.zeros((N_groups, N_q_scores), dtype=np.int64)
+        read_lengths = self.get_read_lengths()
+        for chunk_start in range(0, len(self), N_reads_per_chunk):
+            chunk_end = min(chunk_start + N_reads_per_chunk, len(self))
+            q_array = np.frombuffer(self.q_buffer, dtype=np.uint8, count=self.offsets[chunk_end] - self.offsets[chunk_start], offset=self.offsets[chunk_start])
+            base_group_array = np.repeat(read_group_array[chunk_start:chunk_end], read_lengths[chunk_start:chunk_end])
+            is_valid = base_group_array >= 0
+            q_score_histogram += np.bincount(
+                base_group_array[is_valid] * N_q_scores + q_array[is_valid], minlength=q_score_histogram.size
+            ).reshape(q_score_histogram.shape)
+        return q_score_histogram
+    def get_seq(self, idx):
+        return self.seq_buffer[self.offsets[idx]:self.offsets[idx + 1]].decode("ascii")
+    def get_q_scores_array(self, idx):
+        return np.frombuffer(self.q_buffer, dtype=np.uint8, count=self.offsets[idx + 1] - self.offsets[idx], offset=self.offsets[idx])
     def get_new_seq_id(self, k):
         if k not in self.keys():
             return k
@@ -76,14 +131,15 @@ class MyFastQ(OrderedDict):
                 new_k = f"{k} {n}"
             return new_k
     def append(self, fastq):
-        for k, v in fastq.items():
+        for idx, k in enumerate(fastq.seq_id_list):
             new_k = self.get_new_seq_id(k)
-            self[new_k] = v
+            self.add_read(new_k, fastq.seq_buffer[fastq.offsets[idx]:fastq.offsets[idx + 1]], fastq.q_buffer[fastq.offsets[idx]:fastq.offsets[idx + 1]])
     def get_subset(self, keys):
         fastq_sub = MyFastQ()
         fastq_sub.path = self.path
         for k in keys:
-            fastq_sub[k] = self[k]
+            idx = self.seq_id2idx[k]
+            fastq_sub.add_read(k, self.seq_buffer[self.offsets[idx]:self.offsets[idx + 1]], self.q_buffer[self.offsets[idx]:self.offsets[idx + 1]])
         return fastq_sub
     @staticmethod
     def combine(fastq_list):
@@ -94,7 +150,13 @@ class MyFastQ(OrderedDict):
         return combined_fastq
     @property
     def my_hash(self):
-        return hashlib.sha256(self.to_string().encode("utf-8")).hexdigest()
+        # same as the hash of to_string(), without building the whole text
+        h = hashlib.sha256()
+        q_buffer_33 = (np.frombuffer(self.q_buffer, dtype=np.uint8) + 33).tobytes()
+        for idx, seq_id in enumerate(self.seq_id_list):
+            start, end = self.offsets[idx], self.offsets[idx + 1]
+            h.update(f"{seq_id}\n".encode("utf-8") + self.seq_buffer[start:end] + b"\n+\n" + q_buffer_33[start:end] + b"\n")
+        return h.hexdigest()
     def to_string(self):
         txt = ""
         for seq_id, (seq, q_scores) in self.items():
@@ -102,18 +164,14 @@ class MyFastQ(OrderedDict):
         return txt#.strip()
     def __getitem__(self, k):
         if not isinstance(k, slice):
-            return OrderedDict.__getitem__(self, k)
-        x = self.__class__()
+            idx = self.seq_id2idx[k]
+            return [self.get_seq(idx), self.get_q_scores_array(idx).tolist()]
         if k.start is None: start = 0
         else:               start = k.start
-        if k.stop is None: stop = len(self) - k.stop
+        if k.stop is None: stop = len(self)
         else:              stop = k.stop
         assert (0 <= start <= stop)
-        for idx, key in enumerate(self.keys()):
-            if start <= idx < stop:
-                x[key] = self[key]
-        x.path = self.path
-        return x
+        return self.get_subset(self.seq_id_list[start:stop])
 
 class MyRefSeq():
     def __init__(self, path: Path):
@@ -149,41 +207,210 @@ class MyRefSeq():
 
 # Definition of main classes
 class MyResult():
-    def __init__(self, parasail_result=None) -> None:
+    def __init__(self, parasail_result=None, traced=True) -> None:
         if parasail_result is not None:
-            self.cigar = parasail_result.cigar.decode.decode("ascii")
             self.score = parasail_result.score
-            self.beg_ref = parasail_result.cigar.beg_ref
-            self.beg_query = parasail_result.cigar.beg_query
             self.end_ref = parasail_result.end_ref
             self.end_query = parasail_result.end_query
-    def to_dict(self):
-        keys = ["cigar", "score", "beg_ref", "beg_query", "end_ref", "end_query"]
-        d = {}
-        for key in keys:
-            d[key] = getattr(self, key)
-        return d
-    def apply_dict_params(self, d):
-        for type_convert_key in ['score', 'beg_ref', 'beg_query', 'end_ref', 'end_query']:
-            setattr(self, type_convert_key, int(d[type_convert_key]))
+            if traced:
+                self.cigar = parasail_result.cigar.decode.decode("ascii")
+                self.beg_ref = parasail_result.cigar.beg_ref
+                self.beg_query = parasail_result.cigar.beg_query
+            else:   # score-only alignment (no traceback)
+                self.cigar = ""
+                self.beg_ref = -1
+                self.beg_query = -1
+    @property
+    def is_traced(self):
+        return len(self.cigar) > 0
+    @property
+    def is_aligned(self):   # False for placeholders (MyResult.not_aligned)
+        return self.end_ref >= 0
+    @classmethod
+    def not_aligned(cls):  # placeholder for candidates skipped by MinimizerIndex
+        self = cls()
+        self.cigar = ""
+        self.score = 0
+        self.beg_ref = -1
+        self.beg_query = -1
+        self.end_ref = -1
+        self.end_query = -1
+        return self
+
+MinimizerCandidate = namedtuple("MinimizerCandidate", ["result_idx", "N_anchors", "offset"])
+
+class MinimizerIndex():
+    """
+    (w, k)-minimizer index of the alignment targets to rank refseqs and strands for each read before Smith-Waterman.
+    "offset" of a candidate is the approximate position on the target where the 1st base of the (reverse complemented) read lies.
+    """
+    base2code = np.full(256, 4, dtype=np.uint8)
+    for code, b in enumerate("ACGT"):
+        base2code[ord(b)] = code
+        base2code[ord(b.lower())] = code
+    del code, b
+    def __init__(self, target_seq_list, period_list=None, k=15, w=10, max_occurrence=50, min_anchors=10, max_second_ratio=0.5):
+        self.k = k
+        self.w = w
+        self.max_occurrence = max_occurrence
+        self.min_anchors = min_anchors
+        self.max_second_ratio = max_second_ratio
+        self.N_targets = len(target_seq_list)
+        # period_list: refseq length for circular refseqs (targets are duplicated), None for linear refseqs
+        if period_list is None:
+            period_list = [None for i in target_seq_list]
+        self.period_list = period_list
+        hash_list = []
+        target_idx_list = []
+        pos_list = []
+        for target_idx, target_seq in enumerate(target_seq_list):
+            minimizer_hash, minimizer_pos = self.get_minimizers(target_seq)
+            hash_list.append(minimizer_hash)
+            target_idx_list.append(np.full(len(minimizer_hash), target_idx, dtype=np.int32))
+            pos_list.append(minimizer_pos)
+        hash_array = np.concatenate(hash_list)
+        order = np.argsort(hash_array, kind="stable")
+        self.hash_array = hash_array[order]
+        self.target_idx_array = np.concatenate(target_idx_list)[order]
+        self.pos_array = np.concatenate(pos_list)[order]
+    def get_minimizers(self, seq):
+        codes = self.base2code[np.frombuffer(seq.encode("ascii"), dtype=np.uint8)]
+        if len(codes) < self.k + self.w - 1:
+            return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int64)
+        kmers = np.lib.stride_tricks.sliding_window_view(codes, self.k)
+        is_valid = (kmers < 4).all(axis=1)
+        kmer_values = ((kmers & 3).astype(np.uint64) * (np.uint64(4) ** np.arange(self.k - 1, -1, -1, dtype=np.uint64))).sum(axis=1, dtype=np.uint64)
+        kmer_hash = self.hash64(kmer_values, np.uint64(4 ** self.k - 1))
+        kmer_hash[~is_valid] = np.iinfo(np.uint64).max
+        # minimum hash in each window of w consecutive k-mers
+        windows = np.lib.stride_tricks.sliding_window_view(kmer_hash, self.w)
+        minimizer_pos = np.unique(np.arange(len(windows)) + windows.argmin(axis=1))
+        minimizer_pos = minimizer_pos[is_valid[minimizer_pos]]
+        return kmer_hash[minimizer_pos], minimizer_pos
+    @staticmethod
+    def hash64(key, mask):   # invertible integer hash (same as minimap2)
+        with np.errstate(over="ignore"):
+            key = (~key + (key << np.uint64(21))) & mask
+            key = key ^ (key >> np.uint64(24))
+            key = (key + (key << np.uint64(3)) + (key << np.uint64(8))) & mask
+            key = key ^ (key >> np.uint64(14))
+            key = (key + (key << np.uint64(2)) + (key << np.uint64(4))) & mask
+            key = key ^ (key >> np.uint64(28))
+            key = (key + (key << np.uint64(31))) & mask
+        return key
+    def rank_candidates(self, query_seq, query_seq_rc=None):
+        if query_seq_rc is None:
+            query_seq_rc = str(Seq(query_seq).reverse_complement())
+        candidate_list = []
+        for is_reverse_compliment, seq in enumerate((query_seq, query_seq_rc)):
+            query_hash, query_pos = self.get_minimizers(seq)
+            left = np.searchsorted(self.hash_array, query_hash, side="left")
+            N_hits = np.searchsorted(self.hash_array, query_hash, side="right") - left
+            N_hits[N_hits > self.max_occurrence] = 0    # repetitive minimizers
+            query_hit_idx = np.repeat(np.arange(len(query_hash)), N_hits)
+            hit_idx = np.repeat(left - np.cumsum(N_hits) + N_hits, N_hits) + np.arange(N_hits.sum())
+            hit_target_idx = self.target_idx_array[hit_idx]
+            hit_query_pos = query_pos[query_hit_idx]
+            hit_diagonal = self.pos_array[hit_idx] - hit_query_pos
+            for target_idx in range(self.N_targets):
+                is_target = hit_target_idx == target_idx
+                N_anchors, offset = self.find_best_diagonal(hit_diagonal[is_target], hit_query_pos[is_target], self.period_list[target_idx], len(seq))
+                candidate_list.append(MinimizerCandidate(target_idx * 2 + is_reverse_compliment, N_anchors, offset))
+        candidate_list.sort(key=lambda candidate: candidate.N_anchors, reverse=True)
+        return candidate_list
+    @staticmethod
+    def find_best_diagonal(diagonal, query_pos, period, query_len):
+        if len(diagonal) == 0:
+            return 0, 0
+        # anchors are binned by diagonal; bins are wide enough to absorb indels of the read
+        bin_width = max(100, query_len // 10)
+        if period is not None:
+            diagonal = diagonal % period
+            N_bins = int(np.ceil(period / bin_width))
         else:
-            setattr(self, "cigar", d["cigar"])
+            diagonal = diagonal + query_len
+            N_bins = int(np.ceil((diagonal.max() + 1) / bin_width))
+        diagonal_bin = diagonal // bin_width
+        # count each query minimizer only once per bin (circular targets are duplicated)
+        unique_key = np.unique(query_pos * N_bins + diagonal_bin)
+        counts = np.bincount(unique_key % N_bins, minlength=N_bins)
+        if period is not None:
+            counts_with_neighbors = counts + np.roll(counts, 1) + np.roll(counts, -1)
+        else:
+            counts_with_neighbors = counts + np.pad(counts[:-1], (1, 0)) + np.pad(counts[1:], (0, 1))
+        best_bin = np.argmax(counts_with_neighbors)
+        # offset: median of the diagonals around the best bin
+        distance_from_best_bin = diagonal - (best_bin * bin_width + bin_width // 2)
+        if period is not None:
+            distance_from_best_bin = (distance_from_best_bin + period // 2) % period - period // 2
+        is_near = np.absolute(distance_from_best_bin) < bin_width * 1.5
+        offset = best_bin * bin_width + bin_width // 2 + int(np.median(distance_from_best_bin[is_near]))
+        if period is not None:
+            offset %= period
+        else:
+            offset -= query_len
+        return int(counts_with_neighbors[best_bin]), offset
+    def is_separated(self, candidate_list):
+        return (candidate_list[0].N_anchors >= self.min_anchors) and (candidate_list[1].N_anchors <= candidate_list[0].N_anchors * self.max_second_ratio)
+
+class MyQuery():
+    """
+    per-read context shared by all refseqs: reverse complement is calculated once, and striped profiles are created once per strand
+    """
+    def __init__(self, query_seq, my_custom_matrix) -> None:
+        self.seq_list = [query_seq, str(Seq(query_seq).reverse_complement())]    # [forward, reverse complement]
+        self.my_custom_matrix = my_custom_matrix
+        self.profile_dict = {}
+    def get_profile(self, is_reverse_compliment, bits):
+        key = (is_reverse_compliment, bits)
+        if key not in self.profile_dict:
+            if bits == 16:
+                self.profile_dict[key] = parasail.profile_create_16(self.seq_list[is_reverse_compliment], self.my_custom_matrix)
+            elif bits == 32:
+                self.profile_dict[key] = parasail.profile_create_32(self.seq_list[is_reverse_compliment], self.my_custom_matrix)
+            else:
+                raise Exception("error!")
+        return self.profile_dict[key]
 
 class MyAlignerBase():
-    def __init__(self, refseq_list, combined_fastq, param_dict):
+    # traceback is seeded by MinimizerIndex (see MyAligner.get_band_window)
+    use_seeded_trace = False
+    # margin of the refseq window around the read seeded by MinimizerIndex
+    band_margin_min = 100       # bases
+    band_margin_ratio = 0.1     # relative to read length
+    def __init__(self, refseq_list, combined_fastq, param_dict, max_workers=None, use_minimizer_triage=False, target_depth=None, depth_margin=0.1, subsampling_seed=0):
         # params
         self.param_dict = param_dict
         self.gap_open_penalty = param_dict["gap_open_penalty"]
         self.gap_extend_penalty = param_dict["gap_extend_penalty"]
         self.match_score = param_dict["match_score"]
         self.mismatch_score = param_dict["mismatch_score"]
+        # parallelization (None: use all cores, 1: serial execution)
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        self.max_workers = max_workers
+        # reads clearly assigned by MinimizerIndex are aligned only to the top candidate
+        self.use_minimizer_triage = use_minimizer_triage
+        self.minimizer_index = None
+        # adaptive subsampling (target_depth=None: all reads are aligned)
+        self.target_depth = target_depth
+        self.depth_margin = depth_margin
+        self.subsampling_seed = subsampling_seed
         # others
         self.refseq_list = refseq_list
         self.combined_fastq = combined_fastq
         self.is_refseq_seq_all_ATGC_list = None
+        self._my_custom_matrix = None
     @property
     def my_custom_matrix(self):
-        return parasail.matrix_create("ACGT", self.match_score, self.mismatch_score)
+        # created once per aligner (and per worker, as parasail matrices can not be pickled)
+        if self._my_custom_matrix is None:
+            self._my_custom_matrix = parasail.matrix_create("ACGT", self.match_score, self.mismatch_score)
+        return self._my_custom_matrix
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_my_custom_matrix"] = None
+        return state
     # refが環状プラスミドであるために、それを元に戻すのに使う（プラスミド上のどこがシーケンスの始まりと終わりなのか）を決めるのに使うカスタムのスコア
     def get_custom_cigar_score_dict(self):
         return {
@@ -215,10 +442,192 @@ class MyAlignerBase():
             else:
                 raise Exception(f"unknown letter code: {L}")
         return score
+    def set_minimizer_index(self):
+        if self.use_minimizer_triage or self.use_seeded_trace:
+            self.minimizer_index = MinimizerIndex(self.target_seq_list, period_list=self.target_period_list)
+        else:
+            self.minimizer_index = None
+    def align_single(self, query_seq, cached_result_list=None):
+        # cached_result_list: results found in AlignmentCache (None for the refseqs and strands to be aligned)
+        if cached_result_list is None:
+            cached_result_list = [None] * (len(self.target_seq_list) * 2)
+        query = MyQuery(query_seq, self.my_custom_matrix)
+        offset_list = [None] * len(cached_result_list)
+        if self.minimizer_index is not None:
+            candidate_list = self.minimizer_index.rank_candidates(query_seq, query.seq_list[1])
+            for candidate in candidate_list:
+                if candidate.N_anchors >= self.minimizer_index.min_anchors:
+                    offset_list[candidate.result_idx] = candidate.offset
+            # triage: reads whose top candidate is clearly separated are aligned only to that refseq and strand
+            if self.use_minimizer_triage and self.minimizer_index.is_separated(candidate_list):
+                result_list = [MyResult.not_aligned() for i in range(len(self.target_seq_list) * 2)]
+                result_idx = candidate_list[0].result_idx
+                cached_result = cached_result_list[result_idx]
+                if (cached_result is not None) and cached_result.is_traced:
+                    result_list[result_idx] = cached_result
+                else:
+                    result_list[result_idx] = self.align_trace(query, result_idx, offset=candidate_list[0].offset)
+                return result_list
+        # 1st step: score-only alignment (striped) of all refseqs and strands
+        result_list = []
+        for result_idx, cached_result in enumerate(cached_result_list):
+            if cached_result is not None:
+                result_list.append(cached_result)
+                continue
+            refseq_idx, is_reverse_compliment = divmod(result_idx, 2)
+            result_list.append(self.align_score_only(query, is_reverse_compliment, self.target_seq_list[refseq_idx]))
+        # 2nd step: traceback only for the best candidate (ties are also traced for the uniqueness check of the assignment)
+        normalized_score_list = self.normalize_score_list([result.score for result in result_list])
+        max_normalized_score = max(normalized_score_list)
+        for result_idx, normalized_score in enumerate(normalized_score_list):
+            if (normalized_score != max_normalized_score) or result_list[result_idx].is_traced:
+                continue
+            result = self.align_trace(query, result_idx, offset=offset_list[result_idx])
+            if result.score != result_list[result_idx].score:   # the seeded window missed a part of the alignment
+                result = self.align_trace(query, result_idx)
+            assert result.score == result_list[result_idx].score
+            result_list[result_idx] = result
+        return result_list
+    def align_trace(self, query, result_idx, offset=None):
+        # query: MyQuery or str
+        if not isinstance(query, MyQuery):
+            query = MyQuery(query, self.my_custom_matrix)
+        refseq_idx, is_reverse_compliment = divmod(result_idx, 2)
+        query_seq = query.seq_list[is_reverse_compliment]
+        target_seq = self.target_seq_list[refseq_idx]
+        # when seeded, only the window of the target (rotated to start near the read) is used for DP
+        if offset is None:
+            window_start, window_end = 0, len(target_seq)
+        else:
+            window_start, window_end = self.get_band_window(offset, len(query_seq), len(target_seq))
+        # なぜか result の cigar に、左端にたくさん D もしくは I が連なることがあるが、多分スコアはちゃんと計算されてる
+        result = MyResult(parasail.sw_trace(query_seq, target_seq[window_start:window_end], self.gap_open_penalty, self.gap_extend_penalty, self.my_custom_matrix))
+        # back to the coordinates of the target
+        result.beg_ref += window_start
+        result.end_ref += window_start
+        if offset is not None:
+            self.to_linear_coordinates(result, refseq_idx)
+        # 一応スコアを確認する
+        if self.is_refseq_seq_all_ATGC_list[refseq_idx]:
+            assert result.score == self.clac_cigar_score(result.cigar)
+        return result
+    def get_band_window(self, offset, query_len, target_len):
+        return 0, target_len    # no band for linear refseqs: reads of circular plasmids may be split at both ends
+    def to_linear_coordinates(self, result, refseq_idx):
+        pass
+    def align_score_only(self, query, is_reverse_compliment, target_seq):
+        result = parasail.sw_striped_profile_16(query.get_profile(is_reverse_compliment, 16), target_seq, self.gap_open_penalty, self.gap_extend_penalty)
+        if result.saturated:
+            result = parasail.sw_striped_profile_32(query.get_profile(is_reverse_compliment, 32), target_seq, self.gap_open_penalty, self.gap_extend_penalty)
+        return MyResult(result, traced=False)
+    def align_all(self, cached_result_dict=None):
+        # cached_result_dict: {seq_id: cached_result_list} obtained from AlignmentCache
+        if cached_result_dict is None:
+            cached_result_dict = {}
+        if self.target_depth is None:
+            return OrderedDict(self.iter_align(self.combined_fastq.seq_id_list, cached_result_dict))
+        # adaptive subsampling: reads are aligned in shuffled order until every refseq has enough assigned reads
+        if not isinstance(self.param_dict["score_threshold"], (int, float)):
+            raise Exception("score_threshold must be a number when target_depth is set (None or \"auto\" can not be used)")
+        shuffled_idx_array = np.random.default_rng(self.subsampling_seed).permutation(len(self.combined_fastq))
+        shuffled_seq_id_list = [self.combined_fastq.seq_id_list[i] for i in shuffled_idx_array]
+        N_required = int(np.ceil(self.target_depth * (1 + self.depth_margin)))
+        N_assigned_array = np.zeros(len(self.refseq_list), dtype=int)
+        aligned_result_dict = {}
+        for seq_id, result_list in self.iter_align(shuffled_seq_id_list, cached_result_dict):
+            aligned_result_dict[seq_id] = result_list
+            refseq_idx = self.assign_single(result_list, len(self.combined_fastq[seq_id][0]))
+            if refseq_idx is not None:
+                N_assigned_array[refseq_idx] += 1
+            if (N_assigned_array >= N_required).all():
+                print(f"\nalignment was stopped as all refseqs reached {N_required} assigned reads ({len(aligned_result_dict)} out of {len(self.combined_fastq)} reads)", end="")
+                break
+        # the order of combined_fastq is kept
+        return OrderedDict((seq_id, aligned_result_dict[seq_id]) for seq_id in self.combined_fastq.seq_id_list if seq_id in aligned_result_dict)
+    def iter_align(self, seq_id_list, cached_result_dict):
+        """
+        yields (seq_id, result_list) in the order of seq_id_list
+        in parallel, only a limited number of chunks are submitted in advance, so that the iteration can be stopped early
+        """
+        fastq_len = len(seq_id_list)
+        if (self.max_workers <= 1) or (fastq_len <= 1):
+            for query_idx, seq_id in enumerate(seq_id_list):
+                print(f"\rExecuting alignment: {query_idx + 1} out of {fastq_len} ({seq_id})", end="")
+                yield seq_id, self.align_single(self.combined_fastq[seq_id][0], cached_result_dict.get(seq_id, None))
+            return
+        # split reads into chunks, and align them in parallel (results are yielded in the original order)
+        chunk_size = max(1, min(int(np.ceil(fastq_len / (self.max_workers * 4))), 100))
+        chunk_list = [
+            [(seq_id, self.combined_fastq[seq_id][0], cached_result_dict.get(seq_id, None)) for seq_id in seq_id_list[i:i + chunk_size]]
+                for i in range(0, fastq_len, chunk_size)
+        ]
+        N_done = 0
+        with ProcessPoolExecutor(max_workers=self.max_workers, initializer=init_alignment_worker, initargs=(self.copy_for_worker(), )) as executor:
+            future_queue = deque()
+            try:
+                for chunk_idx in range(len(chunk_list)):
+                    while len(future_queue) < self.max_workers * 2 and chunk_idx + len(future_queue) < len(chunk_list):
+                        future_queue.append(executor.submit(align_chunk_in_worker, chunk_list[chunk_idx + len(future_queue)]))
+                    for seq_id, result_list in future_queue.popleft().result():
+                        N_done += 1
+                        yield seq_id, result_list
+                    print(f"\rExecuting alignment: {N_done} out of {fastq_len} ({self.max_workers} workers)", end="")
+            finally:
+                for future in future_queue:
+                    future.cancel()
+    def assign_single(self, result_list, query_len):
+        idx_array, assigned_array = self.assign(
+            np.array([[result.score for result in result_list]]), 
+            np.array([query_len]), 
+            self.param_dict["score_threshold"], 
+            np.array([[result.is_aligned for result in result_list]])
+        )
+        return int(idx_array[0]) // 2 if assigned_array[0] else None
+    def assign(self, score_array, query_length_array, score_threshold, is_aligned_array):
+        """
+        assignment rule shared by AlignmentResultBase.apply_threshold and the adaptive subsampling (assign_single)
+        score_array, is_aligned_array: (N_reads, N_refseqs * 2)
+        returns result_idx with the maximum (clipped) normalized score of each read, and whether the read is assigned to it
+        """
+        N_reads = len(score_array)
+        clipped_normalized_score_array = np.minimum(self.normalize_score_array(score_array), 1)
+        idx_array = np.argmax(clipped_normalized_score_array, axis=1)
+        refseq_idx_array = idx_array // 2
+        max_score_array = score_array[np.arange(N_reads), idx_array]
+        refseq_length_array = np.array([len(refseq.seq) for refseq in self.refseq_list])
+        # quality check
+        assigned_array = (clipped_normalized_score_array[np.arange(N_reads), idx_array] >= score_threshold)\
+                       & (max_score_array <= refseq_length_array[refseq_idx_array] * self.match_score)\
+                       & (query_length_array <= self.max_query_length_array[refseq_idx_array])\
+                       & is_aligned_array[np.arange(N_reads), idx_array]\
+                       & ((score_array == max_score_array[:, np.newaxis]).sum(axis=1) == 1)   # refseq の長さの二倍以上ある query_seq は omit する、全く同じスコアがある場合は omit する
+        return idx_array, assigned_array
+    @property
+    def subsampling_dict(self):
+        return {
+            "target_depth":self.target_depth, 
+            "depth_margin":self.depth_margin, 
+            "subsampling_seed":self.subsampling_seed
+        }
+    def copy_for_worker(self):
+        # reads are sent to workers chunk by chunk, so combined_fastq is not copied
+        my_aligner = copy.copy(self)
+        my_aligner.combined_fastq = None
+        return my_aligner
+
+# process pool workers for MyAlignerBase.align_all
+worker_aligner = None
+def init_alignment_worker(my_aligner):
+    global worker_aligner
+    worker_aligner = my_aligner
+
+def align_chunk_in_worker(chunk):
+    return [(seq_id, worker_aligner.align_single(query_seq, cached_result_list)) for seq_id, query_seq, cached_result_list in chunk]
 
 class MyAligner(MyAlignerBase):
-    def __init__(self, refseq_list, combined_fastq, param_dict) -> None:
-        super().__init__(refseq_list, combined_fastq, param_dict)
+    use_seeded_trace = True
+    def __init__(self, refseq_list, combined_fastq, param_dict, max_workers=None, use_minimizer_triage=False, target_depth=None, depth_margin=0.1, subsampling_seed=0) -> None:
+        super().__init__(refseq_list, combined_fastq, param_dict, max_workers, use_minimizer_triage, target_depth, depth_margin, subsampling_seed)
         self.duplicated_refseq_seq_list = None
         self.set_refseq_related_info()
     def set_refseq_related_info(self):
@@ -230,38 +639,47 @@ class MyAligner(MyAlignerBase):
             if not is_all_ATCG:
                 print(f"\033[38;2;255;0;0mWARNING: Non-ATCG letter(s) were found in '{refseq.path.name}'.\nWhen calculating the alignment score, they are treated as 'mismatched', no matter what characters they are.\033[0m")
             self.is_refseq_seq_all_ATGC_list.append(is_all_ATCG)
-    def align_all(self):
-        fastq_len = len(self.combined_fastq)
-        result_dict = OrderedDict()
-        for query_idx, (seq_id, (query_seq, q_scores)) in enumerate(list(self.combined_fastq.items())):
-            print(f"\rExecuting alignment: {query_idx + 1} out of {fastq_len} ({seq_id})", end="")
-            # calc scores for each refseq
-            result_list = []
-            for duplicated_refseq_seq, is_refseq_seq_all_ATGC in zip(self.duplicated_refseq_seq_list, self.is_refseq_seq_all_ATGC_list):
-                # なぜか result の cigar に、左端にたくさん D もしくは I が連なることがあるが、多分スコアはちゃんと計算されてる
-                result = parasail.sw_trace(query_seq, duplicated_refseq_seq, self.gap_open_penalty, self.gap_extend_penalty, self.my_custom_matrix)
-                result = MyResult(result)
-                result_rc = parasail.sw_trace(str(Seq(query_seq).reverse_complement()), duplicated_refseq_seq, self.gap_open_penalty, self.gap_extend_penalty, self.my_custom_matrix)
-                result_rc = MyResult(result_rc)
-                # 一応スコアを確認する
-                if is_refseq_seq_all_ATGC:
-                    assert result.score == self.clac_cigar_score(result.cigar)
-                    assert result_rc.score == self.clac_cigar_score(result_rc.cigar)
-                # レジスター
-                result_list.append(result)
-                result_list.append(result_rc)
-                gc.collect()
-            result_dict[seq_id] = result_list
-        return result_dict
+        self.set_minimizer_index()
+    @property
+    def target_seq_list(self):
+        return self.duplicated_refseq_seq_list
+    @property
+    def target_period_list(self):
+        return [len(refseq.seq) for refseq in self.refseq_list]
+    def get_band_window(self, offset, query_len, target_len):
+        """
+        the refseq rotated to start band_margin before the seeded read (0 <= offset < refseq length)
+        target[window_start:window_end] is the rotated refseq, as the target is the duplicated refseq
+        """
+        band_margin = max(self.band_margin_min, int(query_len * self.band_margin_ratio))
+        window_start = (offset - band_margin) % (target_len // 2)
+        if window_start + query_len + band_margin * 2 > target_len:
+            window_start = max(0, offset - band_margin)
+        window_end = min(window_start + query_len + band_margin * 2, target_len)
+        return window_start, window_end
+    def to_linear_coordinates(self, result, refseq_idx):
+        """
+        beg_ref of seeded results is moved to the 1st copy of the refseq (0 <= beg_ref < refseq length)
+        end_ref >= refseq length means that the read goes across the origin
+        """
+        period = len(self.refseq_list[refseq_idx].seq)
+        if result.beg_ref >= period:
+            result.beg_ref -= period
+            result.end_ref -= period
+    def normalize_score_list(self, score_list):
+        # same as AlignmentResultBase.normalize_scores
+        return [min(score / len(self.duplicated_refseq_seq_list[result_idx // 2]) * 2, 1) for result_idx, score in enumerate(score_list)]
+    def normalize_score_array(self, score_array):  # shape: (N_reads, N_refseqs * 2), not clipped
+        return score_array / np.repeat([len(duplicated_refseq_seq) for duplicated_refseq_seq in self.duplicated_refseq_seq_list], 2) * 2
+    @property
+    def max_query_length_array(self):  # query_seq longer than the duplicated refseq is omitted
+        return np.array([len(duplicated_refseq_seq) for duplicated_refseq_seq in self.duplicated_refseq_seq_list])
 
 class MyAlignerLinear(MyAlignerBase):
-    def __init__(self, refseq_list, combined_fastq, param_dict):
-        super().__init__(refseq_list, combined_fastq, param_dict)
+    def __init__(self, refseq_list, combined_fastq, param_dict, max_workers=None, use_minimizer_triage=False, target_depth=None, depth_margin=0.1, subsampling_seed=0):
+        super().__init__(refseq_list, combined_fastq, param_dict, max_workers, use_minimizer_triage, target_depth, depth_margin, subsampling_seed)
         self.refseq_seq_list = None
         self.set_refseq_related_info()
-    @property
-    def my_custom_matrix(self):
-        return parasail.matrix_create("ACGT", self.match_score, self.mismatch_score)
     def set_refseq_related_info(self):
         self.refseq_seq_list = []
         self.is_refseq_seq_all_ATGC_list = []
@@ -271,64 +689,177 @@ class MyAlignerLinear(MyAlignerBase):
             if not is_all_ATCG:
                 print(f"\033[38;2;255;0;0mWARNING: Non-ATCG letter(s) were found in '{refseq.path.name}'.\nWhen calculating the alignment score, they are treated as 'mismatched', no matter what characters they are.\033[0m")
             self.is_refseq_seq_all_ATGC_list.append(is_all_ATCG)
-    def align_all(self):
-        fastq_len = len(self.combined_fastq)
-        result_dict = OrderedDict()
-        for query_idx, (seq_id, (query_seq, q_scores)) in enumerate(list(self.combined_fastq.items())):
-            print(f"\rExecuting alignment: {query_idx + 1} out of {fastq_len} ({seq_id})", end="")
-            # calc scores for each refseq
-            result_list = []
-            for refseq_seq, is_refseq_seq_all_ATGC in zip(self.refseq_seq_list, self.is_refseq_seq_all_ATGC_list):
-                # なぜか result の cigar に、左端にたくさん D もしくは I が連なることがあるが、多分スコアはちゃんと計算されてる
-                result = parasail.sw_trace(query_seq, refseq_seq, self.gap_open_penalty, self.gap_extend_penalty, self.my_custom_matrix)
-                result = MyResult(result)
-                result_rc = parasail.sw_trace(str(Seq(query_seq).reverse_complement()), refseq_seq, self.gap_open_penalty, self.gap_extend_penalty, self.my_custom_matrix)
-                result_rc = MyResult(result_rc)
-                # 一応スコアを確認する
-                if is_refseq_seq_all_ATGC:
-                    assert result.score == self.clac_cigar_score(result.cigar)
-                    assert result_rc.score == self.clac_cigar_score(result_rc.cigar)
-                # レジスター
-                result_list.append(result)
-                result_list.append(result_rc)
-                gc.collect()
-            result_dict[seq_id] = result_list
-        return result_dict
-
-class MyCigarStr(str):
-    def __new__(cls, cigar_str):
-        # when common cigar strings are passed
-        if cigar_str[0].isdecimal():
-            val = "".join([
-                L for N, L in re.findall('(\d+)(\D)', cigar_str)
-                    for i in range(int(N))
-            ])
-            self = super().__new__(cls, val)
-            return self
-        # when "MyCigarStr" strings are passed
-        else:
-            self = super().__new__(cls, cigar_str)
-            return self
-    def __iadd__(self, other):
-        return self.__class__(self + other)
-    def invert(self):
-        return self.__class__(self[::-1])
+        self.set_minimizer_index()
+    @property
+    def target_seq_list(self):
+        return self.refseq_seq_list
+    @property
+    def target_period_list(self):
+        return None
+    def normalize_score_list(self, score_list):
+        # same as AlignmentResultBase.normalize_scores
+        return [min(score / len(self.refseq_seq_list[result_idx // 2]), 1) for result_idx, score in enumerate(score_list)]
+    def normalize_score_array(self, score_array):  # shape: (N_reads, N_refseqs * 2), not clipped
+        return score_array / np.repeat([len(refseq_seq) for refseq_seq in self.refseq_seq_list], 2)
+    @property
+    def max_query_length_array(self):  # query_seq longer than twice the refseq is omitted
+        return np.array([len(refseq_seq) * 2 for refseq_seq in self.refseq_seq_list])
+
+class MyCigar():
+    """
+    run-length encoded cigar with one letter per base ("=", "X", "I", "D", "S", "H", "N"): letters (uint8, e.g. ord("=")) and lengths (uint32) of runs
+    operations are done on runs, and letters are expanded (to_array) only when the pileup is built
+    """
+    def __init__(self, letter_array, length_array) -> None:
+        letter_array = np.asarray(letter_array, dtype=np.uint8)
+        length_array = np.asarray(length_array, dtype=np.uint32)
+        # empty runs are removed, and adjacent runs of the same letter are merged
+        is_not_empty = length_array > 0
+        letter_array = letter_array[is_not_empty]
+        length_array = length_array[is_not_empty]
+        is_new_run = np.append(True, letter_array[1:] != letter_array[:-1])[:len(letter_array)]
+        if not is_new_run.all():
+            run_idx = np.cumsum(is_new_run) - 1
+            length_array = np.bincount(run_idx, weights=length_array).astype(np.uint32)
+            letter_array = letter_array[is_new_run]
+        self.letter_array = letter_array
+        self.length_array = length_array
+    @classmethod
+    def from_cigar_str(cls, cigar_str):
+        N_L_list = re.findall(r"(\d+)(\D)", cigar_str)
+        if len(N_L_list) == 0:
+            return cls([], [])
+        N_list, L_list = zip(*N_L_list)
+        return cls(np.frombuffer("".join(L_list).encode("ascii"), dtype=np.uint8), np.array(N_list, dtype=np.uint32))
+    @classmethod
+    def from_letter(cls, letter, N):
+        return cls([ord(letter)], [N])
+    @classmethod
+    def concatenate(cls, my_cigar_list):
+        return cls(
+            np.concatenate([my_cigar.letter_array for my_cigar in my_cigar_list]), 
+            np.concatenate([my_cigar.length_array for my_cigar in my_cigar_list])
+        )
+    def __len__(self):
+        return int(self.length_array.sum())
+    def __str__(self):
+        return "".join(f"{N}{chr(L)}" for L, N in zip(self.letter_array.tolist(), self.length_array.tolist()))
+    def is_in(self, letters):
+        return np.isin(self.letter_array, np.frombuffer(letters.encode("ascii"), dtype=np.uint8))
+    def count(self, letters):
+        return int(self.length_array[self.is_in(letters)].sum())
+    def ref_length(self):
+        # "H" and "S" are also placed on the ref (see AlignmentResultBase.organize_read_alignment)
+        return len(self) - self.count("I")
+    def query_length(self):
+        return self.count("=XSI")
     def number_of_letters_on_5prime(self, letters):
-        for i, l in enumerate(self):
-            if l not in letters:
-                return i
+        is_in = self.is_in(letters)
+        N_runs = len(is_in) if is_in.all() else np.argmin(is_in)
+        return int(self.length_array[:N_runs].sum())
     def number_of_letters_on_3prime(self, letters):
-        for k, l in enumerate(self[::-1]):
-            if l not in letters:
-                return k
+        is_in = self.is_in(letters)[::-1]
+        N_runs = len(is_in) if is_in.all() else np.argmin(is_in)
+        return int(self.length_array[::-1][:N_runs].sum())
+    def get_runs_on_both_ends(self, letters):
+        # number of runs on 5' and 3' ends consisting of letters
+        is_in = self.is_in(letters)
+        if is_in.all():
+            return len(is_in), 0
+        return int(np.argmin(is_in)), int(np.argmin(is_in[::-1]))
     def clip_from_both_ends(self, letters):
-        i = self.number_of_letters_on_5prime(letters)
-        k = self.number_of_letters_on_3prime(letters)
-        return self.__class__(self[i:len(self) - k])
-    def clipped_len(self):
-        return len(self.clip())
+        N_runs_5prime, N_runs_3prime = self.get_runs_on_both_ends(letters)
+        return self.__class__(self.letter_array[N_runs_5prime:len(self.letter_array) - N_runs_3prime], self.length_array[N_runs_5prime:len(self.length_array) - N_runs_3prime])
+    def replace_both_ends(self, letters, new_letter):
+        N_runs_5prime, N_runs_3prime = self.get_runs_on_both_ends(letters)
+        letter_array = self.letter_array.copy()
+        letter_array[:N_runs_5prime] = ord(new_letter)
+        letter_array[len(letter_array) - N_runs_3prime:] = ord(new_letter)
+        return self.__class__(letter_array, self.length_array)
+    def trim_5prime(self, N):
+        cumsum_length = np.cumsum(self.length_array, dtype=np.int64)
+        N_runs = np.searchsorted(cumsum_length, N, side="right")
+        length_array = self.length_array[N_runs:].copy()
+        if len(length_array) > 0:
+            length_array[0] = cumsum_length[N_runs] - N
+        return self.__class__(self.letter_array[N_runs:], length_array)
+    def get_insertions(self):
+        """
+        ref_idx: index of the ref base after each insertion (number of non-"I" letters before it)
+        """
+        is_I = self.letter_array == ord("I")
+        N_non_I = np.where(is_I, 0, self.length_array).astype(np.int64)
+        ref_idx = np.cumsum(N_non_I) - N_non_I
+        return ref_idx[is_I], self.length_array[is_I].astype(np.int64)
+    def to_array(self):
+        return np.repeat(self.letter_array, self.length_array)
+
+def load_npz_as_memmap(npz_path):
+    """
+    np.load ignores mmap_mode for .npz, so the arrays stored (not compressed) in the archive are memory-mapped directly
+    """
+    array_dict = {}
+    with zipfile.ZipFile(npz_path) as z, open(npz_path, "rb") as f:
+        for info in z.infolist():
+            assert info.compress_type == zipfile.ZIP_STORED
+            # local file header (30 bytes) is followed by file name and extra field
+            f.seek(info.header_offset + 26)
+            file_name_len, extra_field_len = np.frombuffer(f.read(4), dtype="<u2")
+            f.seek(info.header_offset + 30 + int(file_name_len) + int(extra_field_len))
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            key = info.filename[:-len(".npy")]
+            if np.prod(shape) == 0:   # np.memmap does not accept empty arrays
+                array_dict[key] = np.zeros(shape, dtype=dtype)
+            else:
+                array_dict[key] = np.memmap(npz_path, dtype=dtype, mode="r", offset=f.tell(), shape=shape, order="F" if fortran_order else "C")
+    return array_dict
+
+class IntermediateResultDict(Mapping):
+    """
+    read-only {fastq_id: [MyResult, ...]} view of the columns of IntermediateResults
+    MyResult objects are built on access, so that the columns can stay memory-mapped
+    """
+    def __init__(self, combined_fastq_id_list, columns) -> None:
+        self.combined_fastq_id_list = combined_fastq_id_list
+        self.fastq_id2idx = {fastq_id: fastq_idx for fastq_idx, fastq_id in enumerate(combined_fastq_id_list)}
+        self.columns = columns
+    def __getitem__(self, fastq_id):
+        return self.get_result_list(self.fastq_id2idx[fastq_id])
+    def __iter__(self):
+        return iter(self.combined_fastq_id_list)
+    def __len__(self):
+        return len(self.combined_fastq_id_list)
+    @property
+    def score_array(self):  # shape: (N_reads, N_refseqs * 2)
+        return self.columns["score"]
+    @property
+    def is_aligned_array(self):  # False for placeholders (MyResult.not_aligned)
+        return self.columns["end_ref"] >= 0
+    def get_result_list(self, fastq_idx):
+        values_list = zip(*[self.columns[key][fastq_idx].tolist() for key in IntermediateResults.column_keys])
+        cigar_offsets = self.columns["cigar_offsets"]
+        N_results = self.score_array.shape[1]
+        result_list = []
+        for result_idx, values in enumerate(values_list):
+            my_result = MyResult()
+            for key, v in zip(IntermediateResults.column_keys, values):
+                setattr(my_result, key, v)
+            i = fastq_idx * N_results + result_idx
+            my_result.cigar = IntermediateResults.decode_cigar(self.columns["cigar_ops"][cigar_offsets[i]:cigar_offsets[i + 1]])
+            result_list.append(my_result)
+        return result_list
 
 class IntermediateResults(mc.MyTextFormat):
+    """
+    metadata are kept in MyTextFormat, and MyResult of all reads are kept as typed columns in a single .npz file
+    """
+    column_keys = ["score", "beg_ref", "beg_query", "end_ref", "end_query"]
+    param_dict_keys_matter = ['gap_open_penalty', 'gap_extend_penalty', 'match_score', 'mismatch_score']
+    cigar_op_letters = "MIDNSHP=X"  # same order as BAM
     def __init__(self, result_dict=None, my_aligner=None) -> None:
         self.path = None
         self.keys = [
@@ -337,11 +868,12 @@ class IntermediateResults(mc.MyTextFormat):
             ("combined_fastq_names", "list"), 
             ("combined_fastq_hash", "str"), 
             ("param_dict", "dict"), 
+            ("subsampling_dict", "dict"), 
             ("combined_fastq_id_list", "list")
         ]
-        self.non_default_keys_start_idx = 6
-        self.param_dict_keys_matter = ['gap_open_penalty', 'gap_extend_penalty', 'match_score', 'mismatch_score']
         self.combined_fastq_id_list = []
+        self.subsampling_dict = {"target_depth":None}    # files without subsampling_dict are results of all reads
+        self.columns = {}
         if (my_aligner is not None) and (result_dict is not None):
             # my aligner related info
             self.refseq_names = [refseq.path.name for refseq in my_aligner.refseq_list]
@@ -349,19 +881,33 @@ class IntermediateResults(mc.MyTextFormat):
             self.combined_fastq_names = [fastq_path.name for fastq_path in my_aligner.combined_fastq.path]
             self.combined_fastq_hash = my_aligner.combined_fastq.my_hash
             self.param_dict = my_aligner.param_dict
+            self.subsampling_dict = dict(my_aligner.subsampling_dict, N_aligned_reads=len(result_dict), N_reads=len(my_aligner.combined_fastq))
             # result_dict related info
-            assert len(result_dict) == len(my_aligner.combined_fastq)
-            assert result_dict.keys() == my_aligner.combined_fastq.keys()
-            idx = 0
-            for combined_fastq_id, result_list in result_dict.items():
-                self.combined_fastq_id_list.append(combined_fastq_id)
-                for result in result_list:
-                    result_key = f"result{idx}"
-                    setattr(self, result_key, result.to_dict())
-                    self.keys.append((result_key, "dict"))
-                    idx += 1
-            assert len(self.combined_fastq_id_list) == len(my_aligner.combined_fastq)
-            assert len(my_aligner.combined_fastq) * len(my_aligner.refseq_list) * 2 == idx # リバコン(rc) もあるので二倍で assertion
+            if my_aligner.target_depth is None:
+                assert len(result_dict) == len(my_aligner.combined_fastq)
+                assert result_dict.keys() == my_aligner.combined_fastq.keys()
+            else:
+                assert all(seq_id in my_aligner.combined_fastq.seq_id2idx for seq_id in result_dict.keys())
+            self.combined_fastq_id_list = list(result_dict.keys())
+            result_list_list = list(result_dict.values())
+            N_results = len(my_aligner.refseq_list) * 2 # リバコン(rc) もあるので二倍
+            assert all(len(result_list) == N_results for result_list in result_list_list)
+            for key in self.column_keys:
+                self.columns[key] = np.array(
+                    [[getattr(result, key) for result in result_list] for result_list in result_list_list], dtype=np.int32
+                ).reshape(len(result_list_list), N_results)
+            cigar_ops_list = [self.encode_cigar(result.cigar) for result_list in result_list_list for result in result_list]
+            cigar_offsets = np.zeros(len(cigar_ops_list) + 1, dtype=np.int64)
+            np.cumsum([len(cigar_ops) for cigar_ops in cigar_ops_list], out=cigar_offsets[1:])
+            self.columns["cigar_offsets"] = cigar_offsets
+            self.columns["cigar_ops"] = np.concatenate(cigar_ops_list + [np.zeros(0, dtype=np.uint32)])
+    @classmethod
+    def encode_cigar(cls, cigar):
+        # run-length encoded (BAM style): length << 4 | op
+        return np.array([int(N) << 4 | cls.cigar_op_letters.index(L) for N, L in re.findall(r"(\d+)(\D)", cigar)], dtype=np.uint32)
+    @classmethod
+    def decode_cigar(cls, cigar_ops):
+        return "".join(f"{op >> 4}{cls.cigar_op_letters[op & 0xf]}" for op in cigar_ops.tolist())
     def assert_identity(self, my_aligner):
         refseq_names = [refseq.path.name for refseq in my_aligner.refseq_list]
         refseq_hash_list = [refseq.my_hash for refseq in my_aligner.refseq_list]
@@ -369,24 +915,38 @@ class IntermediateResults(mc.MyTextFormat):
         combined_fastq_hash = my_aligner.combined_fastq.my_hash
         param_dict = my_aligner.param_dict
         is_param_dict_same = all(param_dict[k] == self.param_dict[k] for k in self.param_dict_keys_matter)
+        is_subsampling_same = self.is_subsampling_same(my_aligner)
         if (self.refseq_names == refseq_names) and\
             (self.refseq_hash_list == refseq_hash_list) and\
             (self.combined_fastq_names == combined_fastq_names) and\
-            (self.combined_fastq_hash == combined_fastq_hash) and is_param_dict_same:
+            (self.combined_fastq_hash == combined_fastq_hash) and is_param_dict_same and is_subsampling_same:
             return True
         elif (set(self.refseq_names) == set(refseq_names)) and\
             (set(self.refseq_hash_list) == set(refseq_hash_list)) and\
             (self.combined_fastq_names == combined_fastq_names) and\
-            (self.combined_fastq_hash == combined_fastq_hash) and is_param_dict_same:
+            (self.combined_fastq_hash == combined_fastq_hash) and is_param_dict_same and is_subsampling_same:
             # intermediat_resultsに応じて順番を並べ直す
             my_aligner.refseq_list = [my_aligner.refseq_list[refseq_hash_list.index(refseq_hash)] for refseq_hash in self.refseq_hash_list]
             my_aligner.set_refseq_related_info()
             return True
         else:
             return False
+    def is_subsampling_same(self, my_aligner):
+        # values are str after loading
+        if (str(self.subsampling_dict["target_depth"]) == "None") and (my_aligner.target_depth is None):
+            return True
+        return all(str(self.subsampling_dict.get(k, None)) == str(v) for k, v in my_aligner.subsampling_dict.items())
+    def save(self, save_path):
+        # stored without compression so that the columns can be memory-mapped on load
+        meta = np.frombuffer(self.to_text().encode("utf-8"), dtype=np.uint8)
+        with open(save_path, "wb") as f:
+            np.savez(f, meta=meta, **self.columns)
     def load(self, load_path):
         self.path = load_path
-        self.keys = super().load(load_path)
+        self.columns = load_npz_as_memmap(load_path)
+        meta = self.columns.pop("meta")
+        with io.StringIO(meta.tobytes().decode("utf-8")) as f:
+            self.keys = super().load(f)
         for k, v in self.param_dict.items():
             try:
                 self.param_dict[k] = int(v)
@@ -394,26 +954,134 @@ class IntermediateResults(mc.MyTextFormat):
                 self.param_dict[k] = float(v)
     @property
     def result_dict(self):
-        result_dict = OrderedDict()
-        result_list = []
-        refseq_idx = 0
-        refseq_idx_max = len(self.refseq_names) * 2
-        fastq_idx = 0
-        for key, data_type in self.keys[self.non_default_keys_start_idx:]:
-            assert data_type == "dict"
-            my_result = MyResult()
-            my_result.apply_dict_params(getattr(self, key))
-            result_list.append(my_result)
-            refseq_idx += 1
-            if refseq_idx == refseq_idx_max:
-                fastq_id = self.combined_fastq_id_list[fastq_idx]
-                result_dict[fastq_id] = result_list
-                refseq_idx = 0
-                fastq_idx += 1
-                result_list = []
-        assert refseq_idx == 0
-        assert fastq_idx == len(self.combined_fastq_id_list)
-        return result_dict
+        return IntermediateResultDict(self.combined_fastq_id_list, self.columns)
+
+class AlignmentCache():
+    """
+    content-addressed cache of MyResult shared across runs: {cache_dir}/{param_hash}/{refseq_hash}/{shard}.npz
+    each row of a shard is keyed by (sha256 of the read sequence, strand), so that only new reads or refseqs are aligned
+    placeholders of MinimizerIndex triage are not cached, as they depend on the other refseqs
+    """
+    def __init__(self, cache_dir, my_aligner) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.my_aligner = my_aligner
+    @property
+    def param_hash(self):
+        # circular and linear aligners use different targets, and seeded alignment (triage) can give different traces
+        param_list = [self.my_aligner.__class__.__name__, self.my_aligner.use_minimizer_triage] + [self.my_aligner.param_dict[k] for k in IntermediateResults.param_dict_keys_matter]
+        return hashlib.sha256("\t".join(map(str, param_list)).encode("utf-8")).hexdigest()
+    def refseq_dir(self, refseq):
+        return self.cache_dir / self.param_hash / refseq.my_hash
+    @staticmethod
+    def read_hash(query_seq):
+        return hashlib.sha256(query_seq.encode("utf-8")).hexdigest()
+    def load(self, combined_fastq):
+        """
+        returns {seq_id: cached_result_list} of reads that have at least one cached result
+        rows of the reads are selected by np.isin, and MyResult is built only for them
+        """
+        read_hash_list = [self.read_hash(query_seq) for query_seq, q_scores in combined_fastq.values()]
+        read_hash_array = np.array(read_hash_list, dtype="S64")
+        N_results = len(self.my_aligner.refseq_list) * 2
+        cached_dict = defaultdict(lambda: [None] * N_results)   # {read_hash: cached_result_list}
+        for refseq_idx, refseq in enumerate(self.my_aligner.refseq_list):
+            for shard_path in sorted(self.refseq_dir(refseq).glob("*.npz")):
+                columns = load_npz_as_memmap(shard_path)
+                row_idx_array = np.where(np.isin(columns["read_hash"], read_hash_array))[0]
+                cigar_offsets = columns["cigar_offsets"]
+                values_list = zip(*[columns[key][row_idx_array].tolist() for key in ["read_hash", "strand"] + IntermediateResults.column_keys])
+                for row_idx, (read_hash, strand, *values) in zip(row_idx_array.tolist(), values_list):
+                    read_hash = read_hash.decode("ascii")
+                    result_idx = refseq_idx * 2 + strand
+                    cached_result = cached_dict[read_hash][result_idx]
+                    if (cached_result is not None) and cached_result.is_traced:
+                        continue
+                    my_result = MyResult()
+                    for key, v in zip(IntermediateResults.column_keys, values):
+                        setattr(my_result, key, v)
+                    my_result.cigar = IntermediateResults.decode_cigar(columns["cigar_ops"][cigar_offsets[row_idx]:cigar_offsets[row_idx + 1]])
+                    cached_dict[read_hash][result_idx] = my_result
+        cached_result_dict = OrderedDict()
+        for seq_id, read_hash in zip(combined_fastq.keys(), read_hash_list):
+            if read_hash in cached_dict:
+                cached_result_dict[seq_id] = cached_dict[read_hash]
+        return cached_result_dict
+    def save(self, result_dict, cached_result_dict):
+        """
+        results that were not in the cache (or were cached without traceback) are merged with the existing shards of each refseq,
+        so that each refseq_dir keeps a single shard with one row per (read_hash, strand)
+        """
+        shard_name = f"{datetime.now().strftime('%Y%m%d%H%M%S%f')}_{os.getpid()}.npz"
+        N_results = len(self.my_aligner.refseq_list) * 2
+        read_hash_dict = {seq_id: self.read_hash(query_seq) for seq_id, (query_seq, q_scores) in self.my_aligner.combined_fastq.items()}
+        for refseq_idx, refseq in enumerate(self.my_aligner.refseq_list):
+            row_dict = OrderedDict()    # {(read_hash, strand): MyResult}
+            for seq_id, result_list in result_dict.items():
+                cached_result_list = cached_result_dict.get(seq_id, [None] * N_results)
+                for strand in (0, 1):
+                    result_idx = refseq_idx * 2 + strand
+                    result = result_list[result_idx]
+                    cached_result = cached_result_list[result_idx]
+                    if not result.is_aligned:
+                        continue
+                    if (cached_result is not None) and (cached_result.is_traced or not result.is_traced):
+                        continue
+                    row_dict[(read_hash_dict[seq_id], strand)] = result
+            refseq_dir = self.refseq_dir(refseq)
+            shard_path_list = sorted(refseq_dir.glob("*.npz"))
+            if (len(row_dict) == 0) and (len(shard_path_list) <= 1):
+                continue
+            columns_list = [self.results_to_columns(row_dict)] if len(row_dict) > 0 else []
+            for shard_path in shard_path_list:
+                with np.load(shard_path) as npz:
+                    columns_list.append({key: npz[key] for key in npz.files})
+            columns = self.merge_columns(columns_list)
+            refseq_dir.mkdir(parents=True, exist_ok=True)
+            # written under a temporary name so that a partially written shard is never loaded
+            tmp_path = refseq_dir / (shard_name + ".tmp")
+            with open(tmp_path, "wb") as f:
+                np.savez(f, **columns)
+            os.replace(tmp_path, refseq_dir / shard_name)
+            # merged shards (shards added by other runs in the meantime are merged next time)
+            for shard_path in shard_path_list:
+                shard_path.unlink()
+    @staticmethod
+    def results_to_columns(row_dict):
+        columns = {
+            "read_hash":np.array([read_hash for read_hash, strand in row_dict.keys()], dtype="S64"), 
+            "strand":np.array([strand for read_hash, strand in row_dict.keys()], dtype=np.uint8)
+        }
+        for key in IntermediateResults.column_keys:
+            columns[key] = np.array([getattr(result, key) for result in row_dict.values()], dtype=np.int32)
+        cigar_ops_list = [IntermediateResults.encode_cigar(result.cigar) for result in row_dict.values()]
+        cigar_offsets = np.zeros(len(cigar_ops_list) + 1, dtype=np.int64)
+        np.cumsum([len(cigar_ops) for cigar_ops in cigar_ops_list], out=cigar_offsets[1:])
+        columns["cigar_offsets"] = cigar_offsets
+        columns["cigar_ops"] = np.concatenate(cigar_ops_list)
+        return columns
+    @staticmethod
+    def merge_columns(columns_list):
+        """
+        one row per (read_hash, strand): traced rows are preferred, then the earlier columns in columns_list
+        """
+        row_keys = ["read_hash", "strand"] + IntermediateResults.column_keys
+        merged = {key: np.concatenate([columns[key] for columns in columns_list]) for key in row_keys}
+        cigar_length = np.concatenate([np.diff(columns["cigar_offsets"]) for columns in columns_list])
+        cigar_start = np.concatenate([columns["cigar_offsets"][:-1] + offset for columns, offset in zip(
+            columns_list, np.cumsum([0] + [len(columns["cigar_ops"]) for columns in columns_list[:-1]])
+        )])
+        cigar_ops = np.concatenate([columns["cigar_ops"] for columns in columns_list])
+        # stable sort by (read_hash, strand, not traced), and the 1st row of each (read_hash, strand) is kept
+        order = np.lexsort((cigar_length == 0, merged["strand"], merged["read_hash"]))
+        is_first = np.ones(len(order), dtype=bool)
+        is_first[1:] = (merged["read_hash"][order][1:] != merged["read_hash"][order][:-1]) | (merged["strand"][order][1:] != merged["strand"][order][:-1])
+        selected = order[is_first]
+        columns = {key: merged[key][selected] for key in row_keys}
+        cigar_offsets = np.zeros(len(selected) + 1, dtype=np.int64)
+        np.cumsum(cigar_length[selected], out=cigar_offsets[1:])
+        columns["cigar_offsets"] = cigar_offsets
+        columns["cigar_ops"] = cigar_ops[np.repeat(cigar_start[selected] - cigar_offsets[:-1], cigar_length[selected]) + np.arange(cigar_offsets[-1])]
+        return columns
 
 def save_intermediate_results(result_dict, my_aligner, intermediate_results_save_path):
     ir = IntermediateResults(result_dict=result_dict, my_aligner=my_aligner)
@@ -447,18 +1115,22 @@ def organize_files(fastq_file_path_list, refseq_file_path_list):
 
 #@title # 2. Execute alignment
 
-def execute_alignment(refseq_list, combined_fastq, param_dict, save_dir):
-    my_aligner = MyAligner(refseq_list, combined_fastq, param_dict)
-    return execute_alignment_core(my_aligner, combined_fastq, save_dir)
+def execute_alignment(refseq_list, combined_fastq, param_dict, save_dir, max_workers=None, use_minimizer_triage=False, cache_dir=None, target_depth=None, depth_margin=0.1, subsampling_seed=0):
+    """
+    target_depth: reads are aligned in shuffled order until every refseq has target_depth * (1 + depth_margin) assigned reads (None: all reads are aligned)
+        reads are assigned during the alignment with param_dict["score_threshold"], so it must be a number (None or "auto" can not be used with target_depth)
+    """
+    my_aligner = MyAligner(refseq_list, combined_fastq, param_dict, max_workers=max_workers, use_minimizer_triage=use_minimizer_triage, target_depth=target_depth, depth_margin=depth_margin, subsampling_seed=subsampling_seed)
+    return execute_alignment_core(my_aligner, combined_fastq, save_dir, cache_dir)
 
-def execute_alignment_linear(refseq_list, combined_fastq, param_dict, save_dir):
-    my_aligner = MyAlignerLinear(refseq_list, combined_fastq, param_dict)
-    return execute_alignment_core(my_aligner, combined_fastq, save_dir)
+def execute_alignment_linear(refseq_list, combined_fastq, param_dict, save_dir, max_workers=None, use_minimizer_triage=False, cache_dir=None, target_depth=None, depth_margin=0.1, subsampling_seed=0):
+    my_aligner = MyAlignerLinear(refseq_list, combined_fastq, param_dict, max_workers=max_workers, use_minimizer_triage=use_minimizer_triage, target_depth=target_depth, depth_margin=depth_margin, subsampling_seed=subsampling_seed)
+    return execute_alignment_core(my_aligner, combined_fastq, save_dir, cache_dir)
 
-def execute_alignment_core(my_aligner,combined_fastq, save_dir):
+def execute_alignment_core(my_aligner,combined_fastq, save_dir, cache_dir=None):
     # load if there is intermediate data
     skip = False
-    intermediate_results_save_path = save_dir / f"{combined_fastq.combined_name_stem}.intermediate_results.txt"
+    intermediate_results_save_path = save_dir / f"{combined_fastq.combined_name_stem}.intermediate_results.npz"
     if intermediate_results_save_path.exists():
         intermediate_results = IntermediateResults()
         intermediate_results.load(intermediate_results_save_path)
@@ -468,25 +1140,170 @@ def execute_alignment_core(my_aligner,combined_fastq, save_dir):
             print("alignment: SKIPPED (exported intermediate was used)")
             skip = True
     if not skip:
+        # reuse per-read results of previous runs (cache_dir=None: no cache)
+        if cache_dir is not None:
+            alignment_cache = AlignmentCache(cache_dir, my_aligner)
+            cached_result_dict = alignment_cache.load(combined_fastq)
+            print(f"alignment cache: {len(cached_result_dict)} out of {len(combined_fastq)} reads found")
+        else:
+            cached_result_dict = None
         # Execute
-        result_dict = my_aligner.align_all()
+        result_dict = my_aligner.align_all(cached_result_dict)
         print()
         print("alignment: DONE")
+        if cache_dir is not None:
+            alignment_cache.save(result_dict, cached_result_dict)
         intermediate_results = save_intermediate_results(result_dict, my_aligner, intermediate_results_save_path)
 
     return result_dict, my_aligner, intermediate_results
 
+def align_single_baseline(my_aligner, query_seq):
+    """
+    the alignment loop before optimization (for benchmark_align_single): the matrix and the reverse complement are created for each refseq,
+    and traceback (sw_trace) is calculated for every refseq and strand
+    """
+    result_list = []
+    for target_seq, is_refseq_seq_all_ATGC in zip(my_aligner.target_seq_list, my_aligner.is_refseq_seq_all_ATGC_list):
+        my_custom_matrix = parasail.matrix_create("ACGT", my_aligner.match_score, my_aligner.mismatch_score)
+        result = MyResult(parasail.sw_trace(query_seq, target_seq, my_aligner.gap_open_penalty, my_aligner.gap_extend_penalty, my_custom_matrix))
+        result_rc = MyResult(parasail.sw_trace(str(Seq(query_seq).reverse_complement()), target_seq, my_aligner.gap_open_penalty, my_aligner.gap_extend_penalty, my_custom_matrix))
+        if is_refseq_seq_all_ATGC:
+            assert result.score == my_aligner.clac_cigar_score(result.cigar)
+            assert result_rc.score == my_aligner.clac_cigar_score(result_rc.cigar)
+        result_list.append(result)
+        result_list.append(result_rc)
+    return result_list
+
+def benchmark_align_single(my_aligner, N_reads=100, baseline=False):
+    """
+    micro-benchmark of the alignment hot loop: per-read latency (ms) of align_single, serial and without cache
+    baseline=True: align_single_baseline is timed instead, so that before/after can be compared on the same reads
+    """
+    seq_id_list = my_aligner.combined_fastq.seq_id_list[:N_reads]
+    latency_list = []
+    for seq_id in seq_id_list:
+        query_seq = my_aligner.combined_fastq[seq_id][0]
+        t0 = time.perf_counter()
+        if baseline:
+            align_single_baseline(my_aligner, query_seq)
+        else:
+            my_aligner.align_single(query_seq)
+        latency_list.append((time.perf_counter() - t0) * 1000)
+    latency_array = np.array(latency_list)
+    label = "align_single_baseline" if baseline else "align_single"
+    print(f"{label}: {latency_array.mean():.2f} ms/read (median {np.median(latency_array):.2f} ms, {len(latency_array)} reads, {len(my_aligner.refseq_list)} refseqs)")
+    return latency_array
+
 #@title # 3. Set threshold for assignment
 
 class AlignmentResultBase():
+    read_chunk_size = 256   # reads scattered to the MSA at a time
+    coverage_profile_ops = ["match", "omitted", "mismatch", "insertion", "deletion"]
+    coverage_profile_letters = ["=", "NHS", "X", "I", "D"]
     def __init__(self, result_dict, my_aligner, param_dict):
         self.score_threshold = param_dict["score_threshold"]
         self.result_dict = result_dict
         self.my_aligner = my_aligner
         # attributs to register results
+        self.score_array = None
+        self.is_aligned_array = None
+        self.normalized_score_array = None
+        self.expected_false_assignment_rate = None
         self.score_list_ALL = None
         self.result_info_assigned = None
         self.aligned_result_list = None
+    def normalize_scores(self):
+        """
+        score_array: (N_reads, N_refseqs * 2) scores, in the order of result_dict
+        is_aligned_array: False for candidates skipped by MinimizerIndex (their score 0 is a placeholder)
+        does not depend on score_threshold, so that it is calculated only once
+        """
+        assert len(self.result_dict) <= len(self.my_aligner.combined_fastq)   # reads may be subsampled
+        if hasattr(self.result_dict, "score_array"):
+            self.score_array = np.asarray(self.result_dict.score_array, dtype=np.int32)
+            self.is_aligned_array = np.asarray(self.result_dict.is_aligned_array)
+        else:
+            self.score_array = np.array([[result.score for result in result_list] for result_list in self.result_dict.values()], dtype=np.int32).reshape(len(self.result_dict), -1)
+            self.is_aligned_array = np.array([[result.is_aligned for result in result_list] for result_list in self.result_dict.values()], dtype=bool).reshape(self.score_array.shape)
+        assert self.score_array.shape[1] == len(self.my_aligner.refseq_list) * 2
+        self.normalized_score_array = self.my_aligner.normalize_score_array(self.score_array)
+    def apply_threshold(self):
+        if self.normalized_score_array is None:
+            self.normalize_scores()
+        seq_id_list = list(self.result_dict.keys())
+        N_reads = len(seq_id_list)
+        combined_fastq = self.my_aligner.combined_fastq
+        if seq_id_list == combined_fastq.seq_id_list:
+            query_idx_array = np.arange(N_reads)
+        else:
+            query_idx_array = np.array([combined_fastq.seq_id2idx[seq_id] for seq_id in seq_id_list], dtype=int)
+        query_length_array = combined_fastq.get_read_lengths()[query_idx_array]
+        # choose sequence with maximum score, and check the quality
+        idx_array, assigned_array = self.my_aligner.assign(self.score_array, query_length_array, self.score_threshold, self.is_aligned_array)
+        refseq_idx_array, is_reverse_compliment_array = np.divmod(idx_array, 2)
+        is_clipped_array = self.normalized_score_array > 1
+        # register
+        score_list_list = self.score_array.tolist()
+        normalized_score_list_list = self.normalized_score_array.tolist()
+        for i in np.where(is_clipped_array.any(axis=1))[0]:
+            normalized_score_list_list[i] = [1 if v > 1 else v for v in normalized_score_list_list[i]]
+        for i, j in zip(*np.where(~self.is_aligned_array)):   # not aligned: nan instead of the placeholder score
+            score_list_list[i][j] = normalized_score_list_list[i][j] = float("nan")
+        self.score_list_ALL = [{
+            "query_idx":query_idx, 
+            "seq_id":seq_id, 
+            "score_list":score_list, 
+            "normalized_score_list":normalized_score_list, 
+            "assigned_refseq_idx":refseq_idx, 
+            "is_reverse_compliment":is_reverse_compliment, 
+            "assigned":assigned
+        } for query_idx, seq_id, score_list, normalized_score_list, refseq_idx, is_reverse_compliment, assigned in zip(
+            query_idx_array.tolist(), seq_id_list, score_list_list, normalized_score_list_list, refseq_idx_array.tolist(), is_reverse_compliment_array.tolist(), assigned_array.astype(int).tolist()
+        )]
+        self.result_info_assigned = [[] for i in self.my_aligner.refseq_list] # [[[seq_id, is_reverse_compliment, result, query_idx], ...], ...]
+        for i in np.where(assigned_array)[0].tolist():
+            seq_id = seq_id_list[i]
+            self.result_info_assigned[refseq_idx_array[i]].append([
+                seq_id, 
+                int(is_reverse_compliment_array[i]), 
+                self.result_dict[seq_id][idx_array[i]], 
+                int(query_idx_array[i])
+            ])
+    def estimate_score_threshold(self, N_bins=100):
+        """
+        Otsu's method on the histogram of the maximum normalized score of each read
+        expected false assignment rate: fraction of reads in the lower class (fitted by a gaussian) that exceed the threshold, among the reads above the threshold
+        """
+        if self.normalized_score_array is None:
+            self.normalize_scores()
+        max_normalized_score_array = np.minimum(self.normalized_score_array, 1).max(axis=1)
+        if len(max_normalized_score_array) == 0 or max_normalized_score_array.min() == max_normalized_score_array.max():
+            return (max_normalized_score_array.min() if len(max_normalized_score_array) > 0 else 0), 0.
+        hist, bin_edges = np.histogram(max_normalized_score_array, bins=N_bins, range=(0, 1))
+        bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2
+        w0 = np.cumsum(hist)[:-1]
+        w1 = len(max_normalized_score_array) - w0
+        m0 = np.cumsum(hist * bin_centers)[:-1]
+        m1 = (hist * bin_centers).sum() - m0
+        with np.errstate(divide="ignore", invalid="ignore"):
+            between_class_variance = np.where((w0 > 0) & (w1 > 0), w0 * w1 * (m0 / w0 - m1 / w1) ** 2, 0)
+        score_threshold = bin_edges[np.argmax(between_class_variance) + 1]
+        # false assignment
+        lower_score_array = max_normalized_score_array[max_normalized_score_array < score_threshold]
+        N_above = (max_normalized_score_array >= score_threshold).sum()
+        if len(lower_score_array) < 2 or lower_score_array.std() == 0:
+            expected_false_assignment_rate = 0.
+        else:
+            N_false = len(lower_score_array) * norm.sf(score_threshold, loc=lower_score_array.mean(), scale=lower_score_array.std())
+            expected_false_assignment_rate = N_false / max(N_above, 1)
+        return float(score_threshold), float(expected_false_assignment_rate)
+    def normalize_scores_and_apply_threshold(self):
+        self.normalize_scores()
+        # score_threshold = None or "auto"
+        if self.score_threshold is None or self.score_threshold == "auto":
+            self.score_threshold, self.expected_false_assignment_rate = self.estimate_score_threshold()
+            print(f"score_threshold was automatically set to {self.score_threshold:.3f} (expected false assignment rate: {self.expected_false_assignment_rate:.2e})")
+        self.apply_threshold()
     def get_score_summary_df(self):
         records = []
         for info in self.score_list_ALL:
@@ -534,6 +1351,9 @@ class AlignmentResultBase():
         text_list = []
         save_path_list = []
         for refseq, aligned_result in zip(self.my_aligner.refseq_list, self.aligned_result_list):
+            if "my_cigar_matrix" not in aligned_result:
+                print(f"\nSkipped exporting the alignment of {refseq.path.name}: per-read alignments were not kept (integrate_assigned_result_info(keep_reads=True) is required)")
+                continue
             text = ""
             idx_label_minimum = "consensus"
             query_idx_list = aligned_result["query_idx_list"]
@@ -562,14 +1382,7 @@ class AlignmentResultBase():
                 + " " * (label_N0 - 9 + label_N1)
                 + "".join([chr(q) for q in (np.array(consensus_q_scores_all) + 33)])
             )
-            for query_idx, seq_id, my_cigar_str_with_insertion, new_seq_with_insertion, new_q_scores_with_insertion in \
-                zip(
-                    aligned_result["query_idx_list"], 
-                    aligned_result["seq_id_list"], 
-                    aligned_result["my_cigar_str_list_with_insertion"], 
-                    aligned_result["new_seq_list_with_insertion"], 
-                    aligned_result["new_q_scores_list_with_insertion"]
-                ):
+            for query_idx, seq_id, my_cigar_str_with_insertion, new_seq_with_insertion, new_q_scores_with_insertion in self.iter_aligned_reads(aligned_result):
                 label = (
                     "\n"
                     + str(query_idx)
@@ -583,7 +1396,7 @@ class AlignmentResultBase():
                     + label
                     + my_cigar_str_with_insertion
                     + label
-                    + "".join([chr(q) for q in (np.array(new_q_scores_with_insertion) + 33)])
+                    + (new_q_scores_with_insertion + 33).astype(np.uint8).tobytes().decode("ascii")
                 )
             save_path = (save_dir / refseq.path.name).with_suffix(".txt")
             with open(save_path, "w") as f:
@@ -596,13 +1409,15 @@ class AlignmentResultBase():
         highlight_pos_list = []
         refseq_name_list = []
         for refseq, aligned_result in zip(self.my_aligner.refseq_list, self.aligned_result_list):
+            if "my_cigar_matrix" not in aligned_result:
+                raise Exception(f"per-read alignments of {refseq.path.name} were not kept (integrate_assigned_result_info(keep_reads=True) is required)")
             ref_label = "REF"
             label_N = max(len(str(max(aligned_result["query_idx_list"]))), len(ref_label)) + 1
             refseq_name_list.append(refseq.path.name)
             # "linewidth" 行ごとにまとめて改行
             child_lines = re.findall(fr".{{1,{linewidth}}}", aligned_result["refseq_with_insertion"].upper())
             master_lines = [list(map(lambda l: ref_label + " " * (label_N - len(ref_label)) + l, child_lines))]
-            for idx, (new_seq_with_insertion, query_idx) in enumerate(zip(aligned_result["new_seq_list_with_insertion"], aligned_result["query_idx_list"])):
+            for query_idx, seq_id, my_cigar_str_with_insertion, new_seq_with_insertion, new_q_scores_with_insertion in self.iter_aligned_reads(aligned_result):
                 child_lines = re.findall(fr".{{1,{linewidth}}}", new_seq_with_insertion.upper())
                 master_lines.append(list(map(lambda l: f"{query_idx}" + " " * (label_N - len(str(query_idx))) + l, child_lines)))
             # 改行したものを zip でくっつけていく
@@ -616,7 +1431,7 @@ class AlignmentResultBase():
             text_list.append(text.strip())
             # ハイライト部分
             highlight_pos_in_text = []
-            for i, my_cigar_str_with_insertion in enumerate(aligned_result["my_cigar_str_list_with_insertion"]):
+            for i, (query_idx, seq_id, my_cigar_str_with_insertion, new_seq_with_insertion, new_q_scores_with_insertion) in enumerate(self.iter_aligned_reads(aligned_result)):
                 # print(len(my_cigar_str_with_insertion))
                 true_highlight_pos = [m.start() for m in re.finditer('[IXDS]', my_cigar_str_with_insertion)]
                 for p in true_highlight_pos:
@@ -657,6 +1472,186 @@ class AlignmentResultBase():
                 f.write(consensus_fastq_txt)
             save_path_list.append(save_path1)
         return save_path_list
+    @staticmethod
+    def organize_read_alignment(result, seq, q_scores, target_length):
+        """
+        returns my_cigar (MyCigar over the whole target), and seq and q_scores trimmed accordingly
+                    beg_ref(9)      end_ref(24)
+                         |                |
+        pos     0         10         20         30
+        ref     atcgatcggGGCTATG-CTTGCAT-GCatcgatcg
+        align   HHHHHHHSS====X==I===D===N==SSSHHHHH
+        query          caGGCTGTGACTT-CAT-GCtga
+        pos            0         10          20
+                         |                |
+                    beg_query(2)    end_query(17)
+        """
+        my_cigar = MyCigar.from_cigar_str(result.cigar)
+        # organize alignment based on refseq
+        number_of_ref_bases_before_query = result.beg_ref - result.beg_query
+        number_of_ref_bases_after_query = (target_length - result.end_ref - 1) - (len(seq) - result.end_query - 1)
+        beg_query = result.beg_query
+        end_query = result.end_query
+        # truncate
+        assert (number_of_ref_bases_before_query >= 0) or (number_of_ref_bases_after_query >= 0)
+        if (number_of_ref_bases_before_query < 0):
+            q_scores = q_scores[-number_of_ref_bases_before_query:]
+            seq      = seq[-number_of_ref_bases_before_query:]
+            beg_query += number_of_ref_bases_before_query
+            end_query += number_of_ref_bases_before_query
+            number_of_ref_bases_before_query = 0
+        if (number_of_ref_bases_after_query < 0):
+            q_scores = q_scores[:number_of_ref_bases_after_query]
+            seq      = seq[:number_of_ref_bases_after_query]
+            number_of_ref_bases_after_query = 0
+        assert (number_of_ref_bases_before_query >= 0) & (number_of_ref_bases_after_query >= 0)
+        # organize my_cigar
+        my_cigar = MyCigar.concatenate([
+            MyCigar.from_letter("H", number_of_ref_bases_before_query),   # add deletion of ref
+            MyCigar.from_letter("S", beg_query),                          # soft clip of query
+            my_cigar,                                                     # aligned region
+            MyCigar.from_letter("S", len(seq) - end_query - 1),           # soft clip of query
+            MyCigar.from_letter("H", number_of_ref_bases_after_query)     # add deletion of ref
+        ])
+        # なぜか parasail の結果で両端に D が連なっている場合があるので、H とする（本来 beg_ref で調節されるべき？）
+        my_cigar = my_cigar.replace_both_ends("HD", "H")
+        my_cigar_H_clip = my_cigar.clip_from_both_ends("H")
+        assert len(q_scores) == len(seq) == len(my_cigar_H_clip) - my_cigar_H_clip.count("D")
+        assert target_length == my_cigar.ref_length()
+        # なぜか parasail の結果で 5'側に I が連なっている場合があるので、それを除く（本来 beg_query で調節されるべき？）
+        number_of_I_on_5prime = my_cigar.number_of_letters_on_5prime("I")
+        if number_of_I_on_5prime > 0:
+            my_cigar = my_cigar.trim_5prime(number_of_I_on_5prime)
+            q_scores = q_scores[number_of_I_on_5prime:]
+            seq = seq[number_of_I_on_5prime:]
+        return my_cigar, seq, q_scores
+    def iter_aligned_read_chunks(self, result_info_list, target_length):
+        """
+        yields lists of (my_cigar, seq, q_scores) (see organize_read_alignment) for every read_chunk_size reads,
+        so that reads are organized from result_info_list only when they are scattered (only a chunk of reads is in memory at a time)
+        """
+        combined_fastq = self.my_aligner.combined_fastq
+        for chunk_start in range(0, len(result_info_list), self.read_chunk_size):
+            aligned_read_chunk = []
+            for seq_id, is_reverse_compliment, result, query_idx in result_info_list[chunk_start:chunk_start + self.read_chunk_size]:
+                # query info
+                seq = combined_fastq[seq_id][0]
+                q_scores = combined_fastq.get_q_scores_array(combined_fastq.seq_id2idx[seq_id])
+                if is_reverse_compliment:
+                    seq = str(Seq(seq).reverse_complement())
+                    q_scores = q_scores[::-1]
+                seq = np.frombuffer(seq.encode("ascii"), dtype=np.uint8)
+                aligned_read_chunk.append(self.organize_read_alignment(result, seq, q_scores, target_length))
+            yield aligned_read_chunk
+    @staticmethod
+    def get_ref_idx_and_insertion_rank(my_cigar):
+        """
+        ref_idx: index of the ref base of each letter (for "I", index of the next ref base)
+        insertion_rank: position of each "I" in the insertion before the ref base
+        """
+        is_I = my_cigar == ord("I")
+        ref_idx = np.cumsum(~is_I)
+        ref_idx[~is_I] -= 1
+        pos = np.arange(len(my_cigar))
+        last_ref_pos = np.maximum.accumulate(np.where(is_I, -1, pos))
+        insertion_rank = pos - last_ref_pos - 1
+        return is_I, ref_idx, insertion_rank
+    def get_insertion_width(self, result_info_list, target_length):
+        """
+        width of the insertion columns before each ref base (the last one is after the last ref base), i.e. the maximum among reads
+        """
+        insertion_width = np.zeros(target_length + 1, dtype=int)
+        for aligned_read_chunk in self.iter_aligned_read_chunks(result_info_list, target_length):
+            for my_cigar, seq, q_scores in aligned_read_chunk:
+                ref_idx, insertion_length = my_cigar.get_insertions()
+                np.maximum.at(insertion_width, ref_idx, insertion_length)
+        return insertion_width
+    def scatter_aligned_reads(self, aligned_read_list, ref_column, insertion_column, N_columns):
+        """
+        ref_column[r]: column of the r-th ref base (-1: not placed)
+        insertion_column[r]: 1st column of the insertion before the r-th ref base (-1: dropped)
+        columns without any letter are filled with "N" (my_cigar), "-" (seq) and -1 (q_scores)
+        """
+        N_reads = len(aligned_read_list)
+        my_cigar_matrix = np.full((N_reads, N_columns), ord("N"), dtype=np.uint8)
+        seq_matrix = np.full((N_reads, N_columns), ord("-"), dtype=np.uint8)
+        q_score_matrix = np.full((N_reads, N_columns), -1, dtype=np.int16)
+        query_letters = np.frombuffer(b"=XSI", dtype=np.uint8)
+        for i, (my_cigar, seq, q_scores) in enumerate(aligned_read_list):
+            my_cigar = my_cigar.to_array()
+            is_I, ref_idx, insertion_rank = self.get_ref_idx_and_insertion_rank(my_cigar)
+            columns = np.where(is_I, insertion_column[ref_idx] + insertion_rank, ref_column[np.minimum(ref_idx, len(ref_column) - 1)])
+            is_placed = np.where(is_I, insertion_column[ref_idx] >= 0, ref_column[np.minimum(ref_idx, len(ref_column) - 1)] >= 0)
+            is_query = np.isin(my_cigar, query_letters)
+            query_idx = np.cumsum(is_query) - 1
+            assert query_idx[-1] + 1 == len(seq)
+            my_cigar_matrix[i, columns[is_placed]] = my_cigar[is_placed]
+            is_placed &= is_query
+            seq_matrix[i, columns[is_placed]] = seq[query_idx[is_placed]]
+            q_score_matrix[i, columns[is_placed]] = q_scores[query_idx[is_placed]]
+        return my_cigar_matrix, seq_matrix, q_score_matrix
+    def aligned_result_from_chunks(self, refseq_with_insertion, query_idx_list, seq_id_list, chunk_matrices_iter, keep_reads=True):
+        """
+        (my_cigar_matrix, seq_matrix, q_score_matrix) of each chunk of reads are added to PileupCounts one by one
+        per-read data are kept only if keep_reads (otherwise memory does not depend on the number of reads, and alignments can not be exported as text)
+        """
+        pileup_counts = PileupCounts(len(refseq_with_insertion))
+        chunk_matrices_list = []
+        for chunk_matrices in chunk_matrices_iter:
+            pileup_counts.add(*chunk_matrices)
+            if keep_reads:
+                chunk_matrices_list.append(chunk_matrices)
+        if keep_reads:
+            aligned_result = self.aligned_result_from_matrices(
+                refseq_with_insertion, 
+                query_idx_list, 
+                seq_id_list, 
+                *[np.concatenate(matrix_list) for matrix_list in zip(*chunk_matrices_list)]
+            )
+        else:
+            aligned_result = {
+                "refseq_with_insertion": refseq_with_insertion, 
+                "query_idx_list": query_idx_list, 
+                "seq_id_list": seq_id_list
+            }
+        aligned_result["pileup_counts"] = pileup_counts
+        return aligned_result
+    @staticmethod
+    def aligned_result_from_matrices(refseq_with_insertion, query_idx_list, seq_id_list, my_cigar_matrix, seq_matrix, q_score_matrix):
+        # (reads x columns) arrays: strings of each read are built by iter_aligned_reads when exported
+        return {
+            "refseq_with_insertion": refseq_with_insertion, 
+            "query_idx_list": query_idx_list, 
+            "seq_id_list": seq_id_list, 
+            "my_cigar_matrix": my_cigar_matrix, 
+            "seq_matrix": seq_matrix, 
+            "q_score_matrix": q_score_matrix
+        }
+    @staticmethod
+    def iter_aligned_reads(aligned_result):
+        """
+        yields (query_idx, seq_id, my_cigar_str_with_insertion, new_seq_with_insertion, new_q_scores_with_insertion) of each read
+        new_q_scores_with_insertion is an int16 array (-1 for the columns without bases)
+        """
+        for query_idx, seq_id, my_cigar_array, seq_array, q_score_array in zip(
+            aligned_result["query_idx_list"], 
+            aligned_result["seq_id_list"], 
+            aligned_result["my_cigar_matrix"], 
+            aligned_result["seq_matrix"], 
+            aligned_result["q_score_matrix"]
+        ):
+            yield query_idx, seq_id, my_cigar_array.tobytes().decode("ascii"), seq_array.tobytes().decode("ascii"), q_score_array
+    def coverage_profile(self, refseq_idx):
+        """
+        number of reads for each op in coverage_profile_ops (rows) at each column of refseq_with_insertion
+        returns a new int array of shape (ops, columns)
+        """
+        aligned_result = self.aligned_result_list[refseq_idx]
+        if "pileup_counts" in aligned_result:
+            pileup_counts = aligned_result["pileup_counts"]
+        else:
+            pileup_counts = PileupCounts.from_aligned_result(aligned_result)
+        return pileup_counts.get_N_array(self.coverage_profile_letters)
     def alignment_summary_bar_graphs(self):
         N_array_list = []
         bar_graph_img_list = []
@@ -665,631 +1660,148 @@ class AlignmentResultBase():
             filename_for_saving_list.append(f"{self.my_aligner.refseq_list[refseq_idx].path.stem}.gif")
             # prepare
             refseq_with_insertion = aligned_result["refseq_with_insertion"]
-            N_array = np.empty((5, len(refseq_with_insertion)), int)
-            tick_pos_list = []
-            tick_label_list = []
-            cur_ref_base_pos = 0
-            for refbase_idx, refbase in enumerate(refseq_with_insertion):
-
-                if refbase != "-":
-                    cur_ref_base_pos += 1
-                    if cur_ref_base_pos%100 == 0:
-                        tick_pos_list.append(refbase_idx)
-                        tick_label_list.append(cur_ref_base_pos)
-
-                N_match = 0     # =
-                N_mismatch = 0  # X
-                N_insertion = 0 # I
-                N_deletion = 0  # D
-                N_omitted = 0   # N, H, S
-                for my_cigar_str in aligned_result["my_cigar_str_list_with_insertion"]:
-                    L = my_cigar_str[refbase_idx]
-                    if L == "=":    N_match += 1
-                    elif L == "X":  N_mismatch += 1
-                    elif L == "I":  N_insertion += 1
-                    elif L == "D":  N_deletion += 1
-                    elif L in "NHS":    N_omitted += 1
-                    else:   raise Exception(f"unknown cigar string {L}")
-                N_array[:, refbase_idx] = [N_match, N_omitted, N_mismatch, N_insertion, N_deletion]
+            N_array = self.coverage_profile(refseq_idx)
+            # ticks every 100 bases of refseq
+            is_refbase = np.frombuffer(refseq_with_insertion.encode("ascii"), dtype=np.uint8) != ord("-")
+            ref_base_pos_array = np.cumsum(is_refbase)
+            tick_pos_array = np.where(is_refbase & (ref_base_pos_array % 100 == 0))[0]
+            tick_pos_list = tick_pos_array.tolist()
+            tick_label_list = ref_base_pos_array[tick_pos_array].tolist()
             N_array_list.append(N_array)
             # 描画していく！
             bar_graph_img = BarGraphImg(N_array, tick_pos_list, tick_label_list)
             bar_graph_img.generate_bar_graph_ndarray()
-            bar_graph_img.set_legend(legend_list=["match", "omitted", "mismatch", "insertion", "deletion"])
+            bar_graph_img.set_legend(legend_list=self.coverage_profile_ops)
             bar_graph_img_list.append(bar_graph_img)
         return bar_graph_img_list, filename_for_saving_list
 
 class AlignmentResult(AlignmentResultBase):
-    def normalize_scores_and_apply_threshold(self):
-        self.score_list_ALL = []
-        self.result_info_assigned = [[] for i in self.my_aligner.refseq_list] # [[[seq_id, is_reverse_compliment, result, query_idx], ...], ...]
-        assert len(self.result_dict) == len(self.my_aligner.combined_fastq)
-        for query_idx, (seq_id, result_list) in enumerate(self.result_dict.items()):
-            assert len(result_list) == len(self.my_aligner.duplicated_refseq_seq_list) * 2
-            # normalize scores for each refseq
-            score_list = []
-            normalized_score_list = []
-            for result_idx, result in enumerate(result_list):
-                score_list.append(result.score)
-                duplicated_refseq_seq = self.my_aligner.duplicated_refseq_seq_list[result_idx // 2]
-                normalized_score = result.score / len(duplicated_refseq_seq) * 2
-                if normalized_score > 1:
-                    normalized_score = 1
-                normalized_score_list.append(normalized_score)
-            # choose sequence with maximum score
-            idx = np.argmax(normalized_score_list)
-            refseq_idx, is_reverse_compliment = divmod(idx, 2)
-            result = result_list[idx]
-            # quality check
-            assigned = (normalized_score_list[idx] >= self.score_threshold)\
-                     & (result.score <= len(self.my_aligner.refseq_list[refseq_idx].seq) * self.my_aligner.match_score)\
-                     & (len(self.my_aligner.combined_fastq[seq_id][0]) <= len(self.my_aligner.duplicated_refseq_seq_list[refseq_idx]))\
-                     & ((np.array(score_list) == score_list[idx]).sum() == 1)   # refseq の長さの二倍以上ある query_seq は omit する、全く同じスコアがある場合は omit する
-            # register
-            self.score_list_ALL.append({
-                "query_idx":query_idx, 
-                "seq_id":seq_id, 
-                "score_list":score_list, 
-                "normalized_score_list":normalized_score_list, 
-                "assigned_refseq_idx":refseq_idx, 
-                "is_reverse_compliment":is_reverse_compliment, 
-                "assigned":int(assigned)
-            })
-            if assigned:
-                self.result_info_assigned[refseq_idx].append([
-                    seq_id, 
-                    is_reverse_compliment, 
-                    result, 
-                    query_idx
-                ])
-    def integrate_assigned_result_info(self):
+    def integrate_assigned_result_info(self, keep_reads=True):
+        """
+        reads are aligned to the duplicated refseq (1st half: 0 to L-1, 2nd half: L to 2L-1)
+        both halves are put on the same columns (insertion width is the maximum of both halves, and the insertion at the junction is dropped),
+        and each read switches from the 2nd half to the 1st half:
+            reads within one period (e.g. seeded reads, see MyAligner.get_band_window): at the origin, i.e. each base is placed at its aligned position
+            longer reads: where the custom cigar score is maximized (only these reads are merged)
+        reads are organized and scattered chunk by chunk (see iter_aligned_read_chunks), after the insertion width is obtained in the 1st pass
+        keep_reads=False: only PileupCounts are kept to save memory, and alignments are not exported as text (see aligned_result_from_chunks)
+        """
         self.aligned_result_list = []
         assert len(self.my_aligner.refseq_list) == len(self.result_info_assigned)
         total_N = len(self.my_aligner.refseq_list)
+        custom_cigar_score_array = np.zeros(256, dtype=int)
+        for L, score in self.my_aligner.get_custom_cigar_score_dict().items():
+            custom_cigar_score_array[ord(L)] = score
         for cur_idx, (refseq, result_info_list) in enumerate(zip(self.my_aligner.refseq_list, self.result_info_assigned)):
             print(f"\rIntegrating alignment results: {cur_idx + 1} out of {total_N}", end="")
             if len(result_info_list) > 0:
-                my_cigar_str_list = []
-                new_q_scores_list = []
-                new_seq_list = []
                 seq_id_list, is_reverse_compliment_list, result_list, query_idx_list = list(zip(*result_info_list))
-                for result, is_reverse_compliment, seq_id in zip(result_list, is_reverse_compliment_list, seq_id_list):
-                    # query info
-                    seq = self.my_aligner.combined_fastq[seq_id][0]
-                    q_scores = self.my_aligner.combined_fastq[seq_id][1]
-                    if is_reverse_compliment:
-                        seq = str(Seq(seq).reverse_complement())
-                        q_scores = q_scores[::-1]
-                    # results
-                    my_cigar_str = MyCigarStr(result.cigar)
-                    # organize alignment based on refseq
-                    number_of_ref_bases_before_query = result.beg_ref - result.beg_query
-                    number_of_ref_bases_after_query = (refseq.length * 2 - result.end_ref - 1) - (len(seq) - result.end_query - 1)
-                    """
-                                beg_ref(9)      end_ref(24)
-                                     |                |
-                    pos     0         10         20         30
-                    ref     atcgatcggGGCTATG-CTTGCAT-GCatcgatcg
-                    align   HHHHHHHSS====X==I===D===N==SSSHHHHH
-                    query          caGGCTGTGACTT-CAT-GCtga
-                    pos            0         10          20
-                                     |                |         
-                                beg_query(2)    end_query(17)
-                    """
-                    # truncate
-                    assert (number_of_ref_bases_before_query >= 0) or (number_of_ref_bases_after_query >= 0)
-                    if (number_of_ref_bases_before_query < 0):
-                        q_scores = q_scores[-number_of_ref_bases_before_query:]
-                        seq      = seq[-number_of_ref_bases_before_query:]
-                        beg_query = result.beg_query + number_of_ref_bases_before_query
-                        end_query = result.end_query + number_of_ref_bases_before_query
-                        number_of_ref_bases_before_query = 0
-                    else:
-                        beg_query = result.beg_query
-                        end_query = result.end_query
-                    if (number_of_ref_bases_after_query < 0):
-                        q_scores = q_scores[:number_of_ref_bases_after_query]
-                        seq      = seq[:number_of_ref_bases_after_query]
-                        # result.beg_query # do nothing
-                        # result.end_query # do nothing
-                        number_of_ref_bases_after_query = 0
-                    assert (number_of_ref_bases_before_query >= 0) & (number_of_ref_bases_after_query >= 0)
-                    # organize my_cigar_str
-                    my_cigar_str = MyCigarStr(
-                        "H" * number_of_ref_bases_before_query      # add deletion of ref
-                        + "S" * beg_query                           # soft clip of query
-                        + my_cigar_str                              # aligned region
-                        + "S" * (len(seq) - end_query - 1)          # soft clip of query
-                        + "H" * number_of_ref_bases_after_query     # add deletion of ref
-                    )
-                    my_cigar_str = MyCigarStr(
-                        "H" * my_cigar_str.number_of_letters_on_5prime("HD")    # なぜか parasail の結果で 5'側に D が連なっている場合があるので、それを除く（本来 beg_ref で調節されるべき？）
-                        + my_cigar_str.clip_from_both_ends("HD")
-                        + "H" * my_cigar_str.number_of_letters_on_3prime("HD")
-                    )
-                    my_cigar_str_H_clip = my_cigar_str.clip_from_both_ends("H")
-                    assert len(q_scores) == len(seq) == len(my_cigar_str_H_clip) - my_cigar_str_H_clip.count("D")
-                    assert refseq.length * 2 == len(my_cigar_str) - my_cigar_str_H_clip.count("I")
-
-                    # なぜか parasail の結果で 5'側に I が連なっている場合があるので、それを除く（本来 beg_query で調節されるべき？）
-                    number_of_I_on_5prime = my_cigar_str.number_of_letters_on_5prime("I")
-                    if number_of_I_on_5prime > 0:
-                        my_cigar_str = MyCigarStr(my_cigar_str[number_of_I_on_5prime:])
-                        q_scores = q_scores[number_of_I_on_5prime:]
-                        seq = seq[number_of_I_on_5prime:]
-                    my_cigar_str_list.append(my_cigar_str)
-                    new_q_scores_list.append(q_scores)
-                    new_seq_list.append(seq)
-                # further organize to match refseq, new_seq (query), and new_qscores.
-                my_cigar_str_net_length_list = [len(my_cigar_str) - my_cigar_str.count("I") for my_cigar_str in my_cigar_str_list]
-                assert all(my_cigar_str_net_length_list[0] == x for x in my_cigar_str_net_length_list)
-
-                duplicated_refseq = refseq.seq + refseq.seq
-                duplicated_refseq_with_insertion = ""
-                my_cigar_str_list_with_insertion = ["" for i in my_cigar_str_list]
-                new_q_scores_list_with_insertion = [[] for i in new_q_scores_list]
-                new_seq_list_with_insertion = ["" for i in new_seq_list]
-
-                # print(duplicated_refseq)
-                # for i in new_seq_list:
-                #     print(i)
-
-                # current idx (positions of new_q_scores and new_seq are the same)
-                cur_refseq_idx = 0
-                cur_my_cigar_str_idx_list = [0 for i in my_cigar_str_list]
-                cur_q_scores_idx_list = [0 for i in new_q_scores_list]
-                max_refseq_idx = refseq.length * 2 - 1
-                max_my_cigar_str_idx_list = [len(my_cigar_str) - 1 for my_cigar_str in my_cigar_str_list]
-                max_q_scores_idx_list = [len(new_q_scores) - 1 for new_q_scores in new_q_scores_list]
-
-                # print(max_refseq_idx)
-                # print(max_my_cigar_str_idx_list)
-                # print(max_q_scores_idx_list)
-
-                all_done = False
-                cur_idx = -1
-                while not all_done:
-                    cur_idx += 1
-                    cur_my_cigar_letter_list = [my_cigar_str[cur_my_cigar_str_idx] for my_cigar_str, cur_my_cigar_str_idx in zip(my_cigar_str_list, cur_my_cigar_str_idx_list)]
-                    if "I" not in cur_my_cigar_letter_list:
-                        for i, L in enumerate(cur_my_cigar_letter_list):
-                            if L in "DH":
-                                my_cigar_str_list_with_insertion[i] += L
-                                new_q_scores_list_with_insertion[i] += [-1]
-                                new_seq_list_with_insertion[i]      += "-"
-                                cur_my_cigar_str_idx_list[i]        += 1
-                            elif L == "=":
-                                my_cigar_str_list_with_insertion[i] += L
-                                new_q_scores_list_with_insertion[i] += [ new_q_scores_list[i][cur_q_scores_idx_list[i]] ]
-                                new_seq_list_with_insertion[i]      += new_seq_list[i][cur_q_scores_idx_list[i]]
-                                cur_my_cigar_str_idx_list[i]        += 1
-                                cur_q_scores_idx_list[i]            += 1
-                            elif L == "X":
-                                my_cigar_str_list_with_insertion[i] += L
-                                new_q_scores_list_with_insertion[i] += [ new_q_scores_list[i][cur_q_scores_idx_list[i]] ]
-                                new_seq_list_with_insertion[i]      += new_seq_list[i][cur_q_scores_idx_list[i]]
-                                cur_my_cigar_str_idx_list[i]        += 1
-                                cur_q_scores_idx_list[i]            += 1
-                            elif L == "S":
-                                my_cigar_str_list_with_insertion[i] += L
-                                new_q_scores_list_with_insertion[i] += [ new_q_scores_list[i][cur_q_scores_idx_list[i]] ]
-                                new_seq_list_with_insertion[i]      += new_seq_list[i][cur_q_scores_idx_list[i]]
-                                cur_my_cigar_str_idx_list[i]        += 1
-                                cur_q_scores_idx_list[i]            += 1
-                            else:
-                                print(L)
-                                raise Exception("error!")
-                        else:
-                            duplicated_refseq_with_insertion += duplicated_refseq[cur_refseq_idx]
-                            if cur_refseq_idx == refseq.length:
-                                turning_idx = cur_idx   # 後半開始
-                            cur_refseq_idx += 1
-                    else:
-                        # TODO: insertion 同士に関してはアラインメントしてないよ！
-                        for i, L in enumerate(cur_my_cigar_letter_list):
-                            if L == "I":
-                                my_cigar_str_list_with_insertion[i] += "I"
-                                new_q_scores_list_with_insertion[i] += [ new_q_scores_list[i][cur_q_scores_idx_list[i]] ]
-                                new_seq_list_with_insertion[i]      += new_seq_list[i][cur_q_scores_idx_list[i]]
-                                cur_my_cigar_str_idx_list[i]        += 1
-                                cur_q_scores_idx_list[i]            += 1
-                            else:
-                                my_cigar_str_list_with_insertion[i] += "N"
-                                new_q_scores_list_with_insertion[i] += [-1]
-                                new_seq_list_with_insertion[i]      += "-"
-                        else:
-                            duplicated_refseq_with_insertion += "-"
-
-                    # インデックスの最大値を参照して、すべて終わったら終える！
-                    all_done = bool(
-                        (cur_refseq_idx > max_refseq_idx)
-                        * all([cur_my_cigar_str_idx > max_my_cigar_str_idx for cur_my_cigar_str_idx, max_my_cigar_str_idx in zip(cur_my_cigar_str_idx_list, max_my_cigar_str_idx_list)])
-                        * all([cur_q_scores_idx > max_q_scores_idx for cur_q_scores_idx, max_q_scores_idx in zip(cur_q_scores_idx_list, max_q_scores_idx_list)])
-                    )
-                # print(duplicated_refseq_with_insertion)
-                # print(duplicated_refseq_with_insertion[turning_idx:])
-                for i in my_cigar_str_list_with_insertion:
-                    assert len(duplicated_refseq_with_insertion) == len(i)
-                for i in new_seq_list_with_insertion:
-                    assert len(duplicated_refseq_with_insertion) == len(i)
-                for i in new_q_scores_list_with_insertion:
-                    assert len(duplicated_refseq_with_insertion) == len(i)
-
-                # linearlize
-                refseq_with_insertion_1            = duplicated_refseq_with_insertion[:turning_idx]
-                refseq_with_insertion_2            = duplicated_refseq_with_insertion[turning_idx:]
-                assert (len(refseq_with_insertion_1) - refseq_with_insertion_1.count("-")) == (len(refseq_with_insertion_2) - refseq_with_insertion_2.count("-")) == refseq.length
-                my_cigar_str_list_with_insertion_1 = [i[:turning_idx] for i in my_cigar_str_list_with_insertion]
-                my_cigar_str_list_with_insertion_2 = [i[turning_idx:] for i in my_cigar_str_list_with_insertion]
-                new_seq_list_with_insertion_1      = [i[:turning_idx] for i in new_seq_list_with_insertion]
-                new_seq_list_with_insertion_2      = [i[turning_idx:] for i in new_seq_list_with_insertion]
-                new_q_scores_list_with_insertion_1 = [i[:turning_idx] for i in new_q_scores_list_with_insertion]
-                new_q_scores_list_with_insertion_2 = [i[turning_idx:] for i in new_q_scores_list_with_insertion]
-
-                # 前半と後半をアラインメント（insertionを考慮するだけで良い）
-                # 前半の末端処理
-                assert refseq_with_insertion_2[-1] != "-"
-                N_gap_refseq_with_insertion_1_end = 1
-                while True:
-                    if refseq_with_insertion_1[-N_gap_refseq_with_insertion_1_end] != "-":
-                        break
-                    N_gap_refseq_with_insertion_1_end += 1
-                if N_gap_refseq_with_insertion_1_end > 1:
-                    refseq_with_insertion_1 = refseq_with_insertion_1[:1 - N_gap_refseq_with_insertion_1_end]
-                    my_cigar_str_list_with_insertion_1 = [i[:1 - N_gap_refseq_with_insertion_1_end] for i in my_cigar_str_list_with_insertion_1]
-                    new_seq_list_with_insertion_1 = [i[:1 - N_gap_refseq_with_insertion_1_end] for i in new_seq_list_with_insertion_1]
-                    new_q_scores_list_with_insertion_1 = [i[:1 - N_gap_refseq_with_insertion_1_end] for i in new_q_scores_list_with_insertion_1]
-                # 前半後半アラインメント開始
-                idx = -1
-                refseq_idx1 = 0
-                refseq_idx2 = 0
-                refseq_max_idx1 = len(refseq_with_insertion_1) - 1
-                refseq_max_idx2 = len(refseq_with_insertion_2) - 1
-                while True:
-                    idx += 1
-                    if refseq_with_insertion_1[idx] == refseq_with_insertion_2[idx]:
-                        refseq_idx1 += 1
-                        refseq_idx2 += 1
-                    elif refseq_with_insertion_1[idx] == "-":
-                        refseq_idx1 += 1
-                        refseq_with_insertion_2 = refseq_with_insertion_2[:idx] + "-" + refseq_with_insertion_2[idx:]
-                        for i, j in enumerate(my_cigar_str_list_with_insertion_2):
-                            my_cigar_str_list_with_insertion_2[i] = j[:idx] + "N" + j[idx:]
-                        for i, j in enumerate(new_seq_list_with_insertion_2):
-                            new_seq_list_with_insertion_2[i]      = j[:idx] + "-" + j[idx:]
-                        for i in new_q_scores_list_with_insertion_2:
-                            i.insert(idx, -1)
-                    elif refseq_with_insertion_2[idx] == "-":
-                        refseq_idx2 += 1
-                        refseq_with_insertion_1 = refseq_with_insertion_1[:idx] + "-" + refseq_with_insertion_1[idx:]
-                        for i, j in enumerate(my_cigar_str_list_with_insertion_1):
-                            my_cigar_str_list_with_insertion_1[i] = j[:idx] + "N" + j[idx:]
-                        for i, j in enumerate(new_seq_list_with_insertion_1):
-                            new_seq_list_with_insertion_1[i]      = j[:idx] + "-" + j[idx:]
-                        for i in new_q_scores_list_with_insertion_1:
-                            i.insert(idx, -1)
-                    else:
-                        raise Exception("error!")
-                    # end
-                    if (refseq_idx1 == refseq_max_idx1) & (refseq_idx2 == refseq_max_idx2):
-                        break
-                # check
-                assert refseq_with_insertion_1 == refseq_with_insertion_2
-                for i in my_cigar_str_list_with_insertion_1:
-                    assert len(refseq_with_insertion_1) == len(i)
-                for i in my_cigar_str_list_with_insertion_2:
-                    assert len(refseq_with_insertion_2) == len(i)
-                for i in new_seq_list_with_insertion_1:
-                    assert len(refseq_with_insertion_1) == len(i)
-                for i in new_seq_list_with_insertion_2:
-                    assert len(refseq_with_insertion_2) == len(i)
-                for i in new_q_scores_list_with_insertion_1:
-                    assert len(refseq_with_insertion_1) == len(i)
-                for i in new_q_scores_list_with_insertion_2:
-                    assert len(refseq_with_insertion_2) == len(i)
-
-                # print("Alighment of top half and bottom half: DONE")
-
-                # スコアマキシマムになるような前半後半の境界を探す
-                custom_cigar_score_dict = self.my_aligner.get_custom_cigar_score_dict()
-                refseq_with_insertion = refseq_with_insertion_1
-                my_cigar_str_list_with_insertion = [None for i in my_cigar_str_list_with_insertion_1]
-                new_seq_list_with_insertion = [None for i in new_seq_list_with_insertion_1]
-                new_q_scores_list_with_insertion = [None for i in new_q_scores_list_with_insertion_1]
-                for i, (j1, j2, k1, k2, l1, l2) in enumerate(zip(
-                        my_cigar_str_list_with_insertion_1, 
-                        my_cigar_str_list_with_insertion_2, 
-                        new_seq_list_with_insertion_1, 
-                        new_seq_list_with_insertion_2, 
-                        new_q_scores_list_with_insertion_1, 
-                        new_q_scores_list_with_insertion_2
-                )):
-                    my_cigar_scores_with_insertion_1 = np.array([custom_cigar_score_dict[j] for j in j1])
-                    my_cigar_scores_with_insertion_2 = np.array([custom_cigar_score_dict[j] for j in j2])
-                    switching_idx = np.argmin(np.cumsum(my_cigar_scores_with_insertion_1 - my_cigar_scores_with_insertion_2))
-                    # register
-                    my_cigar_str_list_with_insertion[i] = j2[:switching_idx + 1] + j1[switching_idx + 1:]
-                    new_seq_list_with_insertion[i]      = k2[:switching_idx + 1] + k1[switching_idx + 1:]
-                    new_q_scores_list_with_insertion[i] = l2[:switching_idx + 1] + l1[switching_idx + 1:]
-
-                # print(seq_id_list)
-                # print(refseq_with_insertion)
-                # for i, seq_id in enumerate(seq_id_list):
-                #     # print(seq_id)
-                #     print(my_cigar_str_list_with_insertion[i])
-                #     print(new_seq_list_with_insertion[i])
-                #     print(new_q_scores_list_with_insertion[i])
-                self.aligned_result_list.append({
-                    "refseq_with_insertion": refseq_with_insertion, 
-                    "query_idx_list": query_idx_list, 
-                    "seq_id_list": seq_id_list, 
-                    "my_cigar_str_list_with_insertion": my_cigar_str_list_with_insertion, 
-                    "new_seq_list_with_insertion": new_seq_list_with_insertion, 
-                    "new_q_scores_list_with_insertion": new_q_scores_list_with_insertion
-                })
+                # columns
+                insertion_width = self.get_insertion_width(result_info_list, refseq.length * 2)
+                assert insertion_width[-1] == 0
+                insertion_width_1 = insertion_width[:refseq.length]
+                insertion_width_2 = np.append(0, insertion_width[refseq.length + 1:refseq.length * 2])
+                merged_insertion_width = np.maximum(insertion_width_1, insertion_width_2)
+                ref_column = np.arange(refseq.length) + np.cumsum(merged_insertion_width)
+                N_columns = refseq.length + merged_insertion_width.sum()
+                not_placed = np.full(refseq.length, -1)
+                refseq_with_insertion = np.full(N_columns, ord("-"), dtype=np.uint8)
+                refseq_with_insertion[ref_column] = np.frombuffer(refseq.seq.encode("ascii"), dtype=np.uint8)
+                refseq_with_insertion = refseq_with_insertion.tobytes().decode("ascii")
+                def iter_chunk_matrices():
+                    for aligned_read_chunk in self.iter_aligned_read_chunks(result_info_list, refseq.length * 2):
+                        # 1st and 2nd halves on the same columns
+                        my_cigar_matrix_1, seq_matrix_1, q_score_matrix_1 = self.scatter_aligned_reads(
+                            aligned_read_chunk, 
+                            ref_column=np.concatenate([ref_column, not_placed]), 
+                            insertion_column=np.concatenate([ref_column - merged_insertion_width, not_placed, [-1]]), 
+                            N_columns=N_columns
+                        )
+                        my_cigar_matrix_2, seq_matrix_2, q_score_matrix_2 = self.scatter_aligned_reads(
+                            aligned_read_chunk, 
+                            ref_column=np.concatenate([not_placed, ref_column]), 
+                            insertion_column=np.concatenate([not_placed, [-1], (ref_column - merged_insertion_width)[1:], [-1]]), 
+                            N_columns=N_columns
+                        )
+                        # reads within one period are switched at the origin
+                        footprint_start = np.array([my_cigar.number_of_letters_on_5prime("H") for my_cigar, seq, q_scores in aligned_read_chunk])
+                        footprint_end = refseq.length * 2 - 1 - np.array([my_cigar.number_of_letters_on_3prime("H") for my_cigar, seq, q_scores in aligned_read_chunk])
+                        switching_idx = np.where(
+                            footprint_end < refseq.length, 
+                            -1, 
+                            np.where(footprint_start >= refseq.length, N_columns - 1, ref_column[np.clip(footprint_end - refseq.length, 0, refseq.length - 1)])
+                        )
+                        # longer reads: スコアマキシマムになるような前半後半の境界を探す
+                        is_longer = footprint_end - footprint_start + 1 > refseq.length
+                        if is_longer.any():
+                            cumsum_score_diff = np.cumsum(custom_cigar_score_array[my_cigar_matrix_1[is_longer]] - custom_cigar_score_array[my_cigar_matrix_2[is_longer]], axis=1)
+                            switching_idx[is_longer] = np.argmin(cumsum_score_diff, axis=1)
+                        use_2nd_half = np.arange(N_columns)[np.newaxis, :] <= switching_idx[:, np.newaxis]
+                        yield (
+                            np.where(use_2nd_half, my_cigar_matrix_2, my_cigar_matrix_1), 
+                            np.where(use_2nd_half, seq_matrix_2, seq_matrix_1), 
+                            np.where(use_2nd_half, q_score_matrix_2, q_score_matrix_1)
+                        )
+                self.aligned_result_list.append(self.aligned_result_from_chunks(
+                    refseq_with_insertion, 
+                    query_idx_list, 
+                    seq_id_list, 
+                    iter_chunk_matrices(), 
+                    keep_reads
+                ))
             else:
                 self.aligned_result_list.append({
                     "refseq_with_insertion": refseq.seq, 
-
+                    "pileup_counts": PileupCounts(len(refseq.seq)), 
                     "query_idx_list": (), 
                     "seq_id_list": (), 
-                    "my_cigar_str_list_with_insertion": [], 
-                    "new_seq_list_with_insertion": [], 
-                    "new_q_scores_list_with_insertion": []
-
-                    # "query_idx_list": (-1, ), 
-                    # "seq_id_list": ("@None", ), 
-                    # "my_cigar_str_list_with_insertion": ["X" * len(refseq.seq)], 
-                    # "new_seq_list_with_insertion": ["-" * len(refseq.seq)], 
-                    # "new_q_scores_list_with_insertion": [[-1] * len(refseq.seq)]
+                    "my_cigar_matrix": np.empty((0, len(refseq.seq)), dtype=np.uint8), 
+                    "seq_matrix": np.empty((0, len(refseq.seq)), dtype=np.uint8), 
+                    "q_score_matrix": np.empty((0, len(refseq.seq)), dtype=np.int16)
                 })
         assert len(self.my_aligner.refseq_list) == len(self.aligned_result_list)
 
 class AlignmentResultLinear(AlignmentResultBase):
-    def normalize_scores_and_apply_threshold(self):
-        self.score_list_ALL = []
-        self.result_info_assigned = [[] for i in self.my_aligner.refseq_list] # [[[seq_id, is_reverse_compliment, result, query_idx], ...], ...]
-        assert len(self.result_dict) == len(self.my_aligner.combined_fastq)
-        for query_idx, (seq_id, result_list) in enumerate(self.result_dict.items()):
-            assert len(result_list) == len(self.my_aligner.refseq_seq_list) * 2
-            # normalize scores for each refseq
-            score_list = []
-            normalized_score_list = []
-            for result_idx, result in enumerate(result_list):
-                score_list.append(result.score)
-                refseq_seq = self.my_aligner.refseq_seq_list[result_idx // 2]
-                normalized_score = result.score / len(refseq_seq)
-                if normalized_score > 1:
-                    normalized_score = 1
-                normalized_score_list.append(normalized_score)
-            # choose sequence with maximum score
-            idx = np.argmax(normalized_score_list)
-            refseq_idx, is_reverse_compliment = divmod(idx, 2)
-            result = result_list[idx]
-            # quality check
-            assigned = (normalized_score_list[idx] >= self.score_threshold)\
-                     & (result.score <= len(self.my_aligner.refseq_list[refseq_idx].seq) * self.my_aligner.match_score)\
-                     & (len(self.my_aligner.combined_fastq[seq_id][0]) <= len(self.my_aligner.refseq_seq_list[refseq_idx]) * 2)\
-                     & ((np.array(score_list) == score_list[idx]).sum() == 1)   # refseq の長さの二倍以上ある query_seq は omit する、全く同じスコアがある場合は omit する
-            # register
-            self.score_list_ALL.append({
-                "query_idx":query_idx,
-                "seq_id":seq_id,
-                "score_list":score_list,
-                "normalized_score_list":normalized_score_list,
-                "assigned_refseq_idx":refseq_idx,
-                "is_reverse_compliment":is_reverse_compliment,
-                "assigned":int(assigned)
-            })
-            if assigned:
-                self.result_info_assigned[refseq_idx].append([
-                    seq_id,
-                    is_reverse_compliment,
-                    result,
-                    query_idx
-                ])
-    def integrate_assigned_result_info(self):
+    def integrate_assigned_result_info(self, keep_reads=True):
         self.aligned_result_list = []
         assert len(self.my_aligner.refseq_list) == len(self.result_info_assigned)
         total_N = len(self.my_aligner.refseq_list)
         for cur_idx, (refseq, result_info_list) in enumerate(zip(self.my_aligner.refseq_list, self.result_info_assigned)):
             print(f"\rIntegrating alignment results: {cur_idx + 1} out of {total_N}", end="")
             if len(result_info_list) > 0:
-                my_cigar_str_list = []
-                new_q_scores_list = []
-                new_seq_list = []
                 seq_id_list, is_reverse_compliment_list, result_list, query_idx_list = list(zip(*result_info_list))
-                for result, is_reverse_compliment, seq_id in zip(result_list, is_reverse_compliment_list, seq_id_list):
-                    # query info
-                    seq = self.my_aligner.combined_fastq[seq_id][0]
-                    q_scores = self.my_aligner.combined_fastq[seq_id][1]
-                    if is_reverse_compliment:
-                        seq = str(Seq(seq).reverse_complement())
-                        q_scores = q_scores[::-1]
-                    # results
-                    my_cigar_str = MyCigarStr(result.cigar)
-                    # organize alignment based on refseq
-                    number_of_ref_bases_before_query = result.beg_ref - result.beg_query
-                    number_of_ref_bases_after_query = (refseq.length - result.end_ref - 1) - (len(seq) - result.end_query - 1)
-                    """
-                                beg_ref(9)      end_ref(24)
-                                     |                |
-                    pos     0         10         20         30
-                    ref     atcgatcggGGCTATG-CTTGCAT-GCatcgatcg
-                    align   HHHHHHHSS====X==I===D===N==SSSHHHHH
-                    query          caGGCTGTGACTT-CAT-GCtga
-                    pos            0         10          20
-                                     |                |
-                                beg_query(2)    end_query(17)
-                    """
-                    # truncate
-                    assert (number_of_ref_bases_before_query >= 0) or (number_of_ref_bases_after_query >= 0)
-                    if (number_of_ref_bases_before_query < 0):
-                        q_scores = q_scores[-number_of_ref_bases_before_query:]
-                        seq      = seq[-number_of_ref_bases_before_query:]
-                        result.beg_query -= -number_of_ref_bases_before_query
-                        result.end_query -= -number_of_ref_bases_before_query
-                        number_of_ref_bases_before_query = 0
-                    if (number_of_ref_bases_after_query < 0):
-                        q_scores = q_scores[:number_of_ref_bases_after_query]
-                        seq      = seq[:number_of_ref_bases_after_query]
-                        # result.beg_query # do nothing
-                        # result.end_query # do nothing
-                        number_of_ref_bases_after_query = 0
-                    assert (number_of_ref_bases_before_query >= 0) & (number_of_ref_bases_after_query >= 0)
-                    # organize my_cigar_str
-                    my_cigar_str = MyCigarStr(
-                        "H" * number_of_ref_bases_before_query      # add deletion of ref
-                        + "S" * result.beg_query                    # soft clip of query
-                        + my_cigar_str                              # aligned region
-                        + "S" * (len(seq) - result.end_query - 1)   # soft clip of query
-                        + "H" * number_of_ref_bases_after_query     # add deletion of ref
-                    )
-                    my_cigar_str = MyCigarStr(
-                        "H" * my_cigar_str.number_of_letters_on_5prime("HD")    # なぜか parasail の結果で 5'側に D が連なっている場合があるので、それを除く（本来 beg_ref で調節されるべき？）
-                        + my_cigar_str.clip_from_both_ends("HD")
-                        + "H" * my_cigar_str.number_of_letters_on_3prime("HD")
-                    )
-                    my_cigar_str_H_clip = my_cigar_str.clip_from_both_ends("H")
-                    assert len(q_scores) == len(seq) == len(my_cigar_str_H_clip) - my_cigar_str_H_clip.count("D")
-                    assert refseq.length == len(my_cigar_str) - my_cigar_str_H_clip.count("I")
-
-                    # なぜか parasail の結果で 5'側に I が連なっている場合があるので、それを除く（本来 beg_query で調節されるべき？）
-                    number_of_I_on_5prime = my_cigar_str.number_of_letters_on_5prime("I")
-                    if number_of_I_on_5prime > 0:
-                        my_cigar_str = MyCigarStr(my_cigar_str[number_of_I_on_5prime:])
-                        q_scores = q_scores[number_of_I_on_5prime:]
-                        seq = seq[number_of_I_on_5prime:]
-                    my_cigar_str_list.append(my_cigar_str)
-                    new_q_scores_list.append(q_scores)
-                    new_seq_list.append(seq)
-                # further organize to match refseq, new_seq (query), and new_qscores.
-                my_cigar_str_net_length_list = [len(my_cigar_str) - my_cigar_str.count("I") for my_cigar_str in my_cigar_str_list]
-                assert all(my_cigar_str_net_length_list[0] == x for x in my_cigar_str_net_length_list)
-
-                refseq_with_insertion = ""
-                my_cigar_str_list_with_insertion = ["" for i in my_cigar_str_list]
-                new_q_scores_list_with_insertion = [[] for i in new_q_scores_list]
-                new_seq_list_with_insertion = ["" for i in new_seq_list]
-
-                # current idx (positions of new_q_scores and new_seq are the same)
-                cur_refseq_idx = 0
-                cur_my_cigar_str_idx_list = [0 for i in my_cigar_str_list]
-                cur_q_scores_idx_list = [0 for i in new_q_scores_list]
-                max_refseq_idx = refseq.length - 1
-                max_my_cigar_str_idx_list = [len(my_cigar_str) - 1 for my_cigar_str in my_cigar_str_list]
-                max_q_scores_idx_list = [len(new_q_scores) - 1 for new_q_scores in new_q_scores_list]
-
-                # print(max_refseq_idx)
-                # print(max_my_cigar_str_idx_list)
-                # print(max_q_scores_idx_list)
-
-                all_done = False
-                cur_idx = -1
-                while not all_done:
-                    cur_idx += 1
-                    cur_my_cigar_letter_list = [my_cigar_str[cur_my_cigar_str_idx] for my_cigar_str, cur_my_cigar_str_idx in zip(my_cigar_str_list, cur_my_cigar_str_idx_list)]
-                    if "I" not in cur_my_cigar_letter_list:
-                        for i, L in enumerate(cur_my_cigar_letter_list):
-                            if L in "DH":
-                                my_cigar_str_list_with_insertion[i] += L
-                                new_q_scores_list_with_insertion[i] += [-1]
-                                new_seq_list_with_insertion[i]      += "-"
-                                cur_my_cigar_str_idx_list[i]        += 1
-                            elif L == "=":
-                                my_cigar_str_list_with_insertion[i] += L
-                                new_q_scores_list_with_insertion[i] += [ new_q_scores_list[i][cur_q_scores_idx_list[i]] ]
-                                new_seq_list_with_insertion[i]      += new_seq_list[i][cur_q_scores_idx_list[i]]
-                                cur_my_cigar_str_idx_list[i]        += 1
-                                cur_q_scores_idx_list[i]            += 1
-                            elif L == "X":
-                                my_cigar_str_list_with_insertion[i] += L
-                                new_q_scores_list_with_insertion[i] += [ new_q_scores_list[i][cur_q_scores_idx_list[i]] ]
-                                new_seq_list_with_insertion[i]      += new_seq_list[i][cur_q_scores_idx_list[i]]
-                                cur_my_cigar_str_idx_list[i]        += 1
-                                cur_q_scores_idx_list[i]            += 1
-                            elif L == "S":
-                                my_cigar_str_list_with_insertion[i] += L
-                                new_q_scores_list_with_insertion[i] += [ new_q_scores_list[i][cur_q_scores_idx_list[i]] ]
-                                new_seq_list_with_insertion[i]      += new_seq_list[i][cur_q_scores_idx_list[i]]
-                                cur_my_cigar_str_idx_list[i]        += 1
-                                cur_q_scores_idx_list[i]            += 1
-                            else:
-                                print(L)
-                                raise Exception("error!")
-                        else:
-                            refseq_with_insertion += refseq.seq[cur_refseq_idx]
-                            cur_refseq_idx += 1
-                    else:
-                        # TODO: insertion 同士に関してはアラインメントしてないよ！
-                        for i, L in enumerate(cur_my_cigar_letter_list):
-                            if L == "I":
-                                my_cigar_str_list_with_insertion[i] += "I"
-                                new_q_scores_list_with_insertion[i] += [ new_q_scores_list[i][cur_q_scores_idx_list[i]] ]
-                                new_seq_list_with_insertion[i]      += new_seq_list[i][cur_q_scores_idx_list[i]]
-                                cur_my_cigar_str_idx_list[i]        += 1
-                                cur_q_scores_idx_list[i]            += 1
-                            else:
-                                my_cigar_str_list_with_insertion[i] += "N"
-                                new_q_scores_list_with_insertion[i] += [-1]
-                                new_seq_list_with_insertion[i]      += "-"
-                        else:
-                            refseq_with_insertion += "-"
-
-                    # インデックスの最大値を参照して、すべて終わったら終える！
-                    all_done = bool(
-                        (cur_refseq_idx > max_refseq_idx)
-                        * all([cur_my_cigar_str_idx > max_my_cigar_str_idx for cur_my_cigar_str_idx, max_my_cigar_str_idx in zip(cur_my_cigar_str_idx_list, max_my_cigar_str_idx_list)])
-                        * all([cur_q_scores_idx > max_q_scores_idx for cur_q_scores_idx, max_q_scores_idx in zip(cur_q_scores_idx_list, max_q_scores_idx_list)])
-                    )
-                # print(refseq_with_insertion)
-                # print(refseq_with_insertion[turning_idx:])
-                for i in my_cigar_str_list_with_insertion:
-                    assert len(refseq_with_insertion) == len(i)
-                for i in new_seq_list_with_insertion:
-                    assert len(refseq_with_insertion) == len(i)
-                for i in new_q_scores_list_with_insertion:
-                    assert len(refseq_with_insertion) == len(i)
-
-                # check
-                assert refseq_with_insertion[-1] != "-"
-                for i in my_cigar_str_list_with_insertion:
-                    assert len(refseq_with_insertion) == len(i)
-                for i in new_seq_list_with_insertion:
-                    assert len(refseq_with_insertion) == len(i)
-                for i in new_q_scores_list_with_insertion:
-                    assert len(refseq_with_insertion) == len(i)
-
-                # print(seq_id_list)
-                # print(refseq_with_insertion)
-                # for i, seq_id in enumerate(seq_id_list):
-                #     # print(seq_id)
-                #     print(my_cigar_str_list_with_insertion[i])
-                #     print(new_seq_list_with_insertion[i])
-                #     print(new_q_scores_list_with_insertion[i])
-                self.aligned_result_list.append({
-                    "refseq_with_insertion": refseq_with_insertion,
-                    "query_idx_list": query_idx_list,
-                    "seq_id_list": seq_id_list,
-                    "my_cigar_str_list_with_insertion": my_cigar_str_list_with_insertion,
-                    "new_seq_list_with_insertion": new_seq_list_with_insertion,
-                    "new_q_scores_list_with_insertion": new_q_scores_list_with_insertion
-                })
+                # columns
+                insertion_width = self.get_insertion_width(result_info_list, refseq.length)
+                assert insertion_width[-1] == 0
+                ref_column = np.arange(refseq.length) + np.cumsum(insertion_width[:-1])
+                N_columns = refseq.length + insertion_width.sum()
+                refseq_with_insertion = np.full(N_columns, ord("-"), dtype=np.uint8)
+                refseq_with_insertion[ref_column] = np.frombuffer(refseq.seq.encode("ascii"), dtype=np.uint8)
+                refseq_with_insertion = refseq_with_insertion.tobytes().decode("ascii")
+                chunk_matrices_iter = (
+                    self.scatter_aligned_reads(
+                        aligned_read_chunk, 
+                        ref_column=ref_column, 
+                        insertion_column=np.append(ref_column - insertion_width[:-1], -1), 
+                        N_columns=N_columns
+                    ) for aligned_read_chunk in self.iter_aligned_read_chunks(result_info_list, refseq.length)
+                )
+                self.aligned_result_list.append(self.aligned_result_from_chunks(
+                    refseq_with_insertion, 
+                    query_idx_list, 
+                    seq_id_list, 
+                    chunk_matrices_iter, 
+                    keep_reads
+                ))
             else:
                 self.aligned_result_list.append({
                     "refseq_with_insertion": refseq.seq,
-
+                    "pileup_counts": PileupCounts(len(refseq.seq)),
                     "query_idx_list": (),
                     "seq_id_list": (),
-                    "my_cigar_str_list_with_insertion": [],
-                    "new_seq_list_with_insertion": [],
-                    "new_q_scores_list_with_insertion": []
-
-                    # "query_idx_list": (-1, ),
-                    # "seq_id_list": ("@None", ),
-                    # "my_cigar_str_list_with_insertion": ["X" * len(refseq.seq)],
-                    # "new_seq_list_with_insertion": ["-" * len(refseq.seq)],
-                    # "new_q_scores_list_with_insertion": [[-1] * len(refseq.seq)]
+                    "my_cigar_matrix": np.empty((0, len(refseq.seq)), dtype=np.uint8),
+                    "seq_matrix": np.empty((0, len(refseq.seq)), dtype=np.uint8),
+                    "q_score_matrix": np.empty((0, len(refseq.seq)), dtype=np.int16)
                 })
         assert len(self.my_aligner.refseq_list) == len(self.aligned_result_list)
 
@@ -1572,24 +2084,16 @@ class BarGraphImg():
         rounding_error = np.ones(N_array_compositional.shape[1], dtype=int) * self.bar_sum_h - N_array_compositional.sum(axis=0)
         # omitted に追加する
         N_array_compositional[-1, :] += rounding_error
-        # 画像に追加していく
-        ax_loc = [0, 0]
-        bar_pos_x = 0
-        ax_origin = self.get_ax_origin(ax_loc)
-        for idx, array in enumerate(N_array_compositional.T):
-            bar_pos_y = 0
-            for c_cycle, bar_height in enumerate(array):
-                self.draw_bar(bar_pos_x, bar_pos_y, bar_pos_y + bar_height, ax_origin, self.color_cycle_rgb[c_cycle])
-                bar_pos_y += bar_height # （画像左上の座標が [0, 0]、ただし ax の内部では左下が原点）
-            if (idx + 1) in self.tick_pos_list: # 塩基は1スタート
-                tick_idx = list(self.tick_pos_list).index(idx + 1)
-                self.draw_tick(bar_pos_x=bar_pos_x, tick_label=self.tick_label_list[tick_idx], ax_origin=ax_origin) # 下から積み上げていく
-            # 後の idx 処理
-            bar_pos_x += 1
-            if bar_pos_x == self.wrap:
-                bar_pos_x = 0
-                ax_loc[1] += 1
-                ax_origin = self.get_ax_origin(ax_loc)
+        # 画像に追加していく: color index of each pixel (bottom to top) mapped through the palette
+        palette = np.array(self.color_cycle_rgb, dtype=self.dtype)
+        bar_top_array = N_array_compositional.cumsum(axis=0)
+        color_idx_matrix = (bar_top_array[:, np.newaxis, :] <= np.arange(self.bar_sum_h)[np.newaxis, :, np.newaxis]).sum(axis=0)
+        color_idx_matrix = np.repeat(color_idx_matrix[::-1, :], self.bar_w, axis=1)  # （画像左上の座標が [0, 0]、ただし ax の内部では左下が原点）
+        for row_idx, bar_pos_x_start in enumerate(range(0, N_array_compositional.shape[1], self.wrap)):
+            ax_origin = self.get_ax_origin([0, row_idx])
+            img_rgb = palette[color_idx_matrix[:, bar_pos_x_start * self.bar_w:(bar_pos_x_start + self.wrap) * self.bar_w]]
+            self.fill_img(ax_origin[1], ax_origin[0] - self.bar_sum_h + 1, img_rgb)
+        self.draw_ticks(N_array_compositional.shape[1])
     def set_legend(self, legend_list, colors=None, pos="top left"):
         if colors is None:
             colors = self.color_cycle_rgb[:len(legend_list)]
@@ -1609,31 +2113,32 @@ class BarGraphImg():
             loc_x_new = loc_x + self.letter_h + 5
             img_rgb = np.expand_dims(255 - getattr(self, legend) * 255, axis=-1) * np.ones(3, dtype=self.dtype)
             self.fill_img(loc_x_new, loc_y, img_rgb)
-    def draw_bar(self, bar_pos_x, bar_pos_y, bar_pos_y_end, ax_origin, rgb_color):
-        for x in range(bar_pos_x * self.bar_w, (bar_pos_x + 1) * self.bar_w):
-            cur_x = ax_origin[1] + x
-            for y in range(bar_pos_y, bar_pos_y_end):
-                cur_y = ax_origin[0] - y
-                self.paint_img(cur_x, cur_y, rgb_color)
     def get_ax_origin(self, ax_loc):
         origin_w = self.ax_origin_w_list[ax_loc[0]]
         origin_h = self.ax_origin_h_list[ax_loc[1]]
         return origin_h, origin_w
-    def paint_img(self, x, y, color):
-        for i, c in enumerate(color):
-            self.img_array_rgb[y, x, i] = c
     def fill_img(self, x, y, img_rgb): # top left corner of the image is positioned at (x, y)
         self.img_array_rgb[y:y + img_rgb.shape[0], x:x + img_rgb.shape[1], :] = img_rgb
-    def draw_tick(self, bar_pos_x, tick_label, ax_origin):
-        # tick
-        self.draw_bar(bar_pos_x, self.bar_sum_h, self.bar_sum_h + self.tick_h, ax_origin, rgb_color=self.tick_color)
-        # label
-        loc_x = ax_origin[1] + bar_pos_x * self.bar_w - self.number_w // 2
-        for i, l in enumerate(str(tick_label)):
-            loc_y = ax_origin[0] - self.bar_sum_h - self.tick_h - self.letter_h - 1
-            img_rgb = np.expand_dims(255 - getattr(self, self.w2n[int(l)]) * 255, axis=-1) * np.ones(3, dtype=self.dtype)
-            self.fill_img(loc_x, loc_y, img_rgb)
-            loc_x += self.number_w + 1
+    def draw_ticks(self, N_bars):
+        # bar idx (0 start) of each tick (塩基は1スタート)
+        tick_label_dict = {}
+        for tick_pos, tick_label in zip(self.tick_pos_list, self.tick_label_list):
+            if 0 < tick_pos <= N_bars:
+                tick_label_dict.setdefault(tick_pos - 1, tick_label)
+        if len(tick_label_dict) == 0:
+            return
+        bar_idx_array = np.array(sorted(tick_label_dict.keys()))
+        # ticks
+        origin_h_array = np.array(self.ax_origin_h_list)[bar_idx_array // self.wrap]
+        origin_w_array = self.ax_origin_w_list[0] + (bar_idx_array % self.wrap) * self.bar_w
+        y_matrix = origin_h_array[:, np.newaxis, np.newaxis] - np.arange(self.bar_sum_h, self.bar_sum_h + self.tick_h)[np.newaxis, :, np.newaxis]
+        x_matrix = origin_w_array[:, np.newaxis, np.newaxis] + np.arange(self.bar_w)[np.newaxis, np.newaxis, :]
+        self.img_array_rgb[y_matrix, x_matrix] = self.tick_color
+        # labels
+        for origin_h, origin_w, bar_idx in zip(origin_h_array, origin_w_array, bar_idx_array):
+            label = np.hstack(sum([[getattr(self, self.w2n[int(l)]), self.vs] for l in str(tick_label_dict[bar_idx])], [])[:-1])
+            img_rgb = np.expand_dims(255 - label * 255, axis=-1) * np.ones(3, dtype=self.dtype)
+            self.fill_img(origin_w - self.number_w // 2, origin_h - self.bar_sum_h - self.tick_h - self.letter_h - 1, img_rgb)
     def export_as_img(self, save_path):
         PilImage.fromarray(self.img_array_rgb).save(save_path)
 
@@ -1644,17 +2149,13 @@ def draw_distributions(score_summary_df, combined_fastq):
         if m is not None:
             refseq_idx_dict[int(m.group(2))] = m.group(1)
 
-    # データ収集
-    assignment_set_4_read_length = [[] for i in range(len(refseq_idx_dict) + 1)]   # last one is for idx=-1 (not assigned)
-    assignment_set_4_q_scores = [[] for i in range(len(refseq_idx_dict) + 1)]   # last one is for idx=-1 (not assigned)
-    for i, s in score_summary_df.iterrows():
-        seq_id = s["seq_id"]
-        assigned_refseq_idx = s["assigned_refseq_idx"]
-        assigned = s["assigned"]
-        if assigned == 0:
-            assigned_refseq_idx = -1
-        assignment_set_4_read_length[assigned_refseq_idx].append(len(combined_fastq[seq_id][0]))
-        assignment_set_4_q_scores[assigned_refseq_idx].extend(combined_fastq[seq_id][1])
+    # データ収集: histograms of each group (last one is for idx=-1 (not assigned))
+    N_groups = len(refseq_idx_dict) + 1
+    assigned_refseq_idx_array = np.where(score_summary_df["assigned"].to_numpy() == 0, -1, score_summary_df["assigned_refseq_idx"].to_numpy())
+    read_group_array = np.full(len(combined_fastq), -1, dtype=np.int64)   # reads not in score_summary_df are ignored
+    read_group_array[[combined_fastq.seq_id2idx[seq_id] for seq_id in score_summary_df["seq_id"]]] = assigned_refseq_idx_array % N_groups
+    read_length_array = combined_fastq.get_read_lengths()
+    q_score_histogram = combined_fastq.get_q_score_histogram(read_group_array, N_groups)
 
     # 描画パラメータ
     rows = len(refseq_idx_dict)
@@ -1689,10 +2190,12 @@ def draw_distributions(score_summary_df, combined_fastq):
     column_idx = 1
     # assignment ごとにヒートマップを描画
     bin_unit = 100
-    bins = range(0, int(np.ceil(max(max(v) if len(v) > 0 else bin_unit for v in assignment_set_4_read_length) / bin_unit) * bin_unit), bin_unit)
+    bins = np.arange(0, int(np.ceil(max(read_length_array[read_group_array == g].max() if (read_group_array == g).any() else bin_unit for g in range(N_groups)) / bin_unit) * bin_unit), bin_unit)
+    read_length_histogram = np.array([np.histogram(read_length_array[read_group_array == g], bins=bins)[0] for g in range(N_groups)])
     for refseq_idx, refseq_name in refseq_idx_dict.items():
         hist_params = dict(
-            x=assignment_set_4_read_length[-2::-1] + assignment_set_4_read_length[-1:], 
+            x=[bins[:-1] for g in range(N_groups)], 
+            weights=list(read_length_histogram[-2::-1]) + list(read_length_histogram[-1:]), 
             color=[color_cycle[0] if i == refseq_idx else color_cycle[1] for i in range(len(refseq_idx_dict))][::-1] + ["grey"], 
             bins=bins, 
             histtype='bar', 
@@ -1723,7 +2226,8 @@ def draw_distributions(score_summary_df, combined_fastq):
     column_idx = 2
     for refseq_idx, refseq_name in refseq_idx_dict.items():
         hist_params = dict(
-            x=assignment_set_4_q_scores[-2::-1] + assignment_set_4_q_scores[-1:], 
+            x=[np.arange(q_score_histogram.shape[1]) for g in range(N_groups)], 
+            weights=list(q_score_histogram[-2::-1]) + list(q_score_histogram[-1:]), 
             color=[color_cycle[0] if i == refseq_idx else color_cycle[1] for i in range(len(refseq_idx_dict))][::-1] + ["grey"], 
             bins=np.arange(42), 
             histtype='bar', 
@@ -1756,7 +2260,7 @@ def draw_alignment_score_scatter(score_summary_df, score_threshold):
     for refseq_idx, refseq_name in refseq_idx_dict.items():
         col_name1 = refseq_name + f" (idx={refseq_idx}, normalized)"
         col_name2 = refseq_name + f" (idx={refseq_idx},rc, normalized)"
-        score_summary_df[refseq_name] = score_summary_df.apply(lambda row: max(row[col_name1], row[col_name2]), axis=1)
+        score_summary_df[refseq_name] = score_summary_df[[col_name1, col_name2]].max(axis=1)  # nan (not aligned) is skipped
 
     # 描画パラメータ
     rows = columns = len(refseq_idx_dict) + 1
@@ -1789,9 +2293,9 @@ def draw_alignment_score_scatter(score_summary_df, score_threshold):
             diagonal_axes.append(ax)
             hist_params = dict(
                 x=[
-                    score_summary_df.query(f"(assigned_refseq_idx == {refseq_idx1})&(assigned == 1)")[refseq_name1], 
-                    score_summary_df.query(f"(assigned_refseq_idx != {refseq_idx1})&(assigned == 1)")[refseq_name1], 
-                    score_summary_df.query("(assigned == 0)")[refseq_name1]
+                    score_summary_df.query(f"(assigned_refseq_idx == {refseq_idx1})&(assigned == 1)")[refseq_name1].dropna(), 
+                    score_summary_df.query(f"(assigned_refseq_idx != {refseq_idx1})&(assigned == 1)")[refseq_name1].dropna(), 
+                    score_summary_df.query("(assigned == 0)")[refseq_name1].dropna()
                 ], 
                 color=[focused_color1, focused_color2, not_assigned_color], 
                 bins=np.linspace(0, 1, 100), 
@@ -2099,6 +2603,17 @@ class SequenceBasecallQscoreLibrary(mc.MyTextFormat):
             # マイナス1で最後のやつにアクセスできるようにする（さすがに50も間を開けてれば、q-scoreがかぶってくることは無いでしょう…）
             values_list = list(values)[1:] + [0.0 for i in range(50)] + list(values)[:1]
             self.pdf_core[column_names] = values
+    def get_log_P_event_table(self, bases):
+        """
+        log(P(event | true_refseq)) as an array of shape (true_refseq, readseq, q_score + 1) (q_score: -1 to 41)
+        """
+        log_P_event_table = np.empty((len(bases), len(bases), 43), dtype=float)
+        with np.errstate(divide="ignore"):
+            for t, true_refseq in enumerate(bases):
+                for r, readseq in enumerate(bases):
+                    key = f"{true_refseq}_{readseq}"
+                    log_P_event_table[t, r] = np.log(self.P_base_calling_given_true_refseq_dict[key]) + np.log(self.pdf_core[key].loc[-1:41].values.astype(float))
+        return log_P_event_table
     def calc_P_event_given_true_refseq(self, event, true_refseq):
         readseq, q_score = event
         key = f"{true_refseq}_{readseq}"
@@ -2188,79 +2703,150 @@ NanoporeStats_PDF_txt = textwrap.dedent("""
 
 sbq_pdf = SequenceBasecallQscoreLibrary(io.StringIO(NanoporeStats_PDF_txt))
 
-def calc_consensus(self, sbq_pdf, P_N_dict_dict):
-    self.consensus_dict = {}
+class PileupCounts():
+    """
+    per-column counts of events (readseq, q_score + 1) of non-H/S letters, and of my_cigar letters
+    filled chunk by chunk of reads, so that memory depends only on the number of columns
+    """
+    N_q_scores = 43     # q_score: -1 to 41
+    cigar_letters = "=NHSXID"
+    def __init__(self, N_columns) -> None:
+        self.N_columns = N_columns
+        self.event_counts = np.zeros((N_columns, len(bases), self.N_q_scores), dtype=np.uint32)
+        self.cigar_counts = np.zeros((N_columns, len(self.cigar_letters)), dtype=np.uint32)
+        self.base2idx = np.full(256, 255, dtype=np.uint8)
+        for b_idx, b in enumerate(bases):
+            self.base2idx[ord(b)] = b_idx
+            self.base2idx[ord(b.lower())] = b_idx
+        self.cigar2idx = np.full(256, 255, dtype=np.uint8)
+        for L_idx, L in enumerate(self.cigar_letters):
+            self.cigar2idx[ord(L)] = L_idx
+    @classmethod
+    def from_aligned_result(cls, aligned_result):
+        # for aligned_result without pileup_counts
+        pileup_counts = cls(len(aligned_result["refseq_with_insertion"]))
+        pileup_counts.add(aligned_result["my_cigar_matrix"], aligned_result["seq_matrix"], aligned_result["q_score_matrix"])
+        return pileup_counts
+    def add(self, my_cigar_matrix, seq_matrix, q_score_matrix):
+        # (reads x columns) matrices
+        column_matrix = np.broadcast_to(np.arange(self.N_columns), my_cigar_matrix.shape)
+        cigar_idx_matrix = self.cigar2idx[my_cigar_matrix]
+        if (cigar_idx_matrix == 255).any():
+            raise Exception("unknown cigar string")
+        self.cigar_counts += np.bincount(
+            (column_matrix * len(self.cigar_letters) + cigar_idx_matrix).ravel(), minlength=self.cigar_counts.size
+        ).reshape(self.cigar_counts.shape).astype(np.uint32)
+        event_mask = (my_cigar_matrix != ord("H")) & (my_cigar_matrix != ord("S"))
+        readseq_idx = self.base2idx[seq_matrix[event_mask]].astype(int)
+        q_score_idx = q_score_matrix[event_mask].astype(int) + 1
+        if (readseq_idx == 255).any() or (q_score_idx < 0).any() or (q_score_idx >= self.N_q_scores).any():
+            raise Exception("unknown error")
+        self.event_counts += np.bincount(
+            (column_matrix[event_mask] * len(bases) + readseq_idx) * self.N_q_scores + q_score_idx, minlength=self.event_counts.size
+        ).reshape(self.event_counts.shape).astype(np.uint32)
+    @property
+    def N_events(self):
+        return self.event_counts.sum(axis=(1, 2))
+    def get_log_L_events(self, log_P_event_table):
+        """
+        sum(log(P(event | b))) for each true base b, as an array of shape (bases, columns)
+        """
+        is_possible = np.isfinite(log_P_event_table)
+        event_counts = self.event_counts.astype(float)
+        log_L_events = np.einsum("crq,trq->tc", event_counts, np.where(is_possible, log_P_event_table, 0))
+        # events that never occur for b
+        N_impossible = np.einsum("crq,trq->tc", event_counts, (~is_possible).astype(float))
+        log_L_events[N_impossible > 0] = -np.inf
+        return log_L_events
+    def get_N_array(self, letters_list):
+        # (letters_list x columns), where each row is the sum of counts of the letters
+        one_hot = np.array([[L in letters for L in self.cigar_letters] for letters in letters_list], dtype=int)
+        return one_hot @ self.cigar_counts.T.astype(int)
+
+def calc_consensus(self, sbq_pdf, P_N_dict_dict_list):
+    """
+    same as SequenceBasecallQscoreLibrary.calc_consensus_error_rate for every column, computed in log space:
+    error rate of base B = 1 - P(B | events) = 1 - exp(L_B - logsumexp(L)), where L_b = log(P_N[b]) + sum(log(P(event | b)))
+    events are taken from PileupCounts (counts x log(P(event | b))), so that per-read data are not needed
+    sum(log(P(event | b))) does not depend on the prior, so all priors in P_N_dict_dict_list are evaluated in one pass
+    returns [(consensus_dict, consensus_settings), ...] for each prior
+    """
+    log_P_event_table = sbq_pdf.get_log_P_event_table(bases)
+    # consensus letters for all combinations (bit flags) of the bases with the minimum error rate
+    mixed_base_list = [None] + [mixed_bases([b for b_idx, b in enumerate(bases) if (flag >> b_idx) & 1]) for flag in range(1, 2 ** len(bases))]
+    consensus_dict_list = [{} for P_N_dict_dict in P_N_dict_dict_list]
     for refseq_idx, aligned_result in enumerate(self.aligned_result_list):
         print(f"\nrefseq No. {refseq_idx}")
-        consensus_seq = ""
-        consensus_q_scores = []
-        consensus_seq_all = ""
-        consensus_q_scores_all = []
-        N_bases = len(aligned_result["refseq_with_insertion"])
-        for refbase_idx, refbase in enumerate(aligned_result["refseq_with_insertion"]):
-            print(f"\r{refbase_idx + 1} out of {N_bases}", end="")
-            seq_base_list = [i[refbase_idx] for i in aligned_result["new_seq_list_with_insertion"]]
-            q_score_list = [i[refbase_idx] for i in aligned_result["new_q_scores_list_with_insertion"]]
-            my_cigar_str_list = [i[refbase_idx] for i in aligned_result["my_cigar_str_list_with_insertion"]]
-            event_list = [(i.upper(), j) for i, j, k in zip(seq_base_list, q_score_list, my_cigar_str_list) if k not in "HS"]
-
-            if len(event_list) > 0:
-                P_N_dict = P_N_dict_dict[refbase.upper()]
-                p_list = [
-                    sbq_pdf.calc_consensus_error_rate(event_list, true_refseq=B, P_N_dict=P_N_dict, bases=bases)
-                    for B in bases
-                ]
-                p = min(p_list)
-                # p_idx_list = [i for i, v in enumerate(p_list) if v == p]
-                consensus_base_call = mixed_bases([b for b, tmp_p in zip(bases, p_list) if tmp_p == p])
-
-                # register
-                if p >= 10 ** (-5):
-                    q_score = np.round(-10 * np.log10(p)).astype(int)
-                elif p < 0:
-                    raise Exception("unknown error")
+        refseq_with_insertion = aligned_result["refseq_with_insertion"]
+        if "pileup_counts" in aligned_result:
+            pileup_counts = aligned_result["pileup_counts"]
+        else:
+            pileup_counts = PileupCounts.from_aligned_result(aligned_result)
+        assert pileup_counts.N_columns == len(refseq_with_insertion)
+        N_events = pileup_counts.N_events
+        # log likelihood of the events for each true base (bases x columns)
+        log_L_events = pileup_counts.get_log_L_events(log_P_event_table)
+        refbase_list, refbase_inverse = np.unique(list(refseq_with_insertion.upper()), return_inverse=True)
+        for P_N_dict_dict, consensus_dict in zip(P_N_dict_dict_list, consensus_dict_list):
+            # prior
+            with np.errstate(divide="ignore"):
+                log_P_N_matrix = np.log([[P_N_dict_dict[refbase][B] for B in bases] for refbase in refbase_list]).reshape(len(refbase_list), len(bases))
+            log_L = log_P_N_matrix[refbase_inverse].T + log_L_events
+            with np.errstate(invalid="ignore"):
+                p_matrix = -np.expm1(log_L - np.logaddexp.reduce(log_L, axis=0))
+            p = p_matrix.min(axis=0)
+            flags = ((p_matrix == p) * (1 << np.arange(len(bases)))[:, np.newaxis]).sum(axis=0)
+            with np.errstate(divide="ignore"):
+                q_score_array = np.where(p >= 10 ** (-5), np.round(-10 * np.log10(p)), 50).astype(int)
+            q_score_array[N_events == 0] = -1
+
+            consensus_seq = ""
+            consensus_q_scores = []
+            consensus_seq_all = ""
+            consensus_q_scores_all = q_score_array.tolist()
+            for flag, n_events, q_score in zip(flags.tolist(), N_events.tolist(), consensus_q_scores_all):
+                if n_events > 0:
+                    consensus_base_call = mixed_base_list[flag]
                 else:
-                    q_score = 50
-            else:
-                consensus_base_call = "-"
-                q_score = -1
-
-            if  consensus_base_call != "-":
-                consensus_seq += consensus_base_call
-                consensus_q_scores.append(q_score)
-
-            # registre "all" results
-            consensus_seq_all += consensus_base_call
-            consensus_q_scores_all.append(q_score)
-
-        # 登録
-        self.consensus_dict[self.my_aligner.refseq_list[refseq_idx].path.name] = [
-            consensus_seq, 
-            consensus_q_scores, 
-            consensus_seq_all, 
-            consensus_q_scores_all
-        ]
-    # register settings
-    self.consensus_settings = {
+                    consensus_base_call = "-"
+                if  consensus_base_call != "-":
+                    consensus_seq += consensus_base_call
+                    consensus_q_scores.append(q_score)
+                # registre "all" results
+                consensus_seq_all += consensus_base_call
+
+            # 登録
+            consensus_dict[self.my_aligner.refseq_list[refseq_idx].path.name] = [
+                consensus_seq, 
+                consensus_q_scores, 
+                consensus_seq_all, 
+                consensus_q_scores_all
+            ]
+    # settings
+    consensus_settings_list = [{
         "sbq_pdf_version":sbq_pdf.file_version, 
         "P_N_dict_matrix":P_N_dict_dict_2_matrix(P_N_dict_dict), 
         "bases": bases
-    }
+    } for P_N_dict_dict in P_N_dict_dict_list]
+    return list(zip(consensus_dict_list, consensus_settings_list))
 
-def calculate_consensus(alignment_result, param_dict):
+def calculate_consensus(alignment_result, param_dict, keep_reads=True):
     # params
     P_N_dict_dict, P_N_dict_dict_2 = consensus_params(param_dict)
 
     # execute
-    alignment_result.integrate_assigned_result_info()
+    alignment_result.integrate_assigned_result_info(keep_reads=keep_reads)
     print()
     print("integration: DONE")
 
-    print("Calculating consensus with prior information...")
-    calc_consensus(alignment_result, sbq_pdf, P_N_dict_dict)
-    print("\n\nCalculating consensus without prior information...")
-    alignment_result_2 = copy.deepcopy(alignment_result)
-    calc_consensus(alignment_result_2, sbq_pdf, P_N_dict_dict_2)
+    print("Calculating consensus with and without prior information...")
+    (consensus_dict, consensus_settings), (consensus_dict_2, consensus_settings_2) = calc_consensus(alignment_result, sbq_pdf, [P_N_dict_dict, P_N_dict_dict_2])
+    alignment_result.consensus_dict = consensus_dict
+    alignment_result.consensus_settings = consensus_settings
+    # alignment data are shared with alignment_result (not copied)
+    alignment_result_2 = copy.copy(alignment_result)
+    alignment_result_2.consensus_dict = consensus_dict_2
+    alignment_result_2.consensus_settings = consensus_settings_2
 
     return alignment_result_2
 
@@ -2457,7 +3043,7 @@ if __name__ == "__main__":
     refseq_list, combined_fastq = organize_files([fastq_file_path], refseq_file_path_list)
     # combined_fastq = combined_fastq[:2]
     # 2. Execute alignment: load if any previous score_matrix if possible
-    result_dict, my_aligner, intermediate_results = execute_alignment(refseq_list, combined_fastq, param_dict, save_dir)
+    result_dict, my_aligner, intermediate_results = execute_alignment(refseq_list, combined_fastq, param_dict, save_dir, cache_dir=save_dir / "alignment_cache")
     # 3. Set threshold for assignment
     alignment_result = set_threshold_for_assignment(result_dict, my_aligner, param_dict)
     # 4. Calculate consensus
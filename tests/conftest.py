@@ -0,0 +1,72 @@
+import re
+import sys
+import importlib
+from pathlib import Path
+import pytest
+import matplotlib
+matplotlib.use("Agg")
+
+package_dir = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(package_dir / "Modules"))   # 0_pre_survey_core imports my_classes directly
+sys.path.insert(0, str(package_dir))
+
+@pytest.fixture(scope="session")
+def pre_survey_core():
+    pytest.importorskip("cairo")
+    return importlib.import_module("0_pre_survey_core")
+
+@pytest.fixture(scope="session")
+def alignment_consensus_core():
+    return importlib.import_module("Modules.1_alignment_consensus_core")
+
+def random_seq(rng, length):
+    return "".join(rng.choice(list("ATCG"), length))
+
+def mutate(rng, seq, rate=0.03):
+    # substitutions, insertions and deletions at the same rate
+    new_seq = []
+    for b in seq:
+        r = rng.random()
+        if r < rate:
+            new_seq.append(rng.choice([c for c in "ATCG" if c != b]))
+        elif r < rate * 2:
+            new_seq.append(b + rng.choice(list("ATCG")))
+        elif r < rate * 3:
+            continue
+        else:
+            new_seq.append(b)
+    return "".join(new_seq)
+
+class MyCigarStr(str):
+    """
+    the previous cigar representation of 1_alignment_consensus_core (one letter per base), kept as a reference for MyCigar
+    """
+    def __new__(cls, cigar_str):
+        # when common cigar strings are passed
+        if cigar_str[0].isdecimal():
+            val = "".join([
+                L for N, L in re.findall(r'(\d+)(\D)', cigar_str)
+                    for i in range(int(N))
+            ])
+            self = super().__new__(cls, val)
+            return self
+        # when "MyCigarStr" strings are passed
+        else:
+            self = super().__new__(cls, cigar_str)
+            return self
+    def __iadd__(self, other):
+        return self.__class__(self + other)
+    def invert(self):
+        return self.__class__(self[::-1])
+    def number_of_letters_on_5prime(self, letters):
+        for i, l in enumerate(self):
+            if l not in letters:
+                return i
+    def number_of_letters_on_3prime(self, letters):
+        for k, l in enumerate(self[::-1]):
+            if l not in letters:
+                return k
+    def clip_from_both_ends(self, letters):
+        i = self.number_of_letters_on_5prime(letters)
+        k = self.number_of_letters_on_3prime(letters)
+        return self.__class__(self[i:len(self) - k])
@@ -0,0 +1,64 @@
+import numpy as np
+from conftest import random_seq, mutate
+from test_circular_alignment import make_aligner
+
+L = 1500
+
+def count_alignments(my_aligner):
+    counts = {"score_only": 0, "trace": 0}
+    align_score_only, align_trace = my_aligner.align_score_only, my_aligner.align_trace
+    def align_score_only_spy(*args, **kwargs):
+        counts["score_only"] += 1
+        return align_score_only(*args, **kwargs)
+    def align_trace_spy(*args, **kwargs):
+        counts["trace"] += 1
+        return align_trace(*args, **kwargs)
+    my_aligner.align_score_only, my_aligner.align_trace = align_score_only_spy, align_trace_spy
+    return counts
+
+def test_second_run_aligns_nothing(alignment_consensus_core, tmp_path):
+    m = alignment_consensus_core
+    rng = np.random.default_rng(0)
+    refseq_seq_list = [random_seq(rng, L), random_seq(rng, L)]
+    read_list = [mutate(rng, refseq_seq_list[i % 2][100 * i:100 * i + 1000]) for i in range(6)]
+    result_dict_list = []
+    for run in range(2):
+        my_aligner = make_aligner(m, tmp_path, refseq_seq_list, read_list)
+        counts = count_alignments(my_aligner)
+        alignment_cache = m.AlignmentCache(tmp_path / "cache", my_aligner)
+        cached_result_dict = alignment_cache.load(my_aligner.combined_fastq)
+        result_dict = my_aligner.align_all(cached_result_dict)
+        alignment_cache.save(result_dict, cached_result_dict)
+        result_dict_list.append(result_dict)
+    assert counts == {"score_only": 0, "trace": 0}
+    for result_list_1, result_list_2 in zip(result_dict_list[0].values(), result_dict_list[1].values()):
+        assert [vars(result) for result in result_list_1] == [vars(result) for result in result_list_2]
+    # the shards are compacted
+    for refseq in my_aligner.refseq_list:
+        assert len(list(alignment_cache.refseq_dir(refseq).glob("*.npz"))) == 1
+
+def test_score_only_result_is_upgraded(alignment_consensus_core, tmp_path):
+    m = alignment_consensus_core
+    rng = np.random.default_rng(1)
+    refseq_seq_list = [random_seq(rng, L), random_seq(rng, L)]
+    read = mutate(rng, refseq_seq_list[1][200:1200]) + refseq_seq_list[0][:300]
+    # 1st run: the read is assigned to R1, and the results of R0 are cached without traceback
+    my_aligner = make_aligner(m, tmp_path, refseq_seq_list, [read])
+    alignment_cache = m.AlignmentCache(tmp_path / "cache", my_aligner)
+    alignment_cache.save(my_aligner.align_all(), {})
+    cached_result_list = alignment_cache.load(my_aligner.combined_fastq)["@read0"]
+    assert cached_result_list[2].is_traced and not (cached_result_list[0].is_traced or cached_result_list[1].is_traced)
+    # 2nd run without R1: a result of R0 becomes the best hit, and only its traceback is calculated
+    my_aligner = make_aligner(m, tmp_path, refseq_seq_list[:1], [read])
+    counts = count_alignments(my_aligner)
+    alignment_cache = m.AlignmentCache(tmp_path / "cache", my_aligner)
+    cached_result_dict = alignment_cache.load(my_aligner.combined_fastq)
+    result_dict = my_aligner.align_all(cached_result_dict)
+    alignment_cache.save(result_dict, cached_result_dict)
+    best_idx = int(np.argmax([result.score for result in result_dict["@read0"]]))
+    assert best_idx == 0
+    assert counts == {"score_only": 0, "trace": 1}
+    cached_result_list = alignment_cache.load(my_aligner.combined_fastq)["@read0"]
+    assert cached_result_list[best_idx].is_traced
+    assert cached_result_list[best_idx].score == result_dict["@read0"][best_idx].score
+    assert len(list(alignment_cache.refseq_dir(my_aligner.refseq_list[0]).glob("*.npz"))) == 1
@@ -0,0 +1,96 @@
+import numpy as np
+from conftest import random_seq, mutate
+
+L = 3000
+param_dict = dict(gap_open_penalty=3, gap_extend_penalty=1, match_score=1, mismatch_score=-2, score_threshold=0.3)
+
+def make_aligner(m, tmp_path, refseq_seq_list, read_list, max_workers=1, **kwargs):
+    refseq_list = []
+    for i, refseq_seq in enumerate(refseq_seq_list):
+        path = tmp_path / f"R{i}.fa"
+        path.write_text(f">R{i}\n{refseq_seq}\n")
+        refseq_list.append(m.MyRefSeq(path))
+    combined_fastq = m.MyFastQ()
+    for i, read in enumerate(read_list):
+        combined_fastq[f"@read{i}"] = [read, [20] * len(read)]
+    return m.MyAligner(refseq_list, combined_fastq, param_dict, max_workers=max_workers, **kwargs)
+
+def test_seeded_trace_in_linear_coordinates(alignment_consensus_core, tmp_path):
+    m = alignment_consensus_core
+    rng = np.random.default_rng(0)
+    refseq_seq = random_seq(rng, L)
+    my_aligner = make_aligner(m, tmp_path, [refseq_seq], [], use_minimizer_triage=True)
+    for start in [2500, 2950, 10, L + 100]:
+        read = mutate(rng, (refseq_seq * 3)[start:start + 1000])
+        candidate = my_aligner.minimizer_index.rank_candidates(read)[0]
+        window_start, window_end = my_aligner.get_band_window(candidate.offset, len(read), L * 2)
+        assert window_start < L and window_end - window_start < L
+        result_seeded = my_aligner.align_trace(read, candidate.result_idx, offset=candidate.offset)
+        result_full = my_aligner.align_trace(read, candidate.result_idx)
+        assert result_seeded.score == result_full.score
+        assert 0 <= result_seeded.beg_ref < L
+        assert (result_seeded.end_ref - result_full.end_ref) % L == 0
+
+def test_read_across_origin_is_placed_without_merge(alignment_consensus_core, tmp_path):
+    m = alignment_consensus_core
+    rng = np.random.default_rng(1)
+    refseq_seq = random_seq(rng, L)
+    read_list = [(refseq_seq * 2)[2500:3500], (refseq_seq * 2)[L + 100:L + 1300]]
+    for use_minimizer_triage in [False, True]:
+        my_aligner = make_aligner(m, tmp_path, [refseq_seq], read_list, use_minimizer_triage=use_minimizer_triage)
+        alignment_result = m.AlignmentResult(my_aligner.align_all(), my_aligner, param_dict)
+        alignment_result.normalize_scores_and_apply_threshold()
+        alignment_result.integrate_assigned_result_info(keep_reads=True)
+        aligned_result = alignment_result.aligned_result_list[0]
+        assert aligned_result["refseq_with_insertion"] == refseq_seq
+        seq_list = [i.tobytes().decode("ascii") for i in aligned_result["seq_matrix"]]
+        assert seq_list[0] == read_list[0][500:] + "-" * 2000 + read_list[0][:500]
+        assert seq_list[1] == "-" * 100 + read_list[1] + "-" * (L - 1300)
+
+def test_triage_placeholders_are_not_aligned(alignment_consensus_core, tmp_path):
+    m = alignment_consensus_core
+    assert not hasattr(m.MinimizerIndex, "code") and not hasattr(m.MinimizerIndex, "b")
+    rng = np.random.default_rng(2)
+    refseq_seq_list = [random_seq(rng, L), random_seq(rng, L)]
+    read_list = [mutate(rng, refseq_seq_list[0][200:2200]), mutate(rng, refseq_seq_list[1][500:2500])]
+    my_aligner = make_aligner(m, tmp_path, refseq_seq_list, read_list, use_minimizer_triage=True)
+    alignment_result = m.AlignmentResult(my_aligner.align_all(), my_aligner, param_dict)
+    alignment_result.normalize_scores_and_apply_threshold()
+    score_summary_df = alignment_result.get_score_summary_df()
+    assert (score_summary_df["assigned"] == 1).all()
+    assert (score_summary_df["assigned_refseq_idx"] == [0, 1]).all()
+    # only the seeded candidate is aligned, the others are nan (not 0)
+    normalized_columns = [c for c in score_summary_df.columns if c.endswith("normalized)")]
+    assert (score_summary_df[normalized_columns].notna().sum(axis=1) == 1).all()
+    alignment_result.save_score_summary(tmp_path / "summary_scores.txt")
+    assert "\tnan\t" in (tmp_path / "summary_scores.txt").read_text()
+
+def test_trace_is_seeded_without_triage(alignment_consensus_core, tmp_path):
+    m = alignment_consensus_core
+    rng = np.random.default_rng(3)
+    refseq_seq_list = [random_seq(rng, L), random_seq(rng, L)]
+    my_aligner = make_aligner(m, tmp_path, refseq_seq_list, [])
+    assert my_aligner.minimizer_index is not None
+    offset_list = []
+    align_trace = my_aligner.align_trace
+    def align_trace_spy(query, result_idx, offset=None):
+        offset_list.append(offset)
+        return align_trace(query, result_idx, offset=offset)
+    my_aligner.align_trace = align_trace_spy
+    for start in [2500, L + 100]:
+        read = mutate(rng, (refseq_seq_list[1] * 3)[start:start + 1000])
+        result_list = my_aligner.align_single(read)
+        assert offset_list[-1] is not None
+        assert result_list[2].is_traced and 0 <= result_list[2].beg_ref < L
+        assert result_list[2].score == align_trace(read, 2).score
+
+def test_baseline_alignment_scores(alignment_consensus_core, tmp_path):
+    m = alignment_consensus_core
+    rng = np.random.default_rng(4)
+    refseq_seq_list = [random_seq(rng, L), random_seq(rng, L)]
+    read_list = [mutate(rng, (refseq_seq_list[i % 2] * 2)[1000 * i:1000 * i + 1500]) for i in range(4)]
+    my_aligner = make_aligner(m, tmp_path, refseq_seq_list, read_list)
+    for read in read_list:
+        assert [result.score for result in m.align_single_baseline(my_aligner, read)] == [result.score for result in my_aligner.align_single(read)]
+    latency_array = m.benchmark_align_single(my_aligner, baseline=True)
+    assert len(latency_array) == len(read_list)
@@ -0,0 +1,88 @@
+import copy
+import types
+import numpy as np
+
+param_dict = dict(error_rate=0.0001, del_mut_rate=0.0001 / 4, ins_rate=0.0001)
+
+def calc_consensus_per_read(m, aligned_result, sbq_pdf, P_N_dict_dict):
+    # previous calc_consensus (column by column from per-read data)
+    consensus_seq_all = ""
+    consensus_q_scores_all = []
+    for refbase_idx, refbase in enumerate(aligned_result["refseq_with_insertion"]):
+        event_list = [
+            (chr(seq_matrix_column).upper(), int(q_score)) for seq_matrix_column, q_score, L in zip(
+                aligned_result["seq_matrix"][:, refbase_idx], aligned_result["q_score_matrix"][:, refbase_idx], aligned_result["my_cigar_matrix"][:, refbase_idx]
+            ) if chr(L) not in "HS"
+        ]
+        if len(event_list) > 0:
+            P_N_dict = P_N_dict_dict[refbase.upper()]
+            p_list = [sbq_pdf.calc_consensus_error_rate(event_list, true_refseq=B, P_N_dict=P_N_dict, bases=m.bases) for B in m.bases]
+            p = min(p_list)
+            consensus_base_call = m.mixed_bases([b for b, tmp_p in zip(m.bases, p_list) if tmp_p == p])
+            q_score = int(np.round(-10 * np.log10(p))) if p >= 10 ** (-5) else 50
+        else:
+            consensus_base_call = "-"
+            q_score = -1
+        consensus_seq_all += consensus_base_call
+        consensus_q_scores_all.append(q_score)
+    return consensus_seq_all, consensus_q_scores_all
+
+def make_symmetric_sbq_pdf(m):
+    # A and T are exchangeable, so that reads of A and T with the same q-scores give exact ties
+    sbq_pdf = copy.deepcopy(m.sbq_pdf)
+    for dst, src in [("T_T", "A_A"), ("A_T", "T_A"), ("C_T", "C_A"), ("G_T", "G_A"), ("-_T", "-_A")]:
+        sbq_pdf.P_base_calling_given_true_refseq_dict[dst] = sbq_pdf.P_base_calling_given_true_refseq_dict[src]
+        sbq_pdf.pdf_core[dst] = sbq_pdf.pdf_core[src]
+    return sbq_pdf
+
+def make_aligned_result(rng, N_reads, N_columns):
+    refseq_with_insertion = "".join(rng.choice(list("ATCGatcg-"), N_columns))
+    my_cigar_matrix = np.frombuffer("".join(rng.choice(list("=XSIDNH"), N_reads * N_columns)).encode("ascii"), dtype=np.uint8).reshape(N_reads, N_columns).copy()
+    has_base = np.isin(my_cigar_matrix, np.frombuffer(b"=XSI", dtype=np.uint8))
+    seq_matrix = np.where(has_base, np.frombuffer(b"ATCGa", dtype=np.uint8)[rng.integers(0, 5, (N_reads, N_columns))], ord("-")).astype(np.uint8)
+    q_score_matrix = np.where(has_base, rng.integers(1, 42, (N_reads, N_columns)), -1).astype(np.int16)    # q_score 0 never occurs in sbq_pdf
+    # column 0: exact tie of A and T, column 1: no events
+    my_cigar_matrix[:, :2] = ord("H")
+    my_cigar_matrix[:2, 0] = [ord("="), ord("X")]
+    seq_matrix[:2, 0] = [ord("A"), ord("T")]
+    q_score_matrix[:2, 0] = 20
+    return {
+        "refseq_with_insertion": refseq_with_insertion, 
+        "query_idx_list": list(range(N_reads)), 
+        "seq_id_list": [f"@read{i}" for i in range(N_reads)], 
+        "my_cigar_matrix": my_cigar_matrix, 
+        "seq_matrix": seq_matrix, 
+        "q_score_matrix": q_score_matrix
+    }
+
+def test_calc_consensus_matches_per_read_reference(alignment_consensus_core):
+    m = alignment_consensus_core
+    rng = np.random.default_rng(0)
+    aligned_result = make_aligned_result(rng, 7, 120)
+    refseq = types.SimpleNamespace(path=m.Path("R0.fa"))
+    alignment_result = types.SimpleNamespace(aligned_result_list=[aligned_result], my_aligner=types.SimpleNamespace(refseq_list=[refseq]))
+    P_N_dict_dict_list = m.consensus_params(param_dict)
+    for sbq_pdf in (m.sbq_pdf, make_symmetric_sbq_pdf(m)):
+        result_list = m.calc_consensus(alignment_result, sbq_pdf, P_N_dict_dict_list)
+        for P_N_dict_dict, (consensus_dict, consensus_settings) in zip(P_N_dict_dict_list, result_list):
+            consensus_seq, consensus_q_scores, consensus_seq_all, consensus_q_scores_all = consensus_dict["R0.fa"]
+            assert (consensus_seq_all, consensus_q_scores_all) == calc_consensus_per_read(m, aligned_result, sbq_pdf, P_N_dict_dict)
+            assert consensus_seq == consensus_seq_all.replace("-", "")
+            assert consensus_seq_all[1] == "-"
+    # without prior, the tie is reported as a mixed base
+    consensus_seq_all = m.calc_consensus(alignment_result, make_symmetric_sbq_pdf(m), P_N_dict_dict_list)[1][0]["R0.fa"][2]
+    assert consensus_seq_all[0] == "W"
+
+def test_pileup_counts_are_independent_of_chunks(alignment_consensus_core):
+    m = alignment_consensus_core
+    aligned_result = make_aligned_result(np.random.default_rng(1), 50, 80)
+    pileup_counts = m.PileupCounts.from_aligned_result(aligned_result)
+    pileup_counts_chunked = m.PileupCounts(80)
+    for chunk_start in range(0, 50, 7):
+        pileup_counts_chunked.add(*[aligned_result[k][chunk_start:chunk_start + 7] for k in ("my_cigar_matrix", "seq_matrix", "q_score_matrix")])
+    assert np.array_equal(pileup_counts.event_counts, pileup_counts_chunked.event_counts)
+    assert np.array_equal(pileup_counts.cigar_counts, pileup_counts_chunked.cigar_counts)
+    assert np.array_equal(pileup_counts.get_N_array(["=", "NHS"]), np.array([
+        (aligned_result["my_cigar_matrix"] == ord("=")).sum(axis=0), 
+        np.isin(aligned_result["my_cigar_matrix"], np.frombuffer(b"NHS", dtype=np.uint8)).sum(axis=0)
+    ]))
@@ -0,0 +1,73 @@
+import numpy as np
+from Bio.Seq import Seq
+from conftest import random_seq, mutate
+
+L = 3000
+
+def reverse_complement(seq):
+    return str(Seq(seq).reverse_complement())
+
+def test_get_minimizers_positions(alignment_consensus_core):
+    rng = np.random.default_rng(0)
+    seq = random_seq(rng, 500)
+    minimizer_index = alignment_consensus_core.MinimizerIndex([seq])
+    minimizer_hash, minimizer_pos = minimizer_index.get_minimizers(seq)
+    k, w = minimizer_index.k, minimizer_index.w
+    # hashes of all k-mers (w=1)
+    all_hash, all_pos = alignment_consensus_core.MinimizerIndex([seq], w=1).get_minimizers(seq)
+    assert (all_pos == np.arange(len(seq) - k + 1)).all()
+    assert set(minimizer_pos) <= set(all_pos)
+    assert (minimizer_hash == all_hash[minimizer_pos]).all()
+    # the k-mer with the minimum hash of every window of w k-mers is a minimizer
+    for window_start in range(len(all_hash) - w + 1):
+        assert window_start + np.argmin(all_hash[window_start:window_start + w]) in minimizer_pos
+
+def test_seed_read_spanning_origin(alignment_consensus_core):
+    rng = np.random.default_rng(1)
+    refseq_seq = random_seq(rng, L)
+    other_seq = random_seq(rng, L)
+    minimizer_index = alignment_consensus_core.MinimizerIndex([refseq_seq * 2, other_seq * 2], period_list=[L, L])
+    start = 2500
+    read = mutate(rng, (refseq_seq * 2)[start:start + 1000])  # 500 bases before and after the origin
+    # forward
+    candidate_list = minimizer_index.rank_candidates(read)
+    assert candidate_list[0].result_idx == 0
+    assert abs(candidate_list[0].offset - start) < 30
+    assert minimizer_index.is_separated(candidate_list)
+    # reverse complement: the reverse complement of the read is seeded
+    candidate_list = minimizer_index.rank_candidates(reverse_complement(read))
+    assert candidate_list[0].result_idx == 1
+    assert abs(candidate_list[0].offset - start) < 30
+    assert minimizer_index.is_separated(candidate_list)
+
+def test_seed_offset_is_modulo_period(alignment_consensus_core):
+    rng = np.random.default_rng(2)
+    refseq_seq = random_seq(rng, L)
+    minimizer_index = alignment_consensus_core.MinimizerIndex([refseq_seq * 2], period_list=[L])
+    # the read lies in the 2nd copy, but the offset is given on the 1st copy
+    read = (refseq_seq * 2)[L + 100:L + 900]
+    candidate_list = minimizer_index.rank_candidates(read)
+    assert candidate_list[0].result_idx == 0
+    assert 0 <= candidate_list[0].offset < L
+    assert abs(candidate_list[0].offset - 100) < 10
+
+def test_seed_linear(alignment_consensus_core):
+    rng = np.random.default_rng(3)
+    refseq_seq = random_seq(rng, L)
+    minimizer_index = alignment_consensus_core.MinimizerIndex([refseq_seq])
+    read = mutate(rng, refseq_seq[1200:2000])
+    candidate_list = minimizer_index.rank_candidates(read)
+    assert candidate_list[0].result_idx == 0
+    assert abs(candidate_list[0].offset - 1200) < 30
+
+def test_triage_not_separated(alignment_consensus_core):
+    rng = np.random.default_rng(4)
+    refseq_seq = random_seq(rng, L)
+    minimizer_index = alignment_consensus_core.MinimizerIndex([refseq_seq * 2, refseq_seq * 2], period_list=[L, L])
+    # unrelated read
+    candidate_list = minimizer_index.rank_candidates(random_seq(rng, 1000))
+    assert not minimizer_index.is_separated(candidate_list)
+    # the same read matches two identical refseqs equally
+    candidate_list = minimizer_index.rank_candidates(refseq_seq[:1000])
+    assert candidate_list[0].N_anchors == candidate_list[1].N_anchors
+    assert not minimizer_index.is_separated(candidate_list)
@@ -0,0 +1,245 @@
+import numpy as np
+import pytest
+from Bio.Seq import Seq
+from conftest import random_seq, mutate, MyCigarStr
+from test_circular_alignment import make_aligner, param_dict
+
+L = 1000
+
+def integrate_by_appending(m, refseq_seq, result_list, seq_list, q_scores_list, custom_cigar_score_dict):
+    """
+    the previous builder of AlignmentResult.integrate_assigned_result_info (letters are appended one by one)
+    returns refseq_with_insertion, my_cigar_str_list_with_insertion, new_seq_list_with_insertion, new_q_scores_list_with_insertion
+    """
+    length = len(refseq_seq)
+    my_cigar_str_list = []
+    new_q_scores_list = []
+    new_seq_list = []
+    for result, seq, q_scores in zip(result_list, seq_list, q_scores_list):
+        my_cigar_str = MyCigarStr(result.cigar)
+        number_of_ref_bases_before_query = result.beg_ref - result.beg_query
+        number_of_ref_bases_after_query = (length * 2 - result.end_ref - 1) - (len(seq) - result.end_query - 1)
+        if (number_of_ref_bases_before_query < 0):
+            q_scores = q_scores[-number_of_ref_bases_before_query:]
+            seq      = seq[-number_of_ref_bases_before_query:]
+            beg_query = result.beg_query + number_of_ref_bases_before_query
+            end_query = result.end_query + number_of_ref_bases_before_query
+            number_of_ref_bases_before_query = 0
+        else:
+            beg_query = result.beg_query
+            end_query = result.end_query
+        if (number_of_ref_bases_after_query < 0):
+            q_scores = q_scores[:number_of_ref_bases_after_query]
+            seq      = seq[:number_of_ref_bases_after_query]
+            number_of_ref_bases_after_query = 0
+        my_cigar_str = MyCigarStr(
+            "H" * number_of_ref_bases_before_query
+            + "S" * beg_query
+            + my_cigar_str
+            + "S" * (len(seq) - end_query - 1)
+            + "H" * number_of_ref_bases_after_query
+        )
+        my_cigar_str = MyCigarStr(
+            "H" * my_cigar_str.number_of_letters_on_5prime("HD")
+            + my_cigar_str.clip_from_both_ends("HD")
+            + "H" * my_cigar_str.number_of_letters_on_3prime("HD")
+        )
+        number_of_I_on_5prime = my_cigar_str.number_of_letters_on_5prime("I")
+        if number_of_I_on_5prime > 0:
+            my_cigar_str = MyCigarStr(my_cigar_str[number_of_I_on_5prime:])
+            q_scores = q_scores[number_of_I_on_5prime:]
+            seq = seq[number_of_I_on_5prime:]
+        my_cigar_str_list.append(my_cigar_str)
+        new_q_scores_list.append(list(q_scores))
+        new_seq_list.append(seq)
+
+    duplicated_refseq = refseq_seq + refseq_seq
+    duplicated_refseq_with_insertion = ""
+    my_cigar_str_list_with_insertion = ["" for i in my_cigar_str_list]
+    new_q_scores_list_with_insertion = [[] for i in new_q_scores_list]
+    new_seq_list_with_insertion = ["" for i in new_seq_list]
+    cur_refseq_idx = 0
+    cur_my_cigar_str_idx_list = [0 for i in my_cigar_str_list]
+    cur_q_scores_idx_list = [0 for i in new_q_scores_list]
+    max_refseq_idx = length * 2 - 1
+    max_my_cigar_str_idx_list = [len(my_cigar_str) - 1 for my_cigar_str in my_cigar_str_list]
+    max_q_scores_idx_list = [len(new_q_scores) - 1 for new_q_scores in new_q_scores_list]
+    all_done = False
+    cur_idx = -1
+    while not all_done:
+        cur_idx += 1
+        cur_my_cigar_letter_list = [my_cigar_str[cur_my_cigar_str_idx] if cur_my_cigar_str_idx < len(my_cigar_str) else "H" for my_cigar_str, cur_my_cigar_str_idx in zip(my_cigar_str_list, cur_my_cigar_str_idx_list)]
+        if "I" not in cur_my_cigar_letter_list:
+            for i, L_ in enumerate(cur_my_cigar_letter_list):
+                if L_ in "DH":
+                    my_cigar_str_list_with_insertion[i] += L_
+                    new_q_scores_list_with_insertion[i] += [-1]
+                    new_seq_list_with_insertion[i]      += "-"
+                    cur_my_cigar_str_idx_list[i]        += 1
+                else:
+                    assert L_ in "=XS"
+                    my_cigar_str_list_with_insertion[i] += L_
+                    new_q_scores_list_with_insertion[i] += [new_q_scores_list[i][cur_q_scores_idx_list[i]]]
+                    new_seq_list_with_insertion[i]      += new_seq_list[i][cur_q_scores_idx_list[i]]
+                    cur_my_cigar_str_idx_list[i]        += 1
+                    cur_q_scores_idx_list[i]            += 1
+            duplicated_refseq_with_insertion += duplicated_refseq[cur_refseq_idx]
+            if cur_refseq_idx == length:
+                turning_idx = cur_idx
+            cur_refseq_idx += 1
+        else:
+            for i, L_ in enumerate(cur_my_cigar_letter_list):
+                if L_ == "I":
+                    my_cigar_str_list_with_insertion[i] += "I"
+                    new_q_scores_list_with_insertion[i] += [new_q_scores_list[i][cur_q_scores_idx_list[i]]]
+                    new_seq_list_with_insertion[i]      += new_seq_list[i][cur_q_scores_idx_list[i]]
+                    cur_my_cigar_str_idx_list[i]        += 1
+                    cur_q_scores_idx_list[i]            += 1
+                else:
+                    my_cigar_str_list_with_insertion[i] += "N"
+                    new_q_scores_list_with_insertion[i] += [-1]
+                    new_seq_list_with_insertion[i]      += "-"
+            duplicated_refseq_with_insertion += "-"
+        all_done = bool(
+            (cur_refseq_idx > max_refseq_idx)
+            * all([c > mx for c, mx in zip(cur_my_cigar_str_idx_list, max_my_cigar_str_idx_list)])
+            * all([c > mx for c, mx in zip(cur_q_scores_idx_list, max_q_scores_idx_list)])
+        )
+    # linearize
+    refseq_with_insertion_1 = duplicated_refseq_with_insertion[:turning_idx]
+    refseq_with_insertion_2 = duplicated_refseq_with_insertion[turning_idx:]
+    my_cigar_str_list_with_insertion_1 = [i[:turning_idx] for i in my_cigar_str_list_with_insertion]
+    my_cigar_str_list_with_insertion_2 = [i[turning_idx:] for i in my_cigar_str_list_with_insertion]
+    new_seq_list_with_insertion_1      = [i[:turning_idx] for i in new_seq_list_with_insertion]
+    new_seq_list_with_insertion_2      = [i[turning_idx:] for i in new_seq_list_with_insertion]
+    new_q_scores_list_with_insertion_1 = [i[:turning_idx] for i in new_q_scores_list_with_insertion]
+    new_q_scores_list_with_insertion_2 = [i[turning_idx:] for i in new_q_scores_list_with_insertion]
+    N_gap_refseq_with_insertion_1_end = 1
+    while refseq_with_insertion_1[-N_gap_refseq_with_insertion_1_end] == "-":
+        N_gap_refseq_with_insertion_1_end += 1
+    if N_gap_refseq_with_insertion_1_end > 1:
+        refseq_with_insertion_1 = refseq_with_insertion_1[:1 - N_gap_refseq_with_insertion_1_end]
+        my_cigar_str_list_with_insertion_1 = [i[:1 - N_gap_refseq_with_insertion_1_end] for i in my_cigar_str_list_with_insertion_1]
+        new_seq_list_with_insertion_1 = [i[:1 - N_gap_refseq_with_insertion_1_end] for i in new_seq_list_with_insertion_1]
+        new_q_scores_list_with_insertion_1 = [i[:1 - N_gap_refseq_with_insertion_1_end] for i in new_q_scores_list_with_insertion_1]
+    idx = -1
+    refseq_idx1 = 0
+    refseq_idx2 = 0
+    refseq_max_idx1 = len(refseq_with_insertion_1) - 1
+    refseq_max_idx2 = len(refseq_with_insertion_2) - 1
+    while True:
+        idx += 1
+        if refseq_with_insertion_1[idx] == refseq_with_insertion_2[idx]:
+            refseq_idx1 += 1
+            refseq_idx2 += 1
+        elif refseq_with_insertion_1[idx] == "-":
+            refseq_idx1 += 1
+            refseq_with_insertion_2 = refseq_with_insertion_2[:idx] + "-" + refseq_with_insertion_2[idx:]
+            my_cigar_str_list_with_insertion_2 = [j[:idx] + "N" + j[idx:] for j in my_cigar_str_list_with_insertion_2]
+            new_seq_list_with_insertion_2 = [j[:idx] + "-" + j[idx:] for j in new_seq_list_with_insertion_2]
+            for i in new_q_scores_list_with_insertion_2:
+                i.insert(idx, -1)
+        elif refseq_with_insertion_2[idx] == "-":
+            refseq_idx2 += 1
+            refseq_with_insertion_1 = refseq_with_insertion_1[:idx] + "-" + refseq_with_insertion_1[idx:]
+            my_cigar_str_list_with_insertion_1 = [j[:idx] + "N" + j[idx:] for j in my_cigar_str_list_with_insertion_1]
+            new_seq_list_with_insertion_1 = [j[:idx] + "-" + j[idx:] for j in new_seq_list_with_insertion_1]
+            for i in new_q_scores_list_with_insertion_1:
+                i.insert(idx, -1)
+        else:
+            raise Exception("error!")
+        if (refseq_idx1 == refseq_max_idx1) & (refseq_idx2 == refseq_max_idx2):
+            break
+    assert refseq_with_insertion_1 == refseq_with_insertion_2
+    # switch from the 2nd half to the 1st half
+    my_cigar_str_list_with_insertion = []
+    new_seq_list_with_insertion = []
+    new_q_scores_list_with_insertion = []
+    for j1, j2, k1, k2, l1, l2 in zip(
+            my_cigar_str_list_with_insertion_1, my_cigar_str_list_with_insertion_2, 
+            new_seq_list_with_insertion_1, new_seq_list_with_insertion_2, 
+            new_q_scores_list_with_insertion_1, new_q_scores_list_with_insertion_2
+    ):
+        scores_1 = np.array([custom_cigar_score_dict[j] for j in j1])
+        scores_2 = np.array([custom_cigar_score_dict[j] for j in j2])
+        switching_idx = np.argmin(np.cumsum(scores_1 - scores_2))
+        my_cigar_str_list_with_insertion.append(j2[:switching_idx + 1] + j1[switching_idx + 1:])
+        new_seq_list_with_insertion.append(k2[:switching_idx + 1] + k1[switching_idx + 1:])
+        new_q_scores_list_with_insertion.append(l2[:switching_idx + 1] + l1[switching_idx + 1:])
+    return refseq_with_insertion_1, my_cigar_str_list_with_insertion, new_seq_list_with_insertion, new_q_scores_list_with_insertion
+
+def simulate_reads(rng, refseq_seq, N_reads):
+    duplicated_refseq_seq = refseq_seq * 2
+    read_list = []
+    for i in range(N_reads):
+        start = int(rng.integers(0, L))
+        read_length = int(rng.integers(L // 2, L - 50))
+        read = mutate(rng, duplicated_refseq_seq[start:start + read_length], rate=0.02)
+        # insertions of different lengths at the junction (between the last and the 1st base of the refseq)
+        if i % 2 == 0:
+            start = L - int(rng.integers(100, 300))
+            read = mutate(rng, duplicated_refseq_seq[start:L], rate=0.02) + random_seq(rng, int(rng.integers(1, 6))) + mutate(rng, refseq_seq[:read_length - (L - start)], rate=0.02)
+        if i % 3 == 0:
+            read = str(Seq(read).reverse_complement())
+        read_list.append(read)
+    return read_list
+
+def test_msa_builder_matches_appending_builder(alignment_consensus_core, tmp_path):
+    m = alignment_consensus_core
+    rng = np.random.default_rng(0)
+    refseq_seq = random_seq(rng, L)
+    read_list = simulate_reads(rng, refseq_seq, 30)
+    my_aligner = make_aligner(m, tmp_path, [refseq_seq], read_list)
+    q_buffer = my_aligner.combined_fastq.q_buffer
+    q_buffer[:] = rng.integers(0, 42, len(q_buffer), dtype=np.uint8).tobytes()
+    alignment_result = m.AlignmentResult(my_aligner.align_all(), my_aligner, param_dict)
+    alignment_result.normalize_scores_and_apply_threshold()
+    alignment_result.integrate_assigned_result_info(keep_reads=True)
+    aligned_result = alignment_result.aligned_result_list[0]
+    result_info_list = alignment_result.result_info_assigned[0]
+    assert len(result_info_list) == len(read_list)
+    # previous builder
+    seq_list = []
+    q_scores_list = []
+    for seq_id, is_reverse_compliment, result, query_idx in result_info_list:
+        seq, q_scores = my_aligner.combined_fastq[seq_id]
+        if is_reverse_compliment:
+            seq = str(Seq(seq).reverse_complement())
+            q_scores = q_scores[::-1]
+        seq_list.append(seq)
+        q_scores_list.append(q_scores)
+    refseq_with_insertion, my_cigar_str_list, new_seq_list, new_q_scores_list = integrate_by_appending(
+        m, refseq_seq, [result_info[2] for result_info in result_info_list], seq_list, q_scores_list, my_aligner.get_custom_cigar_score_dict()
+    )
+    assert refseq_with_insertion != refseq_seq  # insertion columns exist
+    assert aligned_result["refseq_with_insertion"] == refseq_with_insertion
+    rows = list(m.AlignmentResult.iter_aligned_reads(aligned_result))
+    assert [row[2] for row in rows] == my_cigar_str_list
+    assert [row[3] for row in rows] == new_seq_list
+    assert [row[4].tolist() for row in rows] == new_q_scores_list
+
+def test_counts_only_integration(alignment_consensus_core, tmp_path):
+    m = alignment_consensus_core
+    rng = np.random.default_rng(1)
+    refseq_seq = random_seq(rng, L)
+    my_aligner = make_aligner(m, tmp_path, [refseq_seq], simulate_reads(rng, refseq_seq, 20))
+    alignment_result = m.AlignmentResult(my_aligner.align_all(), my_aligner, param_dict)
+    alignment_result.normalize_scores_and_apply_threshold()
+    # per-read alignments are kept by default
+    alignment_result.integrate_assigned_result_info()
+    aligned_result = alignment_result.aligned_result_list[0]
+    assert "my_cigar_matrix" in aligned_result
+    # reads are organized and scattered chunk by chunk
+    alignment_result.read_chunk_size = 3
+    alignment_result.integrate_assigned_result_info(keep_reads=False)
+    aligned_result_counts_only = alignment_result.aligned_result_list[0]
+    assert "my_cigar_matrix" not in aligned_result_counts_only
+    assert aligned_result_counts_only["refseq_with_insertion"] == aligned_result["refseq_with_insertion"]
+    assert np.array_equal(aligned_result_counts_only["pileup_counts"].event_counts, aligned_result["pileup_counts"].event_counts)
+    assert np.array_equal(aligned_result_counts_only["pileup_counts"].cigar_counts, aligned_result["pileup_counts"].cigar_counts)
+    # alignments can not be exported without per-read data
+    alignment_result.consensus_dict = {}
+    text_list, save_path_list = alignment_result.export_as_text(tmp_path)
+    assert save_path_list == [] and not (tmp_path / "R0.txt").exists()
+    with pytest.raises(Exception, match="keep_reads=True"):
+        alignment_result.alignment_reuslt_list_2_text_list(linewidth=100)
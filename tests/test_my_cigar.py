@@ -0,0 +1,57 @@
+import re
+import numpy as np
+from conftest import MyCigarStr
+
+def random_cigar_str(rng, N_runs, letters="=XIDSH"):
+    # adjacent runs of the same letter are allowed (merged by MyCigar)
+    return "".join(f"{rng.integers(1, 8)}{rng.choice(list(letters))}" for i in range(N_runs))
+
+def expand(my_cigar):
+    return my_cigar.to_array().tobytes().decode("ascii")
+
+def get_insertions_str(my_cigar_str):
+    ref_idx_list = []
+    insertion_length_list = []
+    for m in re.finditer("I+", my_cigar_str):
+        ref_idx_list.append(len(my_cigar_str[:m.start()].replace("I", "")))
+        insertion_length_list.append(len(m.group()))
+    return ref_idx_list, insertion_length_list
+
+def test_my_cigar_matches_my_cigar_str(alignment_consensus_core):
+    m = alignment_consensus_core
+    rng = np.random.default_rng(0)
+    for trial in range(300):
+        cigar_str = random_cigar_str(rng, int(rng.integers(1, 12)))
+        my_cigar = m.MyCigar.from_cigar_str(cigar_str)
+        my_cigar_str = MyCigarStr(cigar_str)
+        assert expand(my_cigar) == my_cigar_str
+        assert len(my_cigar) == len(my_cigar_str)
+        assert MyCigarStr(str(my_cigar)) == my_cigar_str
+        assert np.all(my_cigar.letter_array[1:] != my_cigar.letter_array[:-1])
+        for letters in ("HD", "I", "S", "=X"):
+            if my_cigar_str.strip(letters) == "":
+                # all letters are included
+                assert my_cigar.number_of_letters_on_5prime(letters) == len(my_cigar_str)
+                assert expand(my_cigar.clip_from_both_ends(letters)) == ""
+                continue
+            i = my_cigar_str.number_of_letters_on_5prime(letters)
+            k = my_cigar_str.number_of_letters_on_3prime(letters)
+            assert my_cigar.number_of_letters_on_5prime(letters) == i
+            assert my_cigar.number_of_letters_on_3prime(letters) == k
+            assert expand(my_cigar.clip_from_both_ends(letters)) == my_cigar_str.clip_from_both_ends(letters)
+            assert expand(my_cigar.replace_both_ends(letters, "H")) == "H" * i + my_cigar_str.clip_from_both_ends(letters) + "H" * k
+        for N in (0, 1, int(rng.integers(0, len(my_cigar_str) + 1)), len(my_cigar_str)):
+            assert expand(my_cigar.trim_5prime(N)) == my_cigar_str[N:]
+        ref_idx, insertion_length = my_cigar.get_insertions()
+        assert (ref_idx.tolist(), insertion_length.tolist()) == get_insertions_str(my_cigar_str)
+        assert my_cigar.ref_length() == len(my_cigar_str) - my_cigar_str.count("I")
+
+def test_concatenate(alignment_consensus_core):
+    m = alignment_consensus_core
+    rng = np.random.default_rng(1)
+    for trial in range(100):
+        cigar_str_list = [random_cigar_str(rng, int(rng.integers(0, 5))) for i in range(int(rng.integers(1, 5)))]
+        my_cigar = m.MyCigar.concatenate([m.MyCigar.from_cigar_str(cigar_str) for cigar_str in cigar_str_list])
+        assert expand(my_cigar) == "".join(expand(m.MyCigar.from_cigar_str(cigar_str)) for cigar_str in cigar_str_list)
+        assert np.all(my_cigar.letter_array[1:] != my_cigar.letter_array[:-1])
+    assert expand(m.MyCigar.concatenate([m.MyCigar.from_letter("H", 3), m.MyCigar.from_letter("H", 0), m.MyCigar.from_letter("H", 2)])) == "HHHHH"
@@ -0,0 +1,170 @@
+import itertools
+import pytest
+import numpy as np
+from conftest import random_seq, mutate
+
+param_dict = dict(gap_open_penalty=3, gap_extend_penalty=1, match_score=1, mismatch_score=-2, score_threshold=20)
+
+def make_refseq_list(m, tmp_path, seq_list):
+    refseq_list = []
+    for i, seq in enumerate(seq_list):
+        path = tmp_path / f"P{i}.fa"
+        path.write_text(f">P{i}\n{seq}\n")
+        refseq_list.append(m.MyRefSeq_Minimum(path))
+    return refseq_list
+
+def make_seq_list(rng, N_families=3, N_members=2, length=600):
+    seq_list = []
+    for i in range(N_families):
+        seq = random_seq(rng, length)
+        seq_list += [mutate(rng, seq, rate=0.005) for j in range(N_members)]
+    seq_list.append(seq_list[0])    # identical sequences are not aligned
+    return seq_list
+
+def test_parallel_matches_serial(pre_survey_core, tmp_path):
+    m = pre_survey_core
+    rng = np.random.default_rng(0)
+    refseq_list = make_refseq_list(m, tmp_path, make_seq_list(rng))
+    for func in (m.pre_survery, m.pre_survery_linear):
+        score_matrix_serial = func(refseq_list, param_dict, max_workers=1, callback=lambda N_done, total_N: None)
+        score_matrix_parallel = func(refseq_list, param_dict, max_workers=2, callback=lambda N_done, total_N: None)
+        assert np.array_equal(score_matrix_serial, score_matrix_parallel)
+        assert np.all(np.diag(score_matrix_serial) == 0)
+        assert score_matrix_serial[0, -1] == score_matrix_serial[-1, 0] == 0
+
+def test_lower_bound_distance_never_exceeds_distance(pre_survey_core):
+    m = pre_survey_core
+    rng = np.random.default_rng(1)
+    for trial in range(20):
+        refseq_seq = random_seq(rng, 800)
+        query_seq = mutate(rng, refseq_seq, rate=[0.002, 0.01, 0.05][trial % 3])
+        # rotated (across the origin), reverse complement, partial or unrelated queries
+        if trial % 4 == 1:
+            start = int(rng.integers(1, 800))
+            query_seq = query_seq[start:] + query_seq[:start]
+        elif trial % 4 == 2:
+            query_seq = str(m.Seq(query_seq).reverse_complement())[:500]
+        elif trial % 4 == 3:
+            query_seq = random_seq(rng, 700)
+        for is_linear in (False, True):
+            lower_bound = m.KmerSketch(query_seq, is_circular=not is_linear).lower_bound_distance(m.KmerSketch(refseq_seq, is_circular=not is_linear))
+            if is_linear:
+                d = m.calc_distance_linear(refseq_seq, query_seq, param_dict)
+            else:
+                d = m.calc_distance(refseq_seq + refseq_seq, query_seq, param_dict)
+            assert lower_bound <= d
+
+def test_far_pairs_are_not_distances(pre_survey_core, tmp_path):
+    m = pre_survey_core
+    rng = np.random.default_rng(2)
+    refseq_list = make_refseq_list(m, tmp_path, make_seq_list(rng))
+    callback = lambda N_done, total_N: None
+    score_matrix = m.pre_survery(refseq_list, param_dict, max_workers=1, callback=callback)
+    score_matrix_prefiltered = m.pre_survery(refseq_list, param_dict, max_workers=1, callback=callback, score_threshold=param_dict["score_threshold"])
+    is_far = score_matrix_prefiltered == m.FAR_DISTANCE
+    assert is_far.any()
+    assert np.all(score_matrix[is_far] > param_dict["score_threshold"])
+    assert np.array_equal(score_matrix[~is_far], score_matrix_prefiltered[~is_far])
+    # far pairs are farther than any measured pairs
+    distance_matrix = m.get_distance_matrix(score_matrix_prefiltered)
+    is_far_both = is_far & is_far.T
+    assert np.isinf(distance_matrix[is_far_both]).all()
+    assert distance_matrix[~is_far_both].max() < np.inf
+    # similar sequences are separated as with measured distances
+    for comb in (
+        m.recommended_combination(score_matrix_prefiltered, param_dict["score_threshold"])[0], 
+        m.plan_multiplex(score_matrix_prefiltered, param_dict["score_threshold"], 3)
+    ):
+        assert sorted(sum(comb, [])) == list(range(len(refseq_list)))
+        for combination in comb:
+            for i, j in itertools.combinations(combination, 2):
+                assert min(score_matrix[i, j], score_matrix[j, i]) >= param_dict["score_threshold"]
+    # heatmap
+    tmp_names = [f"P{i + 1}" for i in range(len(refseq_list))]
+    fig, ax = m.draw_heatmap_core(score_matrix_prefiltered, tmp_names, tmp_names, threshold_used=param_dict["score_threshold"])
+    text_list = [t.get_text() for t in ax.texts]
+    assert text_list.count(">20") == is_far.sum()
+    assert str(m.FAR_DISTANCE) not in text_list
+
+def test_distance_cache(pre_survey_core, tmp_path):
+    m = pre_survey_core
+    rng = np.random.default_rng(3)
+    seq_list = make_seq_list(rng)[:-1]
+    refseq_list = make_refseq_list(m, tmp_path, seq_list)
+    N = len(refseq_list)
+    distance_cache_path = tmp_path / "distance_cache.tsv"
+    for func in (m.pre_survery, m.pre_survery_linear):
+        score_matrix = func(refseq_list, param_dict, max_workers=1, callback=lambda N_done, total_N: None)
+        # 1st call: all pairs are aligned, 2nd call: all pairs are loaded from the cache
+        for N_expected in (N * (N - 1), 0):
+            N_aligned_list = []
+            score_matrix_cached = func(refseq_list, param_dict, max_workers=1, callback=lambda N_done, total_N: N_aligned_list.append(N_done), distance_cache_path=distance_cache_path)
+            assert len(N_aligned_list) == N_expected
+            assert np.array_equal(score_matrix_cached, score_matrix)
+        # a new plasmid: only the pairs with it are aligned
+        (tmp_path / func.__name__).mkdir()
+        refseq_list_added = refseq_list + make_refseq_list(m, tmp_path / func.__name__, [random_seq(rng, 600)])
+        N_aligned_list = []
+        score_matrix_added = func(refseq_list_added, param_dict, max_workers=1, callback=lambda N_done, total_N: N_aligned_list.append(N_done), distance_cache_path=distance_cache_path)
+        assert len(N_aligned_list) == 2 * N
+        assert np.array_equal(score_matrix_added[:N, :N], score_matrix)
+        assert np.array_equal(score_matrix_added, func(refseq_list_added, param_dict, max_workers=1, callback=lambda N_done, total_N: None))
+
+def test_recommended_combination_large_group(pre_survey_core, monkeypatch):
+    m = pre_survey_core
+    rng = np.random.default_rng(4)
+    # a group of 8 close plasmids (8! permutations > exact_limit), a group of 3, and 2 isolated plasmids
+    group_list = [list(range(8)), [8, 9, 10], [11], [12]]
+    N = 13
+    score_matrix = rng.integers(60, 100, size=(N, N))
+    for group in group_list:
+        score_matrix[np.ix_(group, group)] = rng.integers(1, 15, size=(len(group), len(group)))
+    np.fill_diagonal(score_matrix, 0)
+    assign_group_call_list = []
+    assign_group = m.assign_group
+    def assign_group_spy(combination_list, group, calc_group_score):
+        assign_group_call_list.append(sorted(group))
+        return assign_group(combination_list, group, calc_group_score)
+    monkeypatch.setattr(m, "assign_group", assign_group_spy)
+    combination_list, result = m.recommended_combination(score_matrix, 20)
+    assert list(range(8)) in assign_group_call_list
+    assert len(combination_list) == 8
+    assert sorted(sum(combination_list, [])) == list(range(N))
+    for combination in combination_list:
+        for i, j in itertools.combinations(combination, 2):
+            assert min(score_matrix[i, j], score_matrix[j, i]) >= 20
+
+def test_plan_multiplex_minimum_number_of_samples(pre_survey_core):
+    m = pre_survey_core
+    # complete bipartite graph (P1-P3 vs P4-P5): P4 and P5 can only share a sample with each other
+    conflict_matrix = np.zeros((5, 5), dtype=bool)
+    conflict_matrix[:3, 3:] = True
+    conflict_matrix |= conflict_matrix.T
+    score_matrix = np.where(conflict_matrix, 5, 50)
+    np.fill_diagonal(score_matrix, 0)
+    # optimum: [P4, P5] and P1-P3 in 2 samples (DSatur-like heuristic alone uses 4 samples)
+    assert len(m.plan_multiplex(score_matrix, 20, 2, exact_limit=0)) == 4
+    comb = m.plan_multiplex(score_matrix, 20, 2)
+    assert len(comb) == 3
+    assert sorted(sum(comb, [])) == list(range(5))
+    assert [3, 4] in comb
+    assert all(len(combination) <= 2 for combination in comb)
+
+def textsize_with_svg_file(cairo, text, fontsize, font_style, tmp_svg_path):
+    # previous Svg.textsize
+    surface = cairo.SVGSurface(str(tmp_svg_path), 1280, 200)
+    cr = cairo.Context(surface)
+    cr.select_font_face(font_style, cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_BOLD)
+    cr.set_font_size(fontsize)
+    xbearing, ybearing, width, height, xadvance, yadvance = cr.text_extents(text)
+    surface.finish()
+    return {"xbearing":xbearing, "ybearing":ybearing, "width":width, "height":height, "xadvance":xadvance, "yadvance":yadvance}
+
+def test_text_metrics_match_svg_surface(pre_survey_core, tmp_path):
+    m = pre_survey_core
+    cairo = pytest.importorskip("cairo")
+    for text in ["P1", "threshold=20", "P12 : M160_P18-CIBN-P2A-CRY2-mCherry-PLDs17_pcDNA3.dna", ""]:
+        for fontsize in [8, 10, 12.5]:
+            assert m.Svg.textsize(text, fontsize, "Helvetica") == textsize_with_svg_file(cairo, text, fontsize, "Helvetica", tmp_path / "undefined.svg")
+            # cached
+            assert m.text_metrics.textsize(text, fontsize, "Helvetica") == m.Svg.textsize(text, fontsize, "Helvetica")
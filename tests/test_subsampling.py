@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+from conftest import random_seq, mutate
+from test_circular_alignment import make_aligner, param_dict
+
+L = 1500
+
+def make_subsampling_data(rng, N_reads_per_refseq=20):
+    refseq_seq_list = [random_seq(rng, L), random_seq(rng, L)]
+    read_list = []
+    for i in range(N_reads_per_refseq):
+        for refseq_seq in refseq_seq_list:
+            start = int(rng.integers(0, L))
+            read_list.append(mutate(rng, (refseq_seq * 2)[start:start + 1000]))
+    read_list.append(random_seq(rng, 1000))    # not assigned
+    return refseq_seq_list, read_list
+
+def test_alignment_stops_at_target_depth(alignment_consensus_core, tmp_path):
+    m = alignment_consensus_core
+    refseq_seq_list, read_list = make_subsampling_data(np.random.default_rng(0))
+    my_aligner = make_aligner(m, tmp_path, refseq_seq_list, read_list, target_depth=4, depth_margin=0.1)
+    result_dict = my_aligner.align_all()
+    assert 10 <= len(result_dict) < len(read_list)
+    # the order of combined_fastq is kept
+    seq_id_list = list(result_dict.keys())
+    assert seq_id_list == [seq_id for seq_id in my_aligner.combined_fastq.seq_id_list if seq_id in result_dict]
+    # assignment during the alignment is the same as apply_threshold
+    alignment_result = m.AlignmentResult(result_dict, my_aligner, param_dict)
+    alignment_result.normalize_scores_and_apply_threshold()
+    N_assigned_array = np.array([len(result_info_list) for result_info_list in alignment_result.result_info_assigned])
+    assert (N_assigned_array >= 5).all() and (N_assigned_array == 5).any()
+    assert [my_aligner.assign_single(result_dict[info["seq_id"]], len(my_aligner.combined_fastq[info["seq_id"]][0])) for info in alignment_result.score_list_ALL]\
+        == [info["assigned_refseq_idx"] if info["assigned"] else None for info in alignment_result.score_list_ALL]
+
+def test_subsampled_reads_do_not_depend_on_max_workers(alignment_consensus_core, tmp_path):
+    m = alignment_consensus_core
+    refseq_seq_list, read_list = make_subsampling_data(np.random.default_rng(1))
+    seq_id_list_list = []
+    for max_workers in (1, 2):
+        my_aligner = make_aligner(m, tmp_path, refseq_seq_list, read_list, max_workers=max_workers, target_depth=4, subsampling_seed=3)
+        seq_id_list_list.append(list(my_aligner.align_all().keys()))
+    assert len(seq_id_list_list[0]) < len(read_list)
+    assert seq_id_list_list[0] == seq_id_list_list[1]
+
+def test_target_depth_requires_score_threshold(alignment_consensus_core, tmp_path):
+    m = alignment_consensus_core
+    refseq_seq_list, read_list = make_subsampling_data(np.random.default_rng(2), N_reads_per_refseq=2)
+    my_aligner = make_aligner(m, tmp_path, refseq_seq_list, read_list, target_depth=4)
+    my_aligner.param_dict = dict(param_dict, score_threshold="auto")
+    with pytest.raises(Exception, match="score_threshold must be a number"):
+        my_aligner.align_all()